@@ -11,7 +11,7 @@ import math
 class CheapestTime(hass.Hass):
     def initialize(self):
         self.log("Starting with arguments " + str(self.args))
-        self.utils                   = PowerUtils(self.log) 
+        self.utils                   = PowerUtils(self.log, self.get_main_log()) 
         batteryPlanSummaryEntityName = self.args['batteryPlanSummaryEntity']
         self.startTimeEntityName     = self.args['startTimeEntity']
         self.programTime             = None
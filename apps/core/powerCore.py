@@ -1,59 +1,159 @@
 from datetime   import datetime
 from datetime   import timedelta
 from datetime   import timezone
-from statistics import mean
 from core.powerUtils import PowerUtils
+from core.powerUtils import IndexedSeries
+from core.powerUtils import RenderedSeries
+from core.powerSeries import ColumnSeries
+from core.powerSeries import SlotGrid
+from core.powerSeries import RatePool
+from core.powerSeries import secondsPerDay
+from core.powerDiagnostics import StageTimer
+from core.powerDiagnostics import timedRun
+from core.powerPlanCache import PlanCache
+from core.powerDpPlanner import DpChargePlanner
+from core.powerDecisions import DecisionTable
+from core.powerSnapshots import SnapshotWriter
+from core.powerSnapshots import readSnapshot
 import re
+import bisect
 import math
 import numpy
-import matplotlib.pyplot as plt
 import json
 import os
 import pickle
 import sys
 import copy
-import functools
+
+
+
+class BatteryProfile():
+    # The forecast battery level for each slot on the grid, where each entry is a tuple of (remaining 
+    # energy, fully charged, empty, app percentage). Alongside each entry we keep a summary of the 
+    # profile up to and including that slot. Changing a plan only affects the battery level from the 
+    # changed slot onwards, so we track the first slot that's out of date and only recalculate the 
+    # profile from there. The profile depends on which solar / usage percentile is used, so we keep 
+    # a separate profile for each one. Each profile is a list of [levels, summaries, first invalid slot].
+    def __init__(self):
+        self.profiles        = {}
+        self.shared          = set()
+        self.percentileIndex = None
+        self.current         = []
+
+
+    def select(self, percentileIndex):
+        # Makes the profile for the percentile the current one, and returns it ready to be updated. 
+        # Copies of a profile share the levels and summaries until one of them needs to change them.
+        self.percentileIndex = percentileIndex
+        profile              = self.profiles.setdefault(percentileIndex, [[], [], 0])
+        if percentileIndex in self.shared:
+            self.shared.discard(percentileIndex)
+            profile[0] = list(profile[0])
+            profile[1] = list(profile[1])
+        self.current = profile[0]
+        return profile
+
+
+    def invalidateFrom(self, slotIdx):
+        for profile in self.profiles.values():
+            profile[2] = min(profile[2], slotIdx)
+
+
+    def copy(self):
+        newProfile                 = BatteryProfile()
+        newProfile.profiles        = dict(map(lambda x: (x[0], list(x[1])), self.profiles.items()))
+        newProfile.percentileIndex = self.percentileIndex
+        newProfile.current         = self.current
+        # Both profiles now share the levels, so they both need to copy them before making changes
+        self.shared                = set(self.profiles)
+        newProfile.shared          = set(self.profiles)
+        return newProfile
+
+
+    def __getitem__(self, slotIdx):
+        return self.current[slotIdx]
+
+
+    def __len__(self):
+        return len(self.current)
+
+
+    def __iter__(self):
+        return iter(self.current)
 
 
 
 class BatteryAllocateState():
-    def __init__(self, exportRateData, importRateData, solarSurplus, usageAfterSolar, core):
-        self.utils                    = core.utils
-        self.batProfile               = []
-        self.solarChargingPlan        = []
-        self.gridChargingPlan         = []
-        self.houseGridPoweredPlan     = []
-        self.dischargeExportSolarPlan = []
-        self.dischargeToGridPlan      = []
-        self.eddiSolarPlan            = []
-        self.eddiGridPlan             = []
+    planNames = ["solarChargingPlan",        "gridChargingPlan",    "houseGridPoweredPlan",
+                 "dischargeExportSolarPlan", "dischargeToGridPlan", "eddiSolarPlan",
+                 "eddiGridPlan"]
+    poolNames = ["availableExportRates",     "availableImportRates", "availableHouseGridPoweredRates"]
+
+
+    def __init__(self, grid, exportRates, importRates, solarUsage, solarSurplus, usageAfterSolar, core):
+        self.grid                     = grid
+        self.batProfile               = BatteryProfile()
+        self.solarChargingPlan        = grid.emptyPlan()
+        self.gridChargingPlan         = grid.emptyPlan()
+        self.houseGridPoweredPlan     = grid.emptyPlan()
+        self.dischargeExportSolarPlan = grid.emptyPlan()
+        self.dischargeToGridPlan      = grid.emptyPlan()
+        self.eddiSolarPlan            = grid.emptyPlan()
+        self.eddiGridPlan             = grid.emptyPlan()
         self.gridSummary              = {}
         self.maxChargeCost            = core.maxChargeCost
+        # The inputs are held as lists with an entry per slot on the grid. They don't change during
+        # planning so they're shared between copies of the state.
+        self.solarUsage               = solarUsage
         self.solarSurplus             = solarSurplus
         self.usageAfterSolar          = usageAfterSolar
-        self.exportRateData           = exportRateData
-        self.importRateData           = importRateData
-        self.availableExportRates     = sorted(exportRateData, key=lambda x: x[2])
-        self.availableImportRates     = sorted(importRateData, key=lambda x: (x[2], x[0]))
-        # We create a set of effective "charge" rates associated with not discharging the battery. The 
-        # idea is that if we choose not to discharge for a period that's the same as charging the battery 
+        self.exportRates              = exportRates
+        self.importRates              = importRates
+        # The available rates are pools of slots, so we can quickly find the cheapest one
+        self.availableExportRates     = RatePool(grid, exportRates, range(len(grid)))
+        self.availableImportRates     = RatePool(grid, importRates, filter(lambda x: importRates[x] is not None, range(len(grid))))
+        # We create a set of effective "charge" rates associated with not discharging the battery. The
+        # idea is that if we choose not to discharge for a period that's the same as charging the battery
         # with the same amount of power. It's actually better than this because not cycling the battery
-        # means we reduce the battery wear, and don't have the battery efficency overhead. 
-        self.availableHouseGridPoweredRates = list(self.availableImportRates)
- 
+        # means we reduce the battery wear, and don't have the battery efficency overhead.
+        self.availableHouseGridPoweredRates = self.availableImportRates.copy()
+        # The plans and rate pools are shared between copies of the state until one of them needs to 
+        # change them (copy on write). This is the set of the ones this state can change in place.
+        self.owned                          = set()
+
 
-    def updateChangeCost(self, cost):  
+    def updateChangeCost(self, cost):
         self.maxChargeCost = max(self.maxChargeCost, cost)
 
 
-    def sortPlans(self):
-        self.solarChargingPlan.sort(key=lambda x: x[0])
-        self.gridChargingPlan.sort(key=lambda x: x[0])
-        self.houseGridPoweredPlan.sort(key=lambda x: x[0])
-        self.dischargeExportSolarPlan.sort(key=lambda x: x[0])
-        self.dischargeToGridPlan.sort(key=lambda x: x[0])
-        self.eddiSolarPlan.sort(key=lambda x: x[0])
-        self.eddiGridPlan.sort(key=lambda x: x[0])
+    def writable(self, name):
+        # Returns the named plan or rate pool, copying it first if it's shared with another state
+        if name not in self.owned:
+            setattr(self, name, getattr(self, name).copy())
+            self.owned.add(name)
+        return getattr(self, name)
+
+
+    def updatePlan(self, planName, slotIdx, value):
+        # Any changes to the battery plans must be made here, so the plan is copied if it's shared, 
+        # and the battery profile knows which slots it needs to recalculate
+        self.writable(planName)[slotIdx] = value
+        self.batProfile.invalidateFrom(slotIdx)
+
+
+    def removeRate(self, poolName, slotIdx):
+        self.writable(poolName).remove(slotIdx)
+
+
+    def discardRate(self, poolName, slotIdx):
+        if slotIdx in getattr(self, poolName):
+            self.removeRate(poolName, slotIdx)
+
+
+    def planValue(self, plan, slotIdx, valueIdx=0):
+        # Returns the value of a plan for a slot, or zero if the slot isn't part of the plan
+        value = plan[slotIdx]
+        return value[valueIdx] if value is not None else 0.0
 
 
     def setTo(self, fromState):
@@ -69,66 +169,86 @@ class BatteryAllocateState():
         self.availableExportRates           = fromState.availableExportRates
         self.availableImportRates           = fromState.availableImportRates
         self.availableHouseGridPoweredRates = fromState.availableHouseGridPoweredRates
-        self.solarSurplus                   = fromState.solarSurplus
-        self.usageAfterSolar                = fromState.usageAfterSolar
-        self.exportRateData                 = fromState.exportRateData
-        self.importRateData                 = fromState.importRateData
+        # This state takes over anything fromState could change in place, and fromState gets its own 
+        # view of the battery profile, so any later changes to fromState can't leak into this state
+        self.owned                          = fromState.owned
+        fromState.owned                     = set()
+        fromState.batProfile                = fromState.batProfile.copy()
 
 
     def copy(self):
-        newState = copy.copy(self)
-        newState.batProfile                     = list(newState.batProfile)
-        newState.solarChargingPlan              = list(newState.solarChargingPlan)
-        newState.gridChargingPlan               = list(newState.gridChargingPlan)
-        newState.houseGridPoweredPlan           = list(newState.houseGridPoweredPlan)
-        newState.dischargeExportSolarPlan       = list(newState.dischargeExportSolarPlan)
-        newState.dischargeToGridPlan            = list(newState.dischargeToGridPlan)
-        newState.eddiSolarPlan                  = list(newState.eddiSolarPlan)
-        newState.eddiGridPlan                   = list(newState.eddiGridPlan)
-        newState.availableExportRates           = list(newState.availableExportRates)
-        newState.availableImportRates           = list(newState.availableImportRates)
-        newState.availableHouseGridPoweredRates = list(newState.availableHouseGridPoweredRates)
-        newState.solarSurplus                   = list(newState.solarSurplus)
-        newState.usageAfterSolar                = list(newState.usageAfterSolar)
-        newState.exportRateData                 = list(newState.exportRateData)
-        newState.importRateData                 = list(newState.importRateData)
+        # The copy shares everything with the original, with neither of them able to change the plans
+        # or rate pools in place. So the cost of a copy is only what's later changed in it.
+        newState            = copy.copy(self)
+        newState.batProfile = self.batProfile.copy()
+        newState.owned      = set()
+        self.owned          = set()
+        return newState
+
+
+    def changes(self):
+        # The parts of the state that change during planning, everything else is fixed for the planning
+        # run. This is all a discharge trial worker needs to be sent (and send back) for each trial. The
+        # rate pools are reduced to their available slots, as they can be rebuilt from those.
+        return (self.batProfile, self.maxChargeCost,
+                dict(map(lambda x: (x, getattr(self, x)),       BatteryAllocateState.planNames)),
+                dict(map(lambda x: (x, list(getattr(self, x))), BatteryAllocateState.poolNames)))
+
+
+    def withChanges(self, changes):
+        # Returns a copy of this state with the changes (from changes()) applied
+        (batProfile, maxChargeCost, plans, pools) = changes
+        newState               = self.copy()
+        newState.batProfile    = batProfile
+        newState.maxChargeCost = maxChargeCost
+        for (planName, plan) in plans.items():
+            setattr(newState, planName, plan)
+        for (poolName, slotIdxs) in pools.items():
+            setattr(newState, poolName, RatePool(self.grid, getattr(self, poolName).rates, slotIdxs))
+        newState.owned         = set(plans) | set(pools)
         return newState
 
 
     def exportProfile(self):
         # Remote charging power and surplus outside the period we have export rates for
-        # (because we won't have a plan for those periods yet).
-        exportProfile = self.utils.opOnSeries(self.solarSurplus, self.exportRateData,           lambda a, b: a if b else 0)
-        exportProfile = self.utils.opOnSeries(exportProfile,     self.solarChargingPlan,        lambda a, b: a - b)
-        exportProfile = self.utils.opOnSeries(exportProfile,     self.dischargeExportSolarPlan, lambda a, b: a + b)
-        exportProfile = self.utils.opOnSeries(exportProfile,     self.dischargeToGridPlan,      lambda a, b: a + b)
-        exportProfile = self.utils.opOnSeries(exportProfile,     self.eddiSolarPlan,            lambda a, b: a - b)
-        exportCosts   = self.utils.opOnSeries(exportProfile,     self.exportRateData,           lambda a, b: a * b)
-        exportRates   = self.utils.opOnSeries(exportProfile,     self.exportRateData,           lambda a, b: b)
-        exportProfile = self.utils.combineSeries(exportProfile,   exportCosts,                   exportRates)
-        return list(filter(lambda x: x[2], exportProfile))
+        # (because we won't have a plan for those periods yet). The profile is returned as a
+        # ColumnSeries of (energy, cost, rate).
+        exportRates   = numpy.array(self.exportRates, dtype=numpy.float64)
+        exportProfile = numpy.where(exportRates != 0, self.grid.planToColumns(self.solarSurplus), 0)
+        exportProfile = exportProfile - self.grid.planToColumns(self.solarChargingPlan)
+        exportProfile = exportProfile + self.grid.planToColumns(self.dischargeExportSolarPlan)
+        exportProfile = exportProfile + self.grid.planToColumns(self.dischargeToGridPlan)
+        exportProfile = exportProfile - self.grid.planToColumns(self.eddiSolarPlan)
+        return self.grid.withValues(numpy.column_stack([exportProfile, exportProfile * exportRates, exportRates])).nonZero()
 
 
     def importProfile(self):
-        usageWhenGridChanging = self.utils.opOnSeries(self.gridChargingPlan, self.usageAfterSolar, lambda a, b: b)
-        # use the input rate to make sure all time slots are populated. Otherwise we only 
-        # end up producing a series when there's a charge plan
-        importProfile = self.utils.opOnSeries(self.importRateData, self.gridChargingPlan,     lambda a, b: b if a else 0)
-        importProfile = self.utils.opOnSeries(importProfile,       self.houseGridPoweredPlan, lambda a, b: a + b)
-        importProfile = self.utils.opOnSeries(importProfile,       usageWhenGridChanging,     lambda a, b: a + b)
-        importProfile = self.utils.opOnSeries(importProfile,       self.eddiGridPlan,         lambda a, b: a + b)
-        importCosts   = self.utils.opOnSeries(importProfile,       self.importRateData,       lambda a, b: a * b)
-        importRates   = self.utils.opOnSeries(importProfile,       self.importRateData,       lambda a, b: b)
-        importProfile = self.utils.combineSeries(importProfile,     importCosts,               importRates)
-        return list(filter(lambda x: x[2], importProfile))
-
+        # Slots without an import rate have a zero rate, so they're dropped from the profile unless
+        # there's something planned for them
+        importRates           = numpy.array(list(map(lambda x: x if x is not None else 0.0, self.importRates)), dtype=numpy.float64)
+        gridCharging          = self.grid.planToColumns(self.gridChargingPlan)
+        usageWhenGridChanging = numpy.where(list(map(lambda x: x is not None, self.gridChargingPlan)),
+                                            self.grid.planToColumns(self.usageAfterSolar), 0)
+        importProfile         = numpy.where(importRates != 0, gridCharging, 0)
+        importProfile         = importProfile + self.grid.planToColumns(self.houseGridPoweredPlan)
+        importProfile         = importProfile + usageWhenGridChanging
+        importProfile         = importProfile + self.grid.planToColumns(self.eddiGridPlan)
+        return self.grid.withValues(numpy.column_stack([importProfile, importProfile * importRates, importRates])).nonZero()
 
 
 class PowerControlCore():
-    def __init__(self, args, log):
+    # The settings (and battery state) the allocator uses, which are sent to the discharge trial workers
+    trialSettingNames = ["args",                   "maxChargeRate",          "maxDischargeRate",      "batteryGridChargeRate",
+                         "batTargetReservePct",    "batAbsMinReservePct",    "batFullPct",            "batFullPctHysteresis",
+                         "batEfficiency",          "gridExportLimit",        "minBuySelMargin",       "minBuySelNotFullMargin",
+                         "minBuyUseMargin",        "batteryCapacity",        "batteryEnergy",         "maxChargeCost",
+                         "originalImportRates"]
+
+
+    def __init__(self, args, log, logger=None):
         self.log                      = log
         self.args                     = args
-        self.utils                    = PowerUtils(self.log)
+        self.utils                    = PowerUtils(self.log, logger)
         self.maxChargeRate            = float(args['batteryChargeRateLimit'])
         self.maxDischargeRate         = float(args['batteryDischargeRateLimit'])
         self.batteryGridChargeRate    = float(args['batteryGridChargeRate'])
@@ -160,36 +280,88 @@ class PowerControlCore():
         self.dischargeToHousePlan     = []
         self.eddiSolarPlan            = []
         self.eddiGridPlan             = []
+        self.decisions                = DecisionTable([], [], [], [], [], [], [], [])
         self.planUpdateTime           = None
+        self.renderedPlans            = {}
+        # Per stage timings for the last few planning runs, these are only recorded if there's an entity
+        # to publish them to
+        self.stageTimer               = StageTimer(bool(args.get('diagnosticsEntity')), int(args.get('diagnosticsWindow', 48)))
+        self.planCache                = PlanCache(int(args.get('planCacheSize', 4)), bool(args.get('planCacheReslice', False)))
+        self.snapshotWriter           = SnapshotWriter(self.stateSavesPath, int(args.get('stateSaveDays', 14)), lambda x: self.log(x))
+        # The worker pool for the discharge trials (with the args it was started with), it's started when
+        # it's first needed
+        self.trialPool                = None
+        self.trialRunKey              = 0
+
+
+    def __getstate__(self):
+        # We can't serialise the logger, so leave it and the utils (which holds a reference to it) out 
+        # of the serialised state. Whoever loads the state needs to restore them.
+        # The rendered plans also hold a reference to the utils, and can be regenerated from the plans.
+        state                  = dict(self.__dict__)
+        state['log']           = None
+        state['utils']         = None
+        state['renderedPlans'] = {}
+        state['trialPool']     = None
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # States saved before the stage timings were added won't have a timer
+        if 'stageTimer' not in state:
+            self.stageTimer = StageTimer()
+        if 'renderedPlans' not in state:
+            self.renderedPlans = {}
+        if 'planCache' not in state:
+            self.planCache = PlanCache(int(self.args.get('planCacheSize', 4)), bool(self.args.get('planCacheReslice', False)))
+        if 'trialPool' not in state:
+            self.trialPool   = None
+            self.trialRunKey = 0
+        if 'decisions' not in state:
+            self.decisions = DecisionTable([], [], [], [], [], [], [], [])
+        if 'snapshotWriter' not in state:
+            self.snapshotWriter = SnapshotWriter(self.stateSavesPath, int(self.args.get('stateSaveDays', 14)))
+        self.snapshotWriter.log = lambda x: self.log(x)
+
+
+    def printSeries(self, series, title, mergeable=False):
+        with self.stageTimer.stage("printSeries"):
+            self.utils.printSeries(series, title, mergeable=mergeable)
+
+
+    def snapshotInputs(self):
+        # The inputs the planner needs to replay a planning run, everything else is derived from them
+        inputNames = ["args",                "planUpdateTime",      "exportRateData",      "importRateData",
+                      "solarData",           "usageData",           "eddiData",            "savingSession",
+                      "tariffOverrideType",  "tariffOverrideStart", "tariffOverrideEnd",   "tariffOverridePrice",
+                      "batteryCapacity",     "batteryEnergy",       "maxChargeCost",       "gasRate"]
+        return dict(map(lambda x: (x, getattr(self, x)), filter(lambda x: hasattr(self, x), inputNames)))
 
 
     def save(self, now):
         self.planUpdateTime = now
-        # Save the state in case we needed for future debug
-        slotMidTime = self.planUpdateTime + timedelta(minutes=15)
-        fileName    = "{0}/{1:02.0f}_{2:02.0f}.pickle".format(self.stateSavesPath, slotMidTime.hour, 
-                                                              30 * math.floor(float(slotMidTime.minute)/30))
-        # We can't serialise the logger, so nul out the loger on self so we can serialise 
-        # safely, then restore it afterwards
-        log        = self.log
-        self.log   = None
-        utils      = self.utils
-        self.utils = None
-        try:
-            with open(fileName, 'wb') as handle:
-                pickle.dump(self, handle, protocol=pickle.HIGHEST_PROTOCOL)
-        except Exception as error:
-            log("Error saving state: " + str(error))
-        self.log   = log
-        self.utils = utils
+        # Save a snapshot of the inputs in case we need to replay the plan for future debug
+        return self.snapshotWriter.save(now, self.snapshotInputs())
+
 
+    def fromSnapshot(inputs, log):
+        obj = PowerControlCore(inputs["args"], log)
+        for (name, value) in inputs.items():
+            setattr(obj, name, value)
+        return obj
 
-    def load(fileName, log):
+
+    def load(fileName, log, index=-1):
+        # Loads a pickled state, or a snapshot from a snapshot file (by default the last one in the file)
         obj = None
         try:
-            with open(fileName, 'rb') as handle:
-                obj     = pickle.load(handle)
-                obj.log = log
+            if fileName.endswith(".snapshots"):
+                obj = PowerControlCore.fromSnapshot(readSnapshot(fileName, index)[1], log)
+            else:
+                with open(fileName, 'rb') as handle:
+                    obj     = pickle.load(handle)
+                    obj.log = log
         except Exception as error:
             print("Error loading state: " + str(error))
         obj.utils = PowerUtils(obj.log)
@@ -221,26 +393,27 @@ class PowerControlCore():
 
 
     def extendSeries(self, inputSeries, extendBy = timedelta(), extendTo = None):                                      
-        outputSeries = list(inputSeries)
+        # Extends the series by repeating the samples from the day before, see ColumnSeries.extendDaily
+        outputSeries = IndexedSeries(inputSeries)
         if outputSeries:
             endTime = (extendTo if extendTo else outputSeries[-1][1]) + extendBy
-            while outputSeries[-1][1] < endTime:
-                # Get the details of the last slot
-                periodStartTime = outputSeries[-1][0] 
-                periodEndTime   = outputSeries[-1][1] 
-                periodDuration  = periodEndTime - periodStartTime
-                # compute the details of the next slot
-                periodStartTime = periodEndTime 
-                periodEndTime   = periodEndTime + periodDuration
-                power           = self.utils.powerForPeriod(outputSeries, 
-                                                            periodStartTime - timedelta(hours=24), 
-                                                            periodEndTime   - timedelta(hours=24)) 
-                outputSeries.append((periodStartTime, periodEndTime, power))
+            if outputSeries[-1][1] < endTime:
+                newSamples = ColumnSeries.fromSeries(outputSeries, 1).extendDaily(endTime)
+                outputSeries.extend(map(lambda x: (x[0], x[1], x[2][0]), zip(newSamples.startTimes, newSamples.endTimes, newSamples.values.tolist())))
         return outputSeries
         
         
+    @timedRun(lambda self: self.stageTimer)
     def mergeAndProcessData(self, now):
         self.log("Updating schedule")        
+        # If the inputs haven't changed since a previous run we may be able to reuse its plan
+        with self.stageTimer.stage("planCache"):
+            fingerprint                  = PlanCache.fingerprint(self.planInputs())
+            slotStart                    = self.planSlotStart(now)
+            (cacheResult, cachedOutputs) = self.planCache.lookup(fingerprint, slotStart)
+        if cacheResult:
+            self.restorePlan(cachedOutputs, now, cacheResult == "reslice")
+            return
         # Remove rates that are in the past
         exportRateData = self.exportRateData
         importRateData = self.importRateData
@@ -249,16 +422,16 @@ class PowerControlCore():
             endTime        = (exportRateData[-1][1] + self.futureTimeWindow).replace(hour=0, minute=0, second=0, microsecond=0)
             exportRateData = self.extendSeries(exportRateData, timedelta(), endTime)
             importRateData = self.extendSeries(importRateData, timedelta(), endTime)
-        exportRateData = list(filter(lambda x: x[1] >= now, exportRateData))
-        importRateData = list(filter(lambda x: x[1] >= now, importRateData))
+        exportRateData = IndexedSeries(filter(lambda x: x[1] >= now, exportRateData))
+        importRateData = IndexedSeries(filter(lambda x: x[1] >= now, importRateData))
         # remove any import rate data that is outside the time range for the export rates and vice 
         # versa. This means we can safely evelauate everything together
         exportRateEndTime           = max(exportRateData, key=lambda x: x[1])[1]
         importRateEndTime           = max(importRateData, key=lambda x: x[1])[1]
-        exportRateData              = list(filter(lambda x: x[1] <= importRateEndTime, exportRateData))
-        importRateData              = list(filter(lambda x: x[1] <= exportRateEndTime, importRateData))
-        self.originalExportRateData = list(exportRateData)
-        self.originalImportRateData = list(importRateData)
+        exportRateData              = IndexedSeries(filter(lambda x: x[1] <= importRateEndTime, exportRateData))
+        importRateData              = IndexedSeries(filter(lambda x: x[1] <= exportRateEndTime, importRateData))
+        self.originalExportRateData = IndexedSeries(exportRateData)
+        self.originalImportRateData = IndexedSeries(importRateData)
         # apply saving sessions
         importRatesOverridden = False
         exportRatesOverridden = False
@@ -288,106 +461,150 @@ class PowerControlCore():
                 if self.tariffOverrideStart <= rate[0] and rate[1] <= self.tariffOverrideEnd:
                     importRatesOverridden = True
                     importRateData[index] = (rate[0], rate[1], self.tariffOverridePrice)
+        # The rates are fixed from here on. Everything else is planned on a common grid of time slots
+        # (the export rate slots), so the rates become lists indexed by slot number.
+        grid                     = SlotGrid(exportRateData)
+        exportRates              = list(map(lambda x: x[2], exportRateData))
+        importRates              = grid.slotValues(importRateData)
+        self.originalImportRates = grid.slotValues(self.originalImportRateData)
         # Print out any overridden rates
         if exportRatesOverridden:
-            self.utils.printSeries(exportRateData, "Overridden export rate")
+            self.printSeries(exportRateData, "Overridden export rate")
         if importRatesOverridden:
-            self.utils.printSeries(importRateData, "Overridden import rate")
-
-        # Calculate the solar surplus after house load, we base this on the usage time 
-        # series dates as that's typically a finer granularity than the solar forecast. Similarly 
-        # we work out the house usage after any forecast solar. The solar forecast has 3 values in 
-        # the following order, a 50th percentile followed by a low and high estimate of the power 
-        # for each period. We carry this through to the generated series so we can more accuratly 
-        # plan the battery charge / house usage.
-        usageData       = self.extendSeries(self.usageData, timedelta(), exportRateData[-1][1])
-        usageData       = list(filter(lambda x: x[0] >= exportRateData[0][0] and x[1] <= exportRateData[-1][1], usageData))
-        solarSurplus    = self.utils.combineSeries(self.utils.opOnSeries(usageData,    self.solarData, lambda a, b: max(0, b-a)), 
-                                                   self.utils.opOnSeries(usageData,    self.solarData, lambda a, b: max(0, b-a), 0, 1), 
-                                                   self.utils.opOnSeries(usageData,    self.solarData, lambda a, b: max(0, b-a), 0, 2))
-        solarUsage      = self.utils.combineSeries(self.utils.opOnSeries(solarSurplus, self.solarData, lambda a, b: b-a),
-                                                   self.utils.opOnSeries(solarSurplus, self.solarData, lambda a, b: b-a, 1, 1),
-                                                   self.utils.opOnSeries(solarSurplus, self.solarData, lambda a, b: b-a, 2, 2))
-        usageAfterSolar = self.utils.combineSeries(self.utils.opOnSeries(usageData,    self.solarData, lambda a, b: max(0, a-b)),
-                                                   self.utils.opOnSeries(usageData,    self.solarData, lambda a, b: max(0, a-b), 0, 1),
-                                                   self.utils.opOnSeries(usageData,    self.solarData, lambda a, b: max(0, a-b), 0, 2))
-        
+            self.printSeries(importRateData, "Overridden import rate")
+
+        # Calculate the solar surplus after house load, the usage and solar forecast are both resampled
+        # onto the slot grid first. Similarly we work out the house usage after any forecast solar. The
+        # solar forecast has 3 values in the following order, a 50th percentile followed by a low and high
+        # estimate of the power for each period. We carry this through to the generated series so we can
+        # more accuratly plan the battery charge / house usage.
+        with self.stageTimer.stage("alignment"):
+            usageData       = self.extendSeries(self.usageData, timedelta(), exportRateData[-1][1])
+            usageData       = ColumnSeries.fromSeries(filter(lambda x: x[0] >= exportRateData[0][0] and x[1] <= exportRateData[-1][1], usageData), 1)
+            usageForSlots   = usageData.energyFor(grid)
+            solarForSlots   = ColumnSeries.fromSeries(self.solarData, 3).energyFor(grid)
+            solarSurplus    = numpy.maximum(0, solarForSlots - usageForSlots)
+            solarUsage      = solarForSlots - solarSurplus
+            usageAfterSolar = numpy.maximum(0, usageForSlots - solarForSlots)
+            solarSurplus    = list(map(tuple, solarSurplus.tolist()))
+            solarUsage      = list(map(tuple, solarUsage.tolist()))
+            usageAfterSolar = list(map(tuple, usageAfterSolar.tolist()))
+
         # calculate the charge plan, and work out what's left afterwards
-        batPlans                 = self.calculateChargePlan(exportRateData, importRateData, solarUsage, solarSurplus, usageAfterSolar, now, extendExportPlanTo)
-        self.utils.printSeries(batPlans.exportProfile(), "Export profile - pre eddi")
-        postBatteryChargeSurplus = self.utils.opOnSeries(solarSurplus, batPlans.solarChargingPlan, lambda a, b: a-b)
-        # Calculate the times when we want the battery in standby mode. IE when there's solar surplus 
+        batPlans                 = self.calculateChargePlan(grid, exportRates, importRates, solarUsage, solarSurplus,
+                                                            usageAfterSolar, now, extendExportPlanTo)
+        self.printSeries(lambda: batPlans.exportProfile().toSeries(), "Export profile - pre eddi")
+        postBatteryChargeSurplus = list(map(lambda x: solarSurplus[x][0] - batPlans.planValue(batPlans.solarChargingPlan, x), range(len(grid))))
+        # Calculate the times when we want the battery in standby mode. IE when there's solar surplus
         # but we don't want to charge or discharge.
-        standbyPlan = []
-        for rate in exportRateData:
-            curSolarSurplus =  self.utils.powerForPeriod(solarSurplus,                      rate[0], rate[1])
-            isPlanned       = (self.utils.powerForPeriod(batPlans.solarChargingPlan,        rate[0], rate[1]) > 0 or
-                               self.utils.powerForPeriod(batPlans.gridChargingPlan,         rate[0], rate[1]) > 0 or
-                               self.utils.powerForPeriod(batPlans.houseGridPoweredPlan,     rate[0], rate[1]) > 0 or
-                               self.utils.powerForPeriod(batPlans.dischargeExportSolarPlan, rate[0], rate[1]) > 0 or
-                               self.utils.powerForPeriod(batPlans.dischargeToGridPlan,      rate[0], rate[1]) > 0)
-            if (curSolarSurplus > 0) and not isPlanned: 
-                standbyPlan.append((rate[0], rate[1], curSolarSurplus))
+        curSolarSurplus = grid.planToColumns(solarSurplus)
+        isPlanned       = ((grid.planToColumns(batPlans.solarChargingPlan)        > 0) |
+                           (grid.planToColumns(batPlans.gridChargingPlan)         > 0) |
+                           (grid.planToColumns(batPlans.houseGridPoweredPlan)     > 0) |
+                           (grid.planToColumns(batPlans.dischargeExportSolarPlan) > 0) |
+                           (grid.planToColumns(batPlans.dischargeToGridPlan)      > 0))
+        standbyPlan     = list(map(lambda x: (x[1],) if x[0] else None,
+                                   zip((curSolarSurplus > 0) & ~isPlanned, curSolarSurplus.tolist())))
         # Create a background plan for info only that shows when we're just powering the house from the battery.
-        usageForRateSlotsOnly = self.utils.opOnSeries(exportRateData,        self.usageData,                    lambda a, b: b)
-        dischargeToHousePlan  = self.utils.opOnSeries(usageForRateSlotsOnly, batPlans.solarChargingPlan,        lambda a, b: 0 if b else a)
-        dischargeToHousePlan  = self.utils.opOnSeries(dischargeToHousePlan,  batPlans.gridChargingPlan,         lambda a, b: 0 if b else a)
-        dischargeToHousePlan  = self.utils.opOnSeries(dischargeToHousePlan,  batPlans.houseGridPoweredPlan,     lambda a, b: 0 if b else a)
-        dischargeToHousePlan  = self.utils.opOnSeries(dischargeToHousePlan,  standbyPlan,                       lambda a, b: 0 if b else a)
-        dischargeToHousePlan  = self.utils.opOnSeries(dischargeToHousePlan,  batPlans.dischargeExportSolarPlan, lambda a, b: 0 if b else a)
-        dischargeToHousePlan  = self.utils.opOnSeries(dischargeToHousePlan,  batPlans.dischargeToGridPlan,      lambda a, b: 0 if b else a)
-        dischargeToHousePlan  = list(filter(lambda x: x[2], dischargeToHousePlan))
+        usageForRateSlotsOnly = ColumnSeries.fromSeries(self.usageData, 1).energyFor(grid)[:, 0]
+        isPlanned             = ((grid.planToColumns(batPlans.solarChargingPlan)        != 0) |
+                                 (grid.planToColumns(batPlans.gridChargingPlan)         != 0) |
+                                 (grid.planToColumns(batPlans.houseGridPoweredPlan)     != 0) |
+                                 (grid.planToColumns(standbyPlan)                       != 0) |
+                                 (grid.planToColumns(batPlans.dischargeExportSolarPlan) != 0) |
+                                 (grid.planToColumns(batPlans.dischargeToGridPlan)      != 0))
+        dischargeToHousePlan  = list(map(lambda x: (x,) if x != 0 else None,
+                                         numpy.where(isPlanned, 0, usageForRateSlotsOnly).tolist()))
 
         # Calculate the eddi plan based on any remaining surplus
-        self.calculateEddiPlan(exportRateData, importRateData, postBatteryChargeSurplus, batPlans, now)
+        with self.stageTimer.stage("eddiPlan"):
+            self.calculateEddiPlan(grid, exportRates, importRates, postBatteryChargeSurplus, batPlans, now)
         exportProfile  = batPlans.exportProfile()
         importProfile  = batPlans.importProfile()
-        profileReducer = lambda a, b: (None, None, a[2]+b[2], a[3]+b[3], None)
-        initialVal     = (None, None, 0, 0, None)
-        exportSummary  = functools.reduce(profileReducer, exportProfile, initialVal)
-        importSummary  = functools.reduce(profileReducer, importProfile, initialVal)
+        self.updateProfiles(exportProfile, importProfile, exportRateData, importRateData)
+        self.updateTariff(now)
+        # The plans are published as series of (start, end, value...) tuples, so convert them back from
+        # the slot grid
+        self.solarChargingPlan        = grid.planToSeries(batPlans.solarChargingPlan)
+        self.gridChargingPlan         = grid.planToSeries(batPlans.gridChargingPlan)
+        self.houseGridPoweredPlan     = grid.planToSeries(batPlans.houseGridPoweredPlan)
+        self.standbyPlan              = grid.planToSeries(standbyPlan)
+        self.dischargeExportSolarPlan = grid.planToSeries(batPlans.dischargeExportSolarPlan)
+        self.dischargeToGridPlan      = grid.planToSeries(batPlans.dischargeToGridPlan)
+        self.dischargeToHousePlan     = grid.planToSeries(dischargeToHousePlan)
+        self.maxChargeCost            = batPlans.maxChargeCost
+        self.eddiSolarPlan            = grid.planToSeries(batPlans.eddiSolarPlan)
+        self.eddiGridPlan             = grid.planToSeries(batPlans.eddiGridPlan)
+        self.decisions                = DecisionTable.fromPlans(grid, {"solarChargingPlan":        batPlans.solarChargingPlan,
+                                                                       "gridChargingPlan":         batPlans.gridChargingPlan,
+                                                                       "houseGridPoweredPlan":     batPlans.houseGridPoweredPlan,
+                                                                       "standbyPlan":              standbyPlan,
+                                                                       "dischargeExportSolarPlan": batPlans.dischargeExportSolarPlan,
+                                                                       "dischargeToGridPlan":      batPlans.dischargeToGridPlan,
+                                                                       "dischargeToHousePlan":     dischargeToHousePlan,
+                                                                       "eddiSolarPlan":            batPlans.eddiSolarPlan,
+                                                                       "eddiGridPlan":             batPlans.eddiGridPlan},
+                                                                  grid.slotValues(self.originalExportRateData), self.originalImportRates, 
+                                                                  self.batEfficiency)
+        self.planUpdateTime           = now
+        self.renderPlans()
+        self.planCache.store(fingerprint, slotStart, exportRateData[-1][1], 
+                             self.planOutputs(batPlans, exportRateData, importRateData))
+
+
+    def updateProfiles(self, exportProfile, importProfile, exportRateData, importRateData):
+        # Generates the grid import / export summary and the profiles and rates we publish from the 
+        # import / export profiles (ColumnSeries of energy, cost and rate) and the rate data
+        exportSummary  = exportProfile.total()
+        importSummary  = importProfile.total()
+        exportSummary  = (None, None, float(exportSummary[0]), float(exportSummary[1]), None)
+        importSummary  = (None, None, float(importSummary[0]), float(importSummary[1]), None)
         netSummary     = (None, None, importSummary[2]-exportSummary[2], importSummary[3]-exportSummary[3], None)
+        exportProfile  = exportProfile.toSeries()
+        importProfile  = importProfile.toSeries()
         def summaryFormatter(typeStr, data):
             rate        = 100*data[3]/data[2] if data[2] != 0 else 0
             summaryStr  = "{3} summary: {0:.2f} kWh @ £{1:.2f} = {2:.2f}p/kWh".format(data[2], data[3], rate, typeStr)
-            summaryDict = { "energy": data[2], 
-                            "cost":   data[3], 
-                            "rate":   rate } 
+            summaryDict = { "energy": data[2],
+                            "cost":   data[3],
+                            "rate":   rate }
             return (summaryStr, summaryDict)
-        
+
         (exportStr, exportDict) = summaryFormatter("Export", exportSummary)
         (importStr, importDict) = summaryFormatter("Import", importSummary)
         (netStr,    netDict)    = summaryFormatter("Net",    netSummary)
-        self.utils.printSeries(exportProfile, "Export profile - post eddi")
+        self.printSeries(exportProfile, "Export profile - post eddi")
         self.log(exportStr)
-        self.utils.printSeries(importProfile, "Import profile - post eddi")
+        self.printSeries(importProfile, "Import profile - post eddi")
         self.log(importStr)
         self.log(netStr)
         self.gridSummary       = {"import": importDict,
                                   "export": exportDict,
                                   "net":    netDict}
-        profileIsoConvert      = lambda a: {"start":  a[0].isoformat(), 
-                                            "end":    a[1].isoformat(), 
-                                            "energy": a[2], 
+        profileIsoConvert      = lambda a: {"start":  a[0].isoformat(),
+                                            "end":    a[1].isoformat(),
+                                            "energy": a[2],
                                             "cost":   a[3],
                                             "rate":   a[4]}
         self.exportProfileISO  = list(map(profileIsoConvert, exportProfile))
         self.importProfileISO  = list(map(profileIsoConvert, importProfile))
-        rateIsoConvert         = lambda a: {"start":  a[0].isoformat(), 
-                                            "end":    a[1].isoformat(), 
+        rateIsoConvert         = lambda a: {"start":  a[0].isoformat(),
+                                            "end":    a[1].isoformat(),
                                             "rate":   a[2]}
         self.exportRateDataISO = list(map(rateIsoConvert, exportRateData))
         self.importRateDataISO = list(map(rateIsoConvert, importRateData))
-        
+
+
+    def updateTariff(self, now):
         # Create a fake tariff with peak time covering the discharge plan
-        # Normally we wouldn't have the solarChargePlan as one of the peak periods. There is some deep 
-        # twisted logic to this. Firstly it doesn't actually matter as we set the powerwall to Self-powered 
+        # Normally we wouldn't have the solarChargePlan as one of the peak periods. There is some deep
+        # twisted logic to this. Firstly it doesn't actually matter as we set the powerwall to Self-powered
         # when we want to charge from solar, which doesn't use the tariff plan. The powerwall sometimes
-        # takes awhile to respond to tariff updates. This means that if the plan changes from change to 
+        # takes awhile to respond to tariff updates. This means that if the plan changes from change to
         # standby then we don't want this to impact the tariff plan we need (which could take awhile to
-        # update). To get round this we pre-emptivly set charging periods to peak in the tariff plan in 
+        # update). To get round this we pre-emptivly set charging periods to peak in the tariff plan in
         # case we need to swap. We also extend the peak period into the past a bit. This prevents any
-        # strange behaviour given we have to have to change the battery settings just before the start of 
+        # strange behaviour given we have to have to change the battery settings just before the start of
         # each hour.
         midnight      = now.replace(hour=0, minute=0, second=0, microsecond=0)
         hourStart     = (now + timedelta(minutes=15)).replace(minute=0, second=0, microsecond=0)
@@ -395,106 +612,159 @@ class PowerControlCore():
         peakPeriods   = self.seriesToTariff(peakPlan, midnight)
         self.defPrice = "0.10 0.10 OFF_PEAK"
         self.pwTariff = {"0.90 0.90 ON_PEAK": peakPeriods}
-        self.utils.printSeries(batPlans.solarChargingPlan,        "Solar charging plan",         mergeable=True)
-        self.utils.printSeries(batPlans.gridChargingPlan,         "Grid charging plan",          mergeable=True)
-        self.utils.printSeries(batPlans.houseGridPoweredPlan,     "House grid powered plan",     mergeable=True)
-        self.utils.printSeries(standbyPlan,                       "Standby plan",                mergeable=True)
-        self.utils.printSeries(batPlans.dischargeExportSolarPlan, "Discharge export solar plan", mergeable=True)
-        self.utils.printSeries(batPlans.dischargeToGridPlan,      "Discharge to grid plan",      mergeable=True)
-        self.utils.printSeries(dischargeToHousePlan,              "Discharging to house plan",   mergeable=True)
-        self.utils.printSeries(batPlans.eddiSolarPlan,            "Eddi solar plan",             mergeable=True)
-        self.utils.printSeries(batPlans.eddiGridPlan,             "Eddi grid plan",              mergeable=True)
-        self.solarChargingPlan        = batPlans.solarChargingPlan
-        self.gridChargingPlan         = batPlans.gridChargingPlan
-        self.houseGridPoweredPlan     = batPlans.houseGridPoweredPlan
-        self.standbyPlan              = standbyPlan
-        self.dischargeExportSolarPlan = batPlans.dischargeExportSolarPlan
-        self.dischargeToGridPlan      = batPlans.dischargeToGridPlan
-        self.dischargeToHousePlan     = dischargeToHousePlan
-        self.maxChargeCost            = batPlans.maxChargeCost
-        self.eddiSolarPlan            = batPlans.eddiSolarPlan
-        self.eddiGridPlan             = batPlans.eddiGridPlan
-        self.planUpdateTime           = now
 
 
-    def calculateEddiPlan(self, exportRateData, importRateData, solarSurplus, batPlans, now):
+    def renderPlans(self):
+        # The merged plans are rendered once, the first time they're needed, and shared between the log 
+        # and the entity attributes
+        planTitles         = [("solarChargingPlan",        "Solar charging plan"),
+                              ("gridChargingPlan",         "Grid charging plan"),
+                              ("houseGridPoweredPlan",     "House grid powered plan"),
+                              ("standbyPlan",              "Standby plan"),
+                              ("dischargeExportSolarPlan", "Discharge export solar plan"),
+                              ("dischargeToGridPlan",      "Discharge to grid plan"),
+                              ("dischargeToHousePlan",     "Discharging to house plan"),
+                              ("eddiSolarPlan",            "Eddi solar plan"),
+                              ("eddiGridPlan",             "Eddi grid plan")]
+        self.renderedPlans = {}
+        for (planName, title) in planTitles:
+            self.renderedPlans[planName] = RenderedSeries(self.utils, getattr(self, planName), mergeable=True)
+            self.printSeries(self.renderedPlans[planName], title)
+
+
+    def planInputs(self):
+        # Everything the plan depends on other than the time. The series are converted to plain lists so 
+        # any index that's been built for them doesn't change the fingerprint.
+        return (list(self.exportRateData), list(self.importRateData), list(self.solarData), list(self.usageData), 
+                list(self.eddiData), self.savingSession, self.tariffOverrideType, self.tariffOverrideStart, 
+                self.tariffOverrideEnd, self.tariffOverridePrice, self.batteryCapacity, self.batteryEnergy, 
+                self.maxChargeCost, self.gasRate, self.args)
+
+
+    def planSlotStart(self, now):
+        # The start of the rate slot we're in, so runs at different times in the same slot can share a plan
+        slot = next(filter(lambda x: x[0] <= now and now < x[1], self.exportRateData), None)
+        return slot[0] if slot else now
+
+
+    def planOutputs(self, batPlans, exportRateData, importRateData):
+        # The outputs of a planning run, as stored in the plan cache. The battery plans and rates are also
+        # kept, so the profiles and grid summary can be recalculated for the slots that are left if the plan
+        # is re-sliced.
+        outputNames = ["originalExportRateData",   "originalImportRateData",   "originalImportRates",
+                       "maxChargeCost",            "solarChargingPlan",        "gridChargingPlan",
+                       "houseGridPoweredPlan",     "standbyPlan",              "dischargeExportSolarPlan",
+                       "dischargeToGridPlan",      "dischargeToHousePlan",     "eddiSolarPlan",
+                       "eddiGridPlan",             "gridSummary",              "exportProfileISO",
+                       "importProfileISO",         "exportRateDataISO",        "importRateDataISO",
+                       "renderedPlans",            "decisions"]
+        outputs     = dict(map(lambda x: (x, getattr(self, x)), outputNames))
+        outputs["profiles"] = (batPlans, exportRateData, importRateData)
+        return outputs
+
+
+    def restorePlan(self, outputs, now, reslice):
+        self.log("Reusing the plan from a previous run{0}, cache stats {1}".format(", without the slots that have passed" if reslice else "",
+                                                                                   self.planCache.summary()))
+        (batPlans, exportRateData, importRateData) = outputs["profiles"]
+        self.__dict__.update(filter(lambda x: x[0] != "profiles", outputs.items()))
+        if reslice:
+            # Drop everything that's in the past, the same as the rates are filtered for a full run. The rest
+            # of the plan is kept as it is, including the battery levels it expects, even if the battery
+            # didn't follow the plan in the slots that have passed.
+            passedSlots                 = sum(map(lambda x: x[1] < now, self.originalExportRateData))
+            self.originalExportRateData = IndexedSeries(filter(lambda x: x[1] >= now, self.originalExportRateData))
+            self.originalImportRateData = IndexedSeries(filter(lambda x: x[1] >= now, self.originalImportRateData))
+            self.originalImportRates    = self.originalImportRates[passedSlots:]
+            for planName in list(self.renderedPlans):
+                setattr(self, planName, IndexedSeries(filter(lambda x: x[1] >= now, getattr(self, planName))))
+            self.decisions              = self.decisions.after(now)
+            # The profiles and grid summary are recalculated from the plans and rates for the slots that are left
+            exportProfile               = batPlans.exportProfile()
+            importProfile               = batPlans.importProfile()
+            self.updateProfiles(exportProfile.mask(exportProfile.ends >= now.timestamp()), 
+                                importProfile.mask(importProfile.ends >= now.timestamp()),
+                                IndexedSeries(filter(lambda x: x[1] >= now, exportRateData)),
+                                IndexedSeries(filter(lambda x: x[1] >= now, importRateData)))
+            self.renderPlans()
+        self.updateTariff(now)
+        self.planUpdateTime = now
+
+
+    def calculateEddiPlan(self, grid, exportRates, importRates, solarSurplus, batPlans, now):
         # Calculate the target rate for the eddi
-        eddiSolarPlan  = []
-        eddiGridPlan   = []
+        eddiSolarPlan  = grid.emptyPlan()
+        eddiGridPlan   = grid.emptyPlan()
         eddiTargetRate = self.gasRate / self.gasEfficiency
-        
-        # Calculate the start time for the eddi plan. This has to be in the past so we calculate 
-        # how much energy we've already sent to the eddi
-        eddiDayStart = now.replace(hour=9, minute=0, second=0, microsecond=0)
-        if eddiDayStart >= now:
-            eddiDayStart = eddiDayStart - timedelta(days=1)
-        eddiEnergyForSlot = self.utils.powerForPeriod(self.eddiData, eddiDayStart, now)
+
+        # Calculate the start time for the eddi plan. This has to be in the past so we calculate
+        # how much energy we've already sent to the eddi. The plan works in epochs, the history only
+        # needs the start as a time.
+        nowEpoch     = int(now.timestamp())
+        eddiDayStart = SlotGrid.dayStartEpoch(now) + 9 * 60 * 60
+        if eddiDayStart >= nowEpoch:
+            eddiDayStart = eddiDayStart - secondsPerDay
+        eddiEnergyForSlot = self.utils.powerForPeriod(self.utils.indexSeries(self.eddiData), 
+                                                      ColumnSeries.localTime(eddiDayStart, now.tzinfo), now)
         # Now create a plan
-        slotStartTime       = eddiDayStart
-        slotEndTime         = eddiDayStart + timedelta(days=1)
-        planEndTime         = exportRateData[-1][1]
+        slotStartEpoch      = eddiDayStart
+        planEndEpoch        = grid.endEpochs[-1]
         eddiPowerReqForSlot = []
-        while slotStartTime < planEndTime:
-            eddiPowerReqForSlot.append((slotStartTime, slotEndTime, self.eddiTargetPower - eddiEnergyForSlot))
-            # Rotate the vars for the next slot, inc zeroing the energy as what the eddi has 
-            # done so far only applies to the first slot in the plan.
-            slotStartTime     = slotEndTime
-            slotEndTime       = slotEndTime + timedelta(days=1)
+        while slotStartEpoch < planEndEpoch:
+            eddiPowerReqForSlot.append((slotStartEpoch, slotStartEpoch + secondsPerDay, self.eddiTargetPower - eddiEnergyForSlot))
+            # Move on to the next slot, inc zeroing the energy as what the eddi has done so far only 
+            # applies to the first slot in the plan.
+            slotStartEpoch    = slotStartEpoch + secondsPerDay
             eddiEnergyForSlot = 0
-        
-        # For any slots where we're planning to run off the grid we also have the opertunity to 
-        # eddi off the grid without draining the battery. Calculate the available slots that 
-        # could be used.
-        gridUseRates      =                self.utils.opOnSeries(batPlans.houseGridPoweredPlan, importRateData, lambda a, b: b)
-        gridUseRates      = gridUseRates + self.utils.opOnSeries(batPlans.gridChargingPlan,     importRateData, lambda a, b: b)
-        gridUseRates      = list(map(lambda a: (a[0], a[1], a[2], False), gridUseRates))
-        # combine with the export rates for solar and sort based on price        
-        solarSurplus      = list(filter(lambda x: x[2], solarSurplus))
-        solarSurplusRates = self.utils.opOnSeries(solarSurplus, exportRateData, lambda a, b: b)
-        solarSurplusRates = list(map(lambda a: (a[0], a[1], a[2], True), solarSurplusRates))
-        ratesCheapFirst   = sorted(gridUseRates + solarSurplusRates, key=lambda x: x[2])
-        # Create the eddi plan by looking for rates that are below the threshold where gas 
+
+        # For any slots where we're planning to run off the grid we also have the opertunity to
+        # eddi off the grid without draining the battery. Calculate the available slots that
+        # could be used. Each rate is a tuple of (slot index, rate, is solar).
+        gridUseRates      = (list(map(lambda x: (x, importRates[x], False), filter(lambda x: batPlans.houseGridPoweredPlan[x] is not None, range(len(grid))))) +
+                             list(map(lambda x: (x, importRates[x], False), filter(lambda x: batPlans.gridChargingPlan[x]     is not None, range(len(grid))))))
+        # combine with the export rates for solar and sort based on price
+        solarSurplusRates = list(map(lambda x: (x, exportRates[x], True), filter(lambda x: solarSurplus[x], range(len(grid)))))
+        ratesCheapFirst   = sorted(gridUseRates + solarSurplusRates, key=lambda x: x[1])
+        # Create the eddi plan by looking for rates that are below the threshold where gas
         # becomes a better option
-        for rate in ratesCheapFirst:
-            if rate[2] > eddiTargetRate:
+        for (slotIdx, rate, isSolar) in ratesCheapFirst:
+            if rate > eddiTargetRate:
                 break
             # find the eddi slot that we're trying to fill for the rate time period
-            foundSlot = list(filter(lambda slot: slot[1][0] <= rate[0] and rate[1] <= slot[1][1], enumerate(eddiPowerReqForSlot)))
+            startEpoch = grid.startEpochs[slotIdx]
+            endEpoch   = grid.endEpochs[slotIdx]
+            foundSlot  = list(filter(lambda slot: slot[1][0] <= startEpoch and endEpoch <= slot[1][1], enumerate(eddiPowerReqForSlot)))
             if not foundSlot:
-                continue 
+                continue
             powerReqSlotIdx  = foundSlot[0][0]
             powerReqSlotInfo = foundSlot[0][1]
             # Calculate the amount of power available
-            maxPower = ((rate[1] - rate[0]).total_seconds() / (60 * 60)) * self.eddiPowerLimit
+            maxPower = grid.slotHours[slotIdx] * self.eddiPowerLimit
             # is this a solar or grid slot
-            if rate[3]:
-                power      = self.utils.powerForPeriod(solarSurplus, rate[0], rate[1])
+            if isSolar:
+                power      = solarSurplus[slotIdx]
                 powerTaken = max(min(power, maxPower), 0)
-                # We still plan to use the eddi even if the forcast says there won't be a 
-                # surplus. This is in case the forcast is wrong, or there are dips in usage 
+                # We still plan to use the eddi even if the forcast says there won't be a
+                # surplus. This is in case the forcast is wrong, or there are dips in usage
                 # or peaks in generation that lead to short term surpluses
-                eddiSolarPlan.append((rate[0], rate[1], powerTaken))
+                eddiSolarPlan[slotIdx] = (powerTaken,)
             else:
                 # Since this is a grid slot we can pull as much power as we want
                 powerTaken = maxPower
-                eddiGridPlan.append((rate[0], rate[1], powerTaken))
+                eddiGridPlan[slotIdx] = (powerTaken,)
             eddiPowerRequired = powerReqSlotInfo[2] - powerTaken
             if eddiPowerRequired <= 0:
                 del eddiPowerReqForSlot[powerReqSlotIdx]
             else:
                 eddiPowerReqForSlot[powerReqSlotIdx] = (powerReqSlotInfo[0], powerReqSlotInfo[1], eddiPowerRequired)
-        # Add on any slots where the battery is charging and the rate is below the threshold. 
-        # This means we divert any surplus that wasn't forecast that the battery could change 
+        # Add on any slots where the battery is charging and the rate is below the threshold.
+        # This means we divert any surplus that wasn't forecast that the battery could change
         # from. EG if the battery fills up early, or we exceed the battery charge rate.
-        for chargePeriod in batPlans.solarChargingPlan:
+        for slotIdx in filter(lambda x: batPlans.solarChargingPlan[x] is not None, range(len(grid))):
             # If the entry is already in the eddi plan, don't try and add it again
-            if not (any(x[0] == chargePeriod[0] for x in eddiSolarPlan) or 
-                    any(x[0] == chargePeriod[0] for x in eddiGridPlan)):
-                exportRate = next(filter(lambda x: x[0] == chargePeriod[0], exportRateData))
-                if exportRate[2] <= eddiTargetRate:
-                    eddiSolarPlan.append((chargePeriod[0], chargePeriod[1], 0))
-        eddiSolarPlan.sort(key=lambda x: x[0])
-        eddiGridPlan.sort(key=lambda  x: x[0])
+            if eddiSolarPlan[slotIdx] is None and eddiGridPlan[slotIdx] is None:
+                if exportRates[slotIdx] <= eddiTargetRate:
+                    eddiSolarPlan[slotIdx] = (0,)
         batPlans.eddiSolarPlan = eddiSolarPlan
         batPlans.eddiGridPlan  = eddiGridPlan
  
@@ -512,152 +782,164 @@ class PowerControlCore():
 
 
     def genBatLevelForecast(self, state, now, percentileIndex):
-        state.batProfile = []
-        # For full charge detection we compare against 99% full, this is so any minor changes 
-        # is battery capacity or energe when we're basically fully charged, and won't charge 
+        # Changing a plan only affects the battery level from the changed slot onwards, so we only 
+        # recalculate the battery profile from the first slot that's out of date, carrying on from the
+        # level and summary of the slot before it.
+        profile                        = state.batProfile.select(percentileIndex)
+        (levels, summaries, firstSlot) = profile
+        del levels[firstSlot:]
+        del summaries[firstSlot:]
+        self.stageTimer.count("genBatLevelForecast")
+        self.stageTimer.count("batLevelSlotsCalculated", len(state.grid) - firstSlot)
+        # For full charge detection we compare against 99% full, this is so any minor changes
+        # is battery capacity or energe when we're basically fully charged, and won't charge
         # any more, don't cause any problems.
         batFullPct            = min(self.batFullPct, 99)
         batTargetResEnergy    = self.batteryCapacity * (self.convertToRealPercentage(self.batTargetReservePct) / 100)
         batAbsMinResEnergy    = self.batteryCapacity * (self.convertToRealPercentage(self.batAbsMinReservePct) / 100)
-        batteryRemaining      = self.batteryEnergy
-        emptyInAnySlot        = False
-        totallyEmptyInAnySlot = False
-        fullInAnySlot         = False
-        totChargeEnergy       = 0.0
-        # The rate data is just used as a basis for the timeline
-        for (index, rate) in enumerate(state.exportRateData):
-            chargeEnergy     = (self.utils.powerForPeriod(state.solarChargingPlan,        rate[0], rate[1], percentileIndex) +
-                                self.utils.powerForPeriod(state.gridChargingPlan,         rate[0], rate[1]))
-            batteryRemaining = (batteryRemaining + chargeEnergy - 
-                                self.utils.powerForPeriod(state.usageAfterSolar,          rate[0], rate[1], percentileIndex) -
-                                self.utils.powerForPeriod(state.dischargeExportSolarPlan, rate[0], rate[1]) -
-                                self.utils.powerForPeriod(state.dischargeToGridPlan,      rate[0], rate[1]) +
-                                self.utils.powerForPeriod(state.houseGridPoweredPlan,     rate[0], rate[1], percentileIndex))
+        lastTargetFullEpoch   = state.grid.dayStartEpochs[-1] + (22 * 60 + 30) * 60
+        # The summary for each slot is (total charge energy, last full slot, last empty slot, totally 
+        # empty in any slot, max energy in a slot after the target full time)
+        if firstSlot:
+            batteryRemaining = levels[-1][0]
+            (totChargeEnergy, lastFullSlot, lastEmptySlot, 
+             totallyEmptyInAnySlot, maxEnergyAfterTarget) = summaries[-1]
+        else:
+            batteryRemaining      = self.batteryEnergy
+            totChargeEnergy       = 0.0
+            lastFullSlot          = None
+            lastEmptySlot         = None
+            totallyEmptyInAnySlot = False
+            maxEnergyAfterTarget  = -math.inf
+        planValue = state.planValue
+        for slotIdx in range(firstSlot, len(state.grid)):
+            chargeEnergy     = (planValue(state.solarChargingPlan,        slotIdx, percentileIndex) +
+                                planValue(state.gridChargingPlan,         slotIdx))
+            batteryRemaining = (batteryRemaining + chargeEnergy -
+                                state.usageAfterSolar[slotIdx][percentileIndex] -
+                                planValue(state.dischargeExportSolarPlan, slotIdx) -
+                                planValue(state.dischargeToGridPlan,      slotIdx) +
+                                planValue(state.houseGridPoweredPlan,     slotIdx, percentileIndex))
             totChargeEnergy  = totChargeEnergy + chargeEnergy
             fullyChanged     = batteryRemaining >= self.batteryCapacity
             empty            = batteryRemaining <= batTargetResEnergy
             totallyEmpty     = batteryRemaining <= batAbsMinResEnergy
             if fullyChanged:
-                fullInAnySlot    = True
+                lastFullSlot     = slotIdx
                 batteryRemaining = self.batteryCapacity
             if empty:
-                emptyInAnySlot   = True
-            if totallyEmpty:      
+                lastEmptySlot    = slotIdx
+            if totallyEmpty:
                 totallyEmptyInAnySlot = True
                 batteryRemaining      = batAbsMinResEnergy
+            if state.grid.startEpochs[slotIdx] >= lastTargetFullEpoch:
+                maxEnergyAfterTarget = max(maxEnergyAfterTarget, batteryRemaining)
             pct = round(self.convertToAppPercentage((batteryRemaining / self.batteryCapacity) * 100), 1)
-            state.batProfile.append((rate[0], rate[1], batteryRemaining, fullyChanged, empty, pct))
-           
-        # calculate the end time of the last fully charged and empty slots
-        lastFullSlotEndTime = None
-        if fullInAnySlot:
-            lastFullSlotEndTime = next(filter(lambda x: x[3], reversed(state.batProfile)))[1]
-        lastEmptySlotEndTime = None
-        if emptyInAnySlot:
-            lastEmptySlotEndTime = next(filter(lambda x: x[4], reversed(state.batProfile)))[1]
+            levels.append((batteryRemaining, fullyChanged, empty, pct))
+            summaries.append((totChargeEnergy, lastFullSlot, lastEmptySlot, totallyEmptyInAnySlot, maxEnergyAfterTarget))
+        profile[2] = len(levels)
+
+        # calculate the end time (as an epoch) of the last fully charged and empty slots
+        emptyInAnySlot       = lastEmptySlot is not None
+        lastFullSlotEndTime  = state.grid.endEpochs[lastFullSlot]  if lastFullSlot  is not None else None
+        lastEmptySlotEndTime = state.grid.endEpochs[lastEmptySlot] if lastEmptySlot is not None else None
         # We need to work out if the battery is fully charged in a time slot after 4pm on the
         # last day of the forecast. When calculating the battery full energy we add a bit of
-        # hysteresis based on whether there are any charge slots in the current plan before midday. 
+        # hysteresis based on whether there are any charge slots in the current plan before midday.
         # This effectily means that we aim to charge to a slightly higher value and when we
-        # discharge we'll only add extra charge slots if we go below a slightly lower value. The 
+        # discharge we'll only add extra charge slots if we go below a slightly lower value. The
         # aim of this is to prevent slight changes in usage etc from suddenly causing an extra high
         # cost charging slot to be added at the last minute.
-        # NOTE: We pick a target full time of 4:30pm as this is after we get the next days price info. 
-        #       So making sure we're in a reasonable state of charge before we know how bad/good the 
+        # NOTE: We pick a target full time of 4:30pm as this is after we get the next days price info.
+        #       So making sure we're in a reasonable state of charge before we know how bad/good the
         #       next day is going to be.
         hysteresis                = self.batFullPctHysteresis if totChargeEnergy else -self.batFullPctHysteresis
         batFullEnergy             = self.batteryCapacity * ((batFullPct + hysteresis) / 100)
-        lastTargetFullTime        = state.batProfile[-1][0].replace(hour=22, minute=30, second=0, microsecond=0)
-        fullChargeAfterTargetTime = any(x[0] >= lastTargetFullTime and x[2] >= batFullEnergy for x in state.batProfile)
-        # We also indicate the battery is fully charged if its after the target time now, and its 
-        # currently fully charged. This prevents an issue where the current time slot is never  
+        fullChargeAfterTargetTime = maxEnergyAfterTarget >= batFullEnergy
+        # We also indicate the battery is fully charged if its after the target time now, and its
+        # currently fully charged. This prevents an issue where the current time slot is never
         # allowed to discharge if we don't have a charging period for tomorrow mapped out already
         if not fullChargeAfterTargetTime:
-            if self.batteryEnergy > batFullEnergy and now >= lastTargetFullTime:
+            if self.batteryEnergy > batFullEnergy and now.timestamp() >= lastTargetFullEpoch:
                 fullChargeAfterTargetTime = True
-        return (lastTargetFullTime, fullChargeAfterTargetTime, lastFullSlotEndTime, emptyInAnySlot, totallyEmptyInAnySlot, lastEmptySlotEndTime)
+        return (lastTargetFullEpoch, fullChargeAfterTargetTime, lastFullSlotEndTime, emptyInAnySlot, totallyEmptyInAnySlot, lastEmptySlotEndTime)
 
 
-    def chooseRate(self, rateA, rateB, notAfterTime=None):
-        foundRate = []
+    def chooseRate(self, rateA, rateB):
+        # Each rate is either None, or a tuple of (slot index, rate)
+        foundRate = None
         isRateA   = None
-        # if requested don't use any slots after the specified time
-        if notAfterTime:
-            rateA = list(filter(lambda x: x[0] <= notAfterTime, rateA))
-            rateB = list(filter(lambda x: x[0] <= notAfterTime, rateB))
         # choose the cheapest of the two rates, but checking for corner cases like no rates left
         if rateA and rateB:
-            isRateA   = rateA[0][2] < rateB[0][2]
-            foundRate = rateA[0] if isRateA else rateB[0]
+            isRateA   = rateA[1] < rateB[1]
+            foundRate = rateA if isRateA else rateB
         elif rateA:
-            isRateA   = True 
-            foundRate = rateA[0]
+            isRateA   = True
+            foundRate = rateA
         elif rateB:
             isRateA   = False
-            foundRate = rateB[0]
+            foundRate = rateB
         return (foundRate, isRateA)
 
 
     def chooseRate3(self, rateA, rateB, rateC, notAfterTime=None):
-        (foundRate, isRateA)  = self.chooseRate(rateA,     rateB, notAfterTime)
-        foundRate             = [foundRate] if foundRate else []
-        (foundRate, isRateAB) = self.chooseRate(foundRate, rateC, notAfterTime)
+        # The rates are rate pools. If requested don't use any slots that start after the specified 
+        # time (an epoch).
+        (foundRate, isRateA)  = self.chooseRate(rateA.cheapest(notAfterTime), rateB.cheapest(notAfterTime))
+        (foundRate, isRateAB) = self.chooseRate(foundRate,                    rateC.cheapest(notAfterTime))
         rateId = (2 if not isRateAB else
                   0 if     isRateA  else 1)
         return (foundRate, rateId)
 
 
     def allocateChangingSlots(self, state, now, maxImportRate, topUpToChargeCost = None):
+        grid = state.grid
         # We create a local copy of the available rates as there some cases (if there's no solar
-        # surplus) where we don't want to remove an entry from the availableExportRates array, 
-        # but we need to remove it locally so we can keep track of which items we've used, and 
+        # surplus) where we don't want to remove an entry from the availableExportRates array,
+        # but we need to remove it locally so we can keep track of which items we've used, and
         # which are still available
-        availableImportRatesLocal           = list(state.availableImportRates)
-        availableImportRatesLocalUnused     = list(state.availableImportRates)
-        availableHouseGridPoweredRatesLocal = list(state.availableHouseGridPoweredRates)
+        availableImportRatesLocal           = state.availableImportRates.copy()
+        availableImportRatesLocalUnused     = state.availableImportRates.copy()
+        availableHouseGridPoweredRatesLocal = state.availableHouseGridPoweredRates.copy()
         # The percentile index is used to select the 50th percentile (index 0) or the low (index 1)
-        # or high (index 2) estimates. Which one we choose changes based on whether we're trying to 
-        # make sure the battery doesn't go flat, or whether we're topping it up and don't want to 
-        # over charge it and end up with a surplus that just goes to the grid. Unless we're explicitly 
-        # being asked to add a topup, we start off with the low estimate as the first passes are to 
+        # or high (index 2) estimates. Which one we choose changes based on whether we're trying to
+        # make sure the battery doesn't go flat, or whether we're topping it up and don't want to
+        # over charge it and end up with a surplus that just goes to the grid. Unless we're explicitly
+        # being asked to add a topup, we start off with the low estimate as the first passes are to
         # ensure the battery doesn't go flat, with later passes topping it up.
         percentileIndex                     = 2 if topUpToChargeCost else 1
-        # Compute a list of times where's a rate, and we have a +ve solar surplus for the selected
-        # percentile. First filter out the slots we don't have a rate for. Then filter out any zero 
-        # surplus slots
-        nonZeroSolarSurplus                 = self.utils.opOnSeries(state.availableExportRates, state.solarSurplus, lambda a, b: b, 0, percentileIndex)
-        nonZeroSolarSurplus                 = list(filter(lambda x: x[2], nonZeroSolarSurplus))
-        # Now create a local list of charge rates, but only for the slots where there's a non-zero surplus.        
-        availableExportRatesLocal           = self.utils.opOnSeries(nonZeroSolarSurplus, state.availableExportRates, lambda a, b: b)        
-        # We don't want to discharge the battery for any slots where the cost of running the house off 
-        # the grid is lower than what we've previously paid to charge the battery. So add any grid 
+        # Create a local list of charge rates, but only for the slots where there's a non-zero surplus
+        # for the selected percentile.
+        availableExportRatesLocal           = RatePool(grid, state.exportRates,
+                                                       filter(lambda x: state.solarSurplus[x][percentileIndex], state.availableExportRates))
+        # We don't want to discharge the battery for any slots where the cost of running the house off
+        # the grid is lower than what we've previously paid to charge the battery. So add any grid
         # powered rates that are below the current charge cost
         def addBelowChargeCostHouseGridPoweredSlots():
-            for rate in list(filter(lambda x: x[2] < state.maxChargeCost, availableHouseGridPoweredRatesLocal)):
-                usage     = self.utils.powerForPeriod(state.usageAfterSolar, rate[0], rate[1])
-                usageLow  = self.utils.powerForPeriod(state.usageAfterSolar, rate[0], rate[1], 1)
-                usageHigh = self.utils.powerForPeriod(state.usageAfterSolar, rate[0], rate[1], 2)
+            while availableHouseGridPoweredRatesLocal and availableHouseGridPoweredRatesLocal.cheapest()[1] < state.maxChargeCost:
+                slotIdx = availableHouseGridPoweredRatesLocal.cheapest()[0]
                 # we can only use a charging slot once, so remove it from the available list
-                availableHouseGridPoweredRatesLocal.remove(rate)
-                state.availableHouseGridPoweredRates.remove(rate)
-                state.houseGridPoweredPlan.append((rate[0], rate[1], usage, usageLow, usageHigh))
+                availableHouseGridPoweredRatesLocal.remove(slotIdx)
+                state.removeRate("availableHouseGridPoweredRates", slotIdx)
+                state.updatePlan("houseGridPoweredPlan", slotIdx, state.usageAfterSolar[slotIdx])
         addBelowChargeCostHouseGridPoweredSlots()
         # Keep producing a battery forecast and adding the cheapest charging slots until the battery is full
-        (fullEndTimeThresh,   fullyCharged, 
-         lastFullSlotEndTime, empty, 
-         totallyEmptyInAnySlot, 
+        (fullEndTimeThresh,   fullyCharged,
+         lastFullSlotEndTime, empty,
+         totallyEmptyInAnySlot,
          lastEmptySlotEndTime)              = self.genBatLevelForecast(state, now, percentileIndex)
         # initialise the allow empty before variable to the start of the profile so it has no effect to start with
-        allowEmptyBefore                    = state.batProfile[0][0]
+        allowEmptyBefore                    = grid.startEpochs[0]
         maxAllowedChargeCost                = topUpToChargeCost if topUpToChargeCost else math.inf
         # Define helper function to check if charging is required, this is so we can be sure to apply
         # the same formula in multiple place
         def chargeRequired(empty, topUpToChargeCost, fullyCharged):
             return empty or topUpToChargeCost or not fullyCharged
-                                        
-        # Keep searching for a slot while there's a need for it, using the common healper function 
-        # defined above 
+
+        # Keep searching for a slot while there's a need for it, using the common healper function
+        # defined above
         while chargeRequired(empty, topUpToChargeCost, fullyCharged):
+            self.stageTimer.count("allocateIterations")
             addBelowChargeCostHouseGridPoweredSlots()
             # If the battery has gone flat during at any point, make sure the charging slot we search
             # for is before the point it went flat
@@ -665,313 +947,472 @@ class PowerControlCore():
             firstEmptySlot = None
             if empty:
                 percentileIndex = 1
-                firstEmptySlot  = next(filter(lambda x: x[4] and x[0] >= allowEmptyBefore, state.batProfile), None)
-                if firstEmptySlot:
-                    firstEmptySlot = firstEmptySlot[1]
-                    chargeBefore   = firstEmptySlot
+                batLevels       = state.batProfile.current
+                firstEmptySlot  = next(filter(lambda x: batLevels[x][2], 
+                                              range(bisect.bisect_left(grid.startEpochs, allowEmptyBefore), len(batLevels))), None)
+                if firstEmptySlot is not None:
+                    chargeBefore = grid.endEpochs[firstEmptySlot]
             else:
                 percentileIndex = 2
-                # If the only reason we're looking for slots is to hit the battery full criteria then 
+                # If the only reason we're looking for slots is to hit the battery full criteria then
                 # don't add slots after the full theshold end time, as they won't actually help meet
                 # the full battery criteria.
                 if not chargeRequired(empty, topUpToChargeCost, True):
                     chargeBefore = fullEndTimeThresh
             # Search for a charging slot
-            (chargeRate, rateId) = self.chooseRate3(availableExportRatesLocal, availableImportRatesLocal, availableHouseGridPoweredRatesLocal, chargeBefore)                
+            (chargeRate, rateId) = self.chooseRate3(availableExportRatesLocal, availableImportRatesLocal, availableHouseGridPoweredRatesLocal, chargeBefore)
             if chargeRate:
-                timeInSlot = (chargeRate[1] - chargeRate[0]).total_seconds() / (60 * 60)
+                (slotIdx, rate) = chargeRate
+                timeInSlot      = grid.slotHours[slotIdx]
                 # The charge cost is the cost to get x amount of energy in the battery, due to the overheads
-                # this is higher than the cost of the rate used to charge the battery. We don't apply the 
+                # this is higher than the cost of the rate used to charge the battery. We don't apply the
                 # efficency factor when using rate type 2, as this is powering the house directly off the
                 # grid, so the "chargeCost" is just the rate, and doesn't take into account the battery efficency.
-                chargeCost = chargeRate[2] if rateId == 2 else (chargeRate[2] / self.batEfficiency)
+                chargeCost = rate if rateId == 2 else (rate / self.batEfficiency)
                 # Pre calculate if the charge rate is below the max import rate. For this comparison we
                 # use the raw charge cost and don't take account of the battery efficency, is this gives
                 # us an apples to apples comparison with the import rates.
-                belowMaxImportRate = chargeRate[2] < maxImportRate
+                belowMaxImportRate = rate < maxImportRate
                 # Calculate the space left in the battery for this slot, We can't charge more than this
-                maxChargeEnergy = self.batteryCapacity - self.utils.powerForPeriod(state.batProfile, chargeRate[0], chargeRate[1])
+                maxChargeEnergy = self.batteryCapacity - state.batProfile[slotIdx][0]
                 # Only allow charging if there's room in the battery for this slot, and its below the max
                 # charge cost allowed
-                willCharge = (chargeCost <= maxAllowedChargeCost) and not next(filter(lambda x: x[0] == chargeRate[0], state.batProfile))[3]
+                willCharge = (chargeCost <= maxAllowedChargeCost) and not state.batProfile[slotIdx][1]
                 # Don't add any charging slots that are before the last fully charged slot, as it won't help
-                # get the battery to fully change at our target time, and it just fills the battery with more 
+                # get the battery to fully change at our target time, and it just fills the battery with more
                 # expensive electricity when there's cheaper electriticy available later.
-                if lastFullSlotEndTime:
-                    willCharge = willCharge and chargeRate[1] >= lastFullSlotEndTime
-                # Similarly, its only worth charging in a slot if the reason for charging isn't just that 
+                if lastFullSlotEndTime is not None:
+                    willCharge = willCharge and grid.endEpochs[slotIdx] >= lastFullSlotEndTime
+                # Similarly, its only worth charging in a slot if the reason for charging isn't just that
                 # we're empty, or if the charge slot is before the point we go empty
-                if lastEmptySlotEndTime:
-                    willCharge = willCharge and (chargeRate[1] <= lastEmptySlotEndTime or chargeRequired(False, topUpToChargeCost, fullyCharged))                
-                # We also don't want to run the house of the grid if the slot we go empty on is the same cost 
-                # as the slot we're evaluating. Instead we just let the battery go flat in this case as we 
-                # might not actually end up using that much power to flatten it if the usage forecast is 
+                if lastEmptySlotEndTime is not None:
+                    willCharge = willCharge and (grid.endEpochs[slotIdx] <= lastEmptySlotEndTime or chargeRequired(False, topUpToChargeCost, fullyCharged))
+                # We also don't want to run the house of the grid if the slot we go empty on is the same cost
+                # as the slot we're evaluating. Instead we just let the battery go flat in this case as we
+                # might not actually end up using that much power to flatten it if the usage forecast is
                 # pesermistic. When it reaches the absolute empty threshold we don't do this any more and must
-                # force at least running the house from the grid. If we don't have the totallyEmptyInAnySlot 
+                # force at least running the house from the grid. If we don't have the totallyEmptyInAnySlot
                 # term in the conditition then the algorithm can treat the battery as an infinite store of
-                # energy and keep running it off an empty battery forever. This in itself isn't a problem as 
+                # energy and keep running it off an empty battery forever. This in itself isn't a problem as
                 # the house will naturally pull from the grid when the battery gives up, but it has knockon
-                # effects on the charge cost etc that breaks other aspects of the system.                    
-                if firstEmptySlot and willCharge and not totallyEmptyInAnySlot:
-                    # Calculate the minimum change cost available taking into account the fact that some list 
+                # effects on the charge cost etc that breaks other aspects of the system.
+                if firstEmptySlot is not None and willCharge and not totallyEmptyInAnySlot:
+                    # Calculate the minimum change cost available taking into account the fact that some list
                     # of rates may be empty
                     minAvailableRate = math.inf
                     if availableExportRatesLocal:
-                        minAvailableRate = min(minAvailableRate, min(map(lambda x: x[2], availableExportRatesLocal)))
+                        minAvailableRate = min(minAvailableRate, availableExportRatesLocal.cheapest()[1])
                     if availableImportRatesLocal:
-                        minAvailableRate = min(minAvailableRate, min(map(lambda x: x[2], availableImportRatesLocal)))
+                        minAvailableRate = min(minAvailableRate, availableImportRatesLocal.cheapest()[1])
                     if availableHouseGridPoweredRatesLocal:
-                        minAvailableRate = min(minAvailableRate, min(map(lambda x: x[2], availableHouseGridPoweredRatesLocal)))
-                    emptySlotCost    = next(filter(lambda x: x[1] == firstEmptySlot, self.originalImportRateData), None)[2]
-                    # We use the raw charge rate instead of chargeCost here because to do a like for like 
+                        minAvailableRate = min(minAvailableRate, availableHouseGridPoweredRatesLocal.cheapest()[1])
+                    emptySlotCost    = self.originalImportRates[firstEmptySlot]
+                    # We use the raw charge rate instead of chargeCost here because to do a like for like
                     # comparison we don't want to take into account the battery efficency when comparing the
                     # rates (as it's not factored into minAvailableRate).
-                    willCharge       = willCharge and ((chargeRate[2] < emptySlotCost) or (chargeRate[2] == minAvailableRate))
-                    
+                    willCharge       = willCharge and ((rate < emptySlotCost) or (rate == minAvailableRate))
+
                 def gridUsageAllowed():
                     # Don't run the house on grid power if the slot is the max grid powered price, we might as
                     # well just let the battery go flat, and in some cases due to the margins we wouldn't actually
                     # end up using that much grid power as we'd pre-planned it.
                     return belowMaxImportRate
-                
+
                 if rateId == 0: # solar
                     maxCharge = min(timeInSlot * self.maxChargeRate, maxChargeEnergy)
-                    powerMed  = self.utils.powerForPeriod(state.solarSurplus, chargeRate[0], chargeRate[1])
-                    powerLow  = self.utils.powerForPeriod(state.solarSurplus, chargeRate[0], chargeRate[1], 1)
-                    powerHigh = self.utils.powerForPeriod(state.solarSurplus, chargeRate[0], chargeRate[1], 2)
-                    power     = (powerMed, powerLow, powerHigh)[percentileIndex]
+                    power     = state.solarSurplus[slotIdx]
                     # we can only add something to the charge plan if there's surplus solar
-                    willCharge = willCharge and power > 0
+                    willCharge = willCharge and power[percentileIndex] > 0
                     if willCharge:
-                        state.solarChargingPlan.append((chargeRate[0], chargeRate[1], min(powerMed,  maxCharge), 
-                                                                                      min(powerLow,  maxCharge),
-                                                                                      min(powerHigh, maxCharge)))
-                        # we can only use a charging slot once, so remove it from the available list            
-                        state.availableExportRates.remove(chargeRate)
-                    # We always remove the rate from the local array, otherwise we could end up trying 
+                        state.updatePlan("solarChargingPlan", slotIdx, (min(power[0], maxCharge),
+                                                                            min(power[1], maxCharge),
+                                                                            min(power[2], maxCharge)))
+                        # we can only use a charging slot once, so remove it from the available list
+                        state.removeRate("availableExportRates", slotIdx)
+                    # We always remove the rate from the local array, otherwise we could end up trying
                     # to add the same zero power rate again and again. We don't want to remove these rates
-                    # from the availableExportRates as we want these slots to be available outside this 
+                    # from the availableExportRates as we want these slots to be available outside this
                     # function for other types of activity
-                    availableExportRatesLocal.remove(chargeRate)
+                    availableExportRatesLocal.remove(slotIdx)
                 elif rateId == 1: # grid charge
                     willCharge = willCharge and gridUsageAllowed()
-                    # We don't want to end up charging the battery when its cheaper to just run the house 
-                    # directly from the grid. So if the battery is going to be empty (and that's the only 
+                    # We don't want to end up charging the battery when its cheaper to just run the house
+                    # directly from the grid. So if the battery is going to be empty (and that's the only
                     # reason we're looking for a charge slot), check what the electricity import rate is for
                     # the slot where it goes empty and compare that to the cheapest charge rate we've found
                     # to determine if we should use this charge rate or not.
-                    if firstEmptySlot and not chargeRequired(False, topUpToChargeCost, fullyCharged):
-                        emptySlotCost = next(filter(lambda x: x[1] == firstEmptySlot, self.originalImportRateData), None)[2]
+                    if firstEmptySlot is not None and not chargeRequired(False, topUpToChargeCost, fullyCharged):
+                        emptySlotCost = self.originalImportRates[firstEmptySlot]
                         cheapEnough   = (chargeCost <= emptySlotCost - self.minBuyUseMargin)
                         # If we're not using the slot because its not cheap enough, then we shouldn't remove
                         # the slot from the list of available slots. This is because we might encounter an
                         # empty slot later on where the cost differential is large enough to warrant using
                         # this slot. There is a side effect to this. Becauase we might not be removing the
                         # slot from the available slot list, we need another way of making sure we don't just
-                        # try the same slot next time arround and end up in an infinite loop. To handle all of 
+                        # try the same slot next time arround and end up in an infinite loop. To handle all of
                         # this we maintain two sets of slot lists:
-                        #   availableImportRatesLocal: Is the list of slots currently being considered, we 
-                        #     always remove entries from this as we check them. Even if the reason we're 
-                        #     rejected the slot is that its not cheap enough. This slot list is used for 
+                        #   availableImportRatesLocal: Is the list of slots currently being considered, we
+                        #     always remove entries from this as we check them. Even if the reason we're
+                        #     rejected the slot is that its not cheap enough. This slot list is used for
                         #     checking on the next iteration, so this behaviour prevents infinite loops.
-                        #   availableImportRatesLocalUnused: This list contains all the unused slots, we only 
-                        #     remove a slot from this list if we've eliminated the slot for a reason other than 
-                        #     it not being cheap enough. Every time we update allowEmptyBefore we restore 
-                        #     availableImportRatesLocal based on whats in availableImportRatesLocalUnused so we 
-                        #     can reconsider slots there were rejected because they weren't cheap enough for 
+                        #   availableImportRatesLocalUnused: This list contains all the unused slots, we only
+                        #     remove a slot from this list if we've eliminated the slot for a reason other than
+                        #     it not being cheap enough. Every time we update allowEmptyBefore we restore
+                        #     availableImportRatesLocal based on whats in availableImportRatesLocalUnused so we
+                        #     can reconsider slots there were rejected because they weren't cheap enough for
                         #     the empty slot cost we were considering at the time.
                         slotUsed   = not willCharge or  cheapEnough
                         willCharge =     willCharge and cheapEnough
                     else:
                         slotUsed = True
                     # If the charge slot is still valid, add it to the plan now
-                    solarCharge = self.utils.powerForPeriod(state.solarChargingPlan, chargeRate[0], chargeRate[1])
+                    solarCharge = state.planValue(state.solarChargingPlan, slotIdx)
                     chargeTaken = min((timeInSlot * self.batteryGridChargeRate) - solarCharge, maxChargeEnergy)
                     if willCharge and chargeTaken > 0:
                         # we can only use a charging slot once, so remove it from the available list
-                        state.availableImportRates.remove(chargeRate)
-                        state.gridChargingPlan.append((chargeRate[0], chargeRate[1], chargeTaken))
+                        state.removeRate("availableImportRates", slotIdx)
+                        state.updatePlan("gridChargingPlan", slotIdx, (chargeTaken,))
                     # Same reason as above, always remove the local charge rate
-                    availableImportRatesLocal.remove(chargeRate)
+                    availableImportRatesLocal.remove(slotIdx)
                     # See detaied explanation where slotUsed is set above
                     if slotUsed:
-                        availableImportRatesLocalUnused.remove(chargeRate)
+                        availableImportRatesLocalUnused.remove(slotIdx)
                 elif rateId == 2: # house on grid power
                     willCharge = willCharge and gridUsageAllowed()
                     if willCharge:
-                        usage     = self.utils.powerForPeriod(state.usageAfterSolar, chargeRate[0], chargeRate[1])
-                        usageLow  = self.utils.powerForPeriod(state.usageAfterSolar, chargeRate[0], chargeRate[1], 1)
-                        usageHigh = self.utils.powerForPeriod(state.usageAfterSolar, chargeRate[0], chargeRate[1], 2)
                         # we can only use a charging slot once, so remove it from the available list
-                        state.availableHouseGridPoweredRates.remove(chargeRate)
-                        state.houseGridPoweredPlan.append((chargeRate[0], chargeRate[1], usage, usageLow, usageHigh))
+                        state.removeRate("availableHouseGridPoweredRates", slotIdx)
+                        state.updatePlan("houseGridPoweredPlan", slotIdx, state.usageAfterSolar[slotIdx])
                     # Same reason as above, always remove the local charge rate
-                    availableHouseGridPoweredRatesLocal.remove(chargeRate)
-                    
+                    availableHouseGridPoweredRatesLocal.remove(slotIdx)
+
                 if willCharge:
                     state.updateChangeCost(chargeCost)
                     addBelowChargeCostHouseGridPoweredSlots()
                     # update the battery profile based on the new charging plan
-                    (_, fullyCharged, lastFullSlotEndTime, empty, 
-                     totallyEmptyInAnySlot, lastEmptySlotEndTime) = self.genBatLevelForecast(state, now, percentileIndex)   
-            elif firstEmptySlot:
-                # If the battery gets empty then the code above we restrict the search for a charging 
-                # slot to the time before it gets empty. This can result in not finding a charge slot. 
-                # In this case we don't terminate the search we just allow the battery to be empty for 
+                    (_, fullyCharged, lastFullSlotEndTime, empty,
+                     totallyEmptyInAnySlot, lastEmptySlotEndTime) = self.genBatLevelForecast(state, now, percentileIndex)
+            elif firstEmptySlot is not None:
+                # If the battery gets empty then the code above we restrict the search for a charging
+                # slot to the time before it gets empty. This can result in not finding a charge slot.
+                # In this case we don't terminate the search we just allow the battery to be empty for
                 # that slot and try again to change during a later slot.
-                allowEmptyBefore          = firstEmptySlot
+                allowEmptyBefore          = grid.endEpochs[firstEmptySlot]
                 # See detaied explanation where slotUsed is set above
-                availableImportRatesLocal = list(availableImportRatesLocalUnused)
+                availableImportRatesLocal = availableImportRatesLocalUnused.copy()
             else:
                 break
 
         return (fullyCharged, empty)
 
-    
-    def houseRateForPeriod(self, startTime, endTime, exportRateData, importRateData, solarSurplus):
-        surplus = self.utils.powerForPeriod(solarSurplus, startTime, endTime)
-        if surplus > 0:
-            rate = next(filter(lambda x: x[0] == startTime, exportRateData), None)
+
+    def houseRateForSlot(self, state, slotIdx):
+        if state.solarSurplus[slotIdx][0] > 0:
+            rate = state.exportRates[slotIdx]
         else:
-            rate = next(filter(lambda x: x[0] == startTime, importRateData), None)
+            rate = state.importRates[slotIdx]
         return rate
 
 
     def maxHouseRateForEmpty(self, state):
         maxRate = None
-        for batEntry in filter(lambda x: x[4], state.batProfile):
-            curRate = self.houseRateForPeriod(batEntry[0], batEntry[1], state.exportRateData, state.importRateData, state.solarSurplus)
+        for slotIdx in filter(lambda x: state.batProfile[x][2], range(len(state.batProfile))):
+            curRate = self.houseRateForSlot(state, slotIdx)
             if maxRate == None:
-                maxRate = curRate[2]
+                maxRate = curRate
             else:
-                maxRate = max(maxRate, curRate[2])
+                maxRate = max(maxRate, curRate)
         return maxRate
 
-    
-    def calculateChargePlan(self, exportRateData, importRateData, solarUsage, solarSurplus, usageAfterSolar, now, extendExportPlanTo):
-        minImportChargeRate = min(map(lambda x: x[2], self.originalImportRateData)) / self.batEfficiency
+
+    def calculateChargePlan(self, grid, exportRates, importRates, solarUsage, solarSurplus, usageAfterSolar, now, extendExportPlanTo):
         maxImportRate       = max(map(lambda x: x[2], self.originalImportRateData))
         # calculate the initial charging profile
-        batAllocateState    = BatteryAllocateState(exportRateData, importRateData, solarSurplus, usageAfterSolar, self)
-        self.allocateChangingSlots(batAllocateState, now, maxImportRate)
+        batAllocateState    = BatteryAllocateState(grid, exportRates, importRates, solarUsage, solarSurplus, usageAfterSolar, self)
+        # The plan can optionally be found by dynamic programming, rather than the greedy search below
+        if self.args.get('planner', 'greedy') == 'dp':
+            with self.stageTimer.stage("dpPlanner"):
+                DpChargePlanner(self, batAllocateState, maxImportRate).plan(now, self.dischargePlanEndEpoch(now, extendExportPlanTo))
+            self.log("Max battery charge cost {0:.2f}".format(batAllocateState.maxChargeCost))
+            self.printSeries(lambda: grid.planToSeries(batAllocateState.batProfile), "Battery profile")
+            self.removeHouseGridPoweredOverlap(batAllocateState)
+            return batAllocateState
+        with self.stageTimer.stage("initialAllocation"):
+            self.allocateChangingSlots(batAllocateState, now, maxImportRate)
 
         # Now we have a change plan, see if we can swap some of the slots to discharge to the grid to improve the
-        # income
-        def dischargeGridExportSlotTest(state, slot):
-            newState               = None
-            timeInSlot             = (slot[1] - slot[0]).total_seconds() / (60 * 60)
-            maxExportForSlot       = timeInSlot * self.gridExportLimit
-            maxDischargeForSlot    = timeInSlot * self.maxDischargeRate
-            solarSurplusForSlot    = self.utils.powerForPeriod(state.solarSurplus,    slot[0], slot[1])
-            usageAfterSolarForSlot = self.utils.powerForPeriod(state.usageAfterSolar, slot[0], slot[1])
-            dischargeForSlot       = min(maxDischargeForSlot - usageAfterSolarForSlot, max(0, maxExportForSlot - solarSurplusForSlot))
-            if dischargeForSlot > 0:
-                newState = state.copy()
-                newState.dischargeToGridPlan.append((slot[0], slot[1], dischargeForSlot))
-            return newState   
-            
-        self.addDischargeSlots(batAllocateState, now, maxImportRate, dischargeGridExportSlotTest, extendExportPlanTo)
-
-        # Now we have a change plan, see if we can swap some of the slots to discharge to cover the house usage to
-        # improve the income
-        def dischargeExportSolarSlotTest(state, slot):
-            newState          = None
-            solarUsageForSlot = self.utils.powerForPeriod(solarUsage, slot[0], slot[1])
-            if solarUsageForSlot > 0:
-                newState = state.copy()
-                newState.dischargeExportSolarPlan.append((slot[0], slot[1], solarUsageForSlot))
-            return newState   
-            
-        self.addDischargeSlots(batAllocateState, now, maxImportRate, dischargeExportSolarSlotTest, extendExportPlanTo)
-   
-        self.utils.printSeries(batAllocateState.batProfile, "Battery profile - pre topup")
+        # income. Then see if we can swap some of the slots to discharge to cover the house usage to improve the 
+        # income. If enabled the discharge trials are evaluated in parallel, sharing what's sent to the workers
+        # between both passes.
+        trialRunner = self.dischargeTrialRunner(batAllocateState)
+        with self.stageTimer.stage("dischargeToGrid"):
+            self.addDischargeSlots(batAllocateState, now, maxImportRate, "dischargeGridExportSlotTest",  extendExportPlanTo, trialRunner)
+        with self.stageTimer.stage("dischargeExportSolar"):
+            self.addDischargeSlots(batAllocateState, now, maxImportRate, "dischargeExportSolarSlotTest", extendExportPlanTo, trialRunner)
+
+        self.printSeries(lambda: grid.planToSeries(batAllocateState.batProfile), "Battery profile - pre topup")
         # Now allocate any final charge slots topping up the battery as much as possible, but not exceeding
         # the max charge cost. This means we won't end up increasing the overall charge cost per/kwh. In
-        # addition, this means that we'll top up to 100% overright if that's the cheaper option, or if the 
-        # solar is a lower cost we'll end up topping up to 100% during the day. This in turn means we're 
+        # addition, this means that we'll top up to 100% overright if that's the cheaper option, or if the
+        # solar is a lower cost we'll end up topping up to 100% during the day. This in turn means we're
         # more likely to be prepared for the next day. EG if we need a higher charge level at the end of
-        # the day if we need to make it all the way to the next days solar charge period, or a lower charge 
-        # level at the end of the day because we only need to make it to the overright charge period max 
-        # charge cost we've already established. 
+        # the day if we need to make it all the way to the next days solar charge period, or a lower charge
+        # level at the end of the day because we only need to make it to the overright charge period max
+        # charge cost we've already established.
         topUpMaxCost = batAllocateState.maxChargeCost * float(self.args.get('topUpCostTolerance', 1))
-        self.allocateChangingSlots(batAllocateState, now, maxImportRate, batAllocateState.maxChargeCost)    
+        with self.stageTimer.stage("topUp"):
+            self.allocateChangingSlots(batAllocateState, now, maxImportRate, batAllocateState.maxChargeCost)
 
         self.log("Battery top up cost threshold {0:.3f}".format(topUpMaxCost))
         self.log("Max battery charge cost {0:.2f}".format(batAllocateState.maxChargeCost))
-        self.utils.printSeries(batAllocateState.batProfile, "Battery profile - post topup")
+        self.printSeries(lambda: grid.planToSeries(batAllocateState.batProfile), "Battery profile - post topup")
+        self.removeHouseGridPoweredOverlap(batAllocateState)
+        return batAllocateState
+
+
+    def removeHouseGridPoweredOverlap(self, batAllocateState):
         # When calculating the battery profile we allow the "house on grid power" and "grid charging" plans to
         # overlap. However we need to remove this overlap before returning the plan to the caller.
-        batAllocateState.houseGridPoweredPlan = self.utils.opOnSeries(batAllocateState.houseGridPoweredPlan, batAllocateState.gridChargingPlan, lambda a, b: 0 if b else a)
-        batAllocateState.houseGridPoweredPlan = list(filter(lambda x: x[2], batAllocateState.houseGridPoweredPlan))
-        batAllocateState.sortPlans()
-        return batAllocateState
+        batAllocateState.houseGridPoweredPlan = list(map(lambda x: (x[0][0],) if x[0] is not None and x[0][0] and not (x[1] is not None and x[1][0]) else None,
+                                                         zip(batAllocateState.houseGridPoweredPlan, batAllocateState.gridChargingPlan)))
+        batAllocateState.batProfile.invalidateFrom(0)
+
+
+    def dischargeTrialWorkers(self):
+        # The number of processes used to evaluate discharge trials in parallel, 0 or 1 evaluates them in turn.
+        # There's no point having more workers than CPUs, as the trials would just queue up for them.
+        return min(int(self.args.get('dischargeTrialWorkers', 0)), os.cpu_count() or 1)
 
 
-    def addDischargeSlots(self, batAllocateState, now, maxImportRate, slotTest, extendExportPlanTo):
+    def dischargeTrialPool(self):
+        # Returns the process pool used to evaluate discharge trials in parallel, or None if they're evaluated
+        # in turn. Starting the workers takes far longer than a planning run, so the pool is started the first
+        # time it's needed and kept for later runs. It's only restarted if the args change.
+        if self.trialPool and self.trialPool[0] != self.args:
+            self.closeDischargeTrialPool()
+        if self.dischargeTrialWorkers() <= 1:
+            return None
+        if self.trialPool is None:
+            # These are only imported when they're used, as multiprocessing is slow to import
+            import multiprocessing
+            import concurrent.futures
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+            if "forkserver" in methods:
+                context.set_forkserver_preload(["core.powerCore"])
+            self.trialPool = (dict(self.args), concurrent.futures.ProcessPoolExecutor(self.dischargeTrialWorkers(), mp_context=context))
+        return self.trialPool[1]
+
+
+    def closeDischargeTrialPool(self):
+        if self.trialPool:
+            self.trialPool[1].shutdown(wait=False, cancel_futures=True)
+            self.trialPool = None
+
+
+    def dischargeTrialRunner(self, batAllocateState):
+        # Returns a runner for the discharge trials of this planning run, or None if they're evaluated in turn
+        pool = self.dischargeTrialPool()
+        if pool is None:
+            return None
+        self.trialRunKey = self.trialRunKey + 1
+        return DischargeTrialRunner(pool, self.trialRunKey, int(self.args.get('dischargeTrialMinBatch', 3)),
+                                    lambda: self.trialContext(batAllocateState))
+
+
+    def trialContext(self, batAllocateState):
+        # Everything a discharge trial worker needs that's fixed for the planning run, the settings and
+        # battery state the allocator uses and the planner inputs on the slot grid. This is much smaller 
+        # than the core, which holds all the input and output series.
+        settings = dict(map(lambda x: (x, getattr(self, x)), PowerControlCore.trialSettingNames))
+        inputs   = (batAllocateState.grid,       batAllocateState.exportRates,  batAllocateState.importRates,
+                    batAllocateState.solarUsage, batAllocateState.solarSurplus, batAllocateState.usageAfterSolar)
+        return pickle.dumps((settings, inputs), protocol=pickle.HIGHEST_PROTOCOL)
+
+
+    def dischargeGridExportSlotTest(self, state, slotIdx):
+        newState               = None
+        timeInSlot             = state.grid.slotHours[slotIdx]
+        maxExportForSlot       = timeInSlot * self.gridExportLimit
+        maxDischargeForSlot    = timeInSlot * self.maxDischargeRate
+        solarSurplusForSlot    = state.solarSurplus[slotIdx][0]
+        usageAfterSolarForSlot = state.usageAfterSolar[slotIdx][0]
+        dischargeForSlot       = min(maxDischargeForSlot - usageAfterSolarForSlot, max(0, maxExportForSlot - solarSurplusForSlot))
+        if dischargeForSlot > 0:
+            newState = state.copy()
+            newState.updatePlan("dischargeToGridPlan", slotIdx, (dischargeForSlot,))
+        return newState
+
+
+    def dischargeExportSolarSlotTest(self, state, slotIdx):
+        newState          = None
+        solarUsageForSlot = state.solarUsage[slotIdx][0]
+        if solarUsageForSlot > 0:
+            newState = state.copy()
+            newState.updatePlan("dischargeExportSolarPlan", slotIdx, (solarUsageForSlot,))
+        return newState
+
+
+    def tryDischargeSlot(self, batAllocateState, slotIdx, rate, now, maxImportRate, slotTestName):
+        # Check if discharging in this slot is plausable. The slot test function must return a new 
+        # state object if it is, and it can't be the same as the existing state object as we need
+        # to modify it during the checks to see if this slot is indeed possible to discharge in. 
+        # Returns the new state if the slot should be used for discharging, otherwise None.
+        newBatAllocateState = getattr(self, slotTestName)(batAllocateState, slotIdx)
+        assert(newBatAllocateState != batAllocateState)
+        if newBatAllocateState:
+            # We can't change in the slot we're trying to discharge in, so remove this from the trial list.
+            newBatAllocateState.removeRate("availableExportRates", slotIdx)
+            # We can't charge and discharge at the same time, so remove the proposed discharge slot from
+            # the available charge rates. We also do the same for the existing import slots. It can make
+            # sense to swap one import slot for export because the import and export prices are so different.
+            newBatAllocateState.discardRate("availableImportRates",           slotIdx)
+            newBatAllocateState.discardRate("availableHouseGridPoweredRates", slotIdx)
+            newBatAllocateState.updatePlan("gridChargingPlan",                slotIdx, None)
+            newBatAllocateState.updatePlan("houseGridPoweredPlan",            slotIdx, None)
+            (fullyCharged, empty) = self.allocateChangingSlots(newBatAllocateState, now, maxImportRate)
+            # If we're still fully charged after swapping a slot to discharging, then make that the plan
+            # of record. We also skip a potential discharge period if the difference between the cost of 
+            # the charge / discharge periods isn't greater than the threshold. This reduces battery 
+            # cycling if there's not much to be gained from it.
+            newMaxCostRate          = newBatAllocateState.maxChargeCost
+            newMaxHouseRateForEmpty = self.maxHouseRateForEmpty(newBatAllocateState)
+            if newMaxHouseRateForEmpty != None:
+                newMaxCostRate = max(newBatAllocateState.maxChargeCost, newMaxHouseRateForEmpty)
+            buySelMargin = rate - newMaxCostRate
+            reqMargin    = self.minBuySelMargin if fullyCharged else self.minBuySelNotFullMargin
+            if buySelMargin > reqMargin:
+                return newBatAllocateState
+        return None
+
+
+    def dischargePlanEndEpoch(self, now, extendExportPlanTo):
         # Limit the length of time into the future that we calculate the discharge slots
-        midnight = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        endTime  = midnight + timedelta(hours=24)
+        endEpoch = SlotGrid.dayStartEpoch(now) + secondsPerDay
         if now.hour > 20:
-            endTime = endTime + timedelta(hours=24)
+            endEpoch = endEpoch + secondsPerDay
         # Make sure we plan upto at least the end of the export override end time
-        if endTime < extendExportPlanTo:
-            endTime = extendExportPlanTo
+        return max(endEpoch, math.ceil(extendExportPlanTo.timestamp()))
+
+
+    def addDischargeSlots(self, batAllocateState, now, maxImportRate, slotTestName, extendExportPlanTo, trialRunner=None):
+        grid     = batAllocateState.grid
+        endEpoch = self.dischargePlanEndEpoch(now, extendExportPlanTo)
         # look at the most expensive rate and see if there's solar usage we can flip to battery usage so
-        # we can export more. We only do this if we still end up fully charged. We can't use the 
-        # availableExportRates list directly, as we need to remove entries as we go, and we still need 
-        # to have a list of available charge slots after this step. We sort the list to favour the most 
-        # profitable slots, then the earliest day, then the latest slot on that day (which is likely to 
-        # be when there's the least solar, so we consider the largest power slots first).
-        potentialDischargeRates = sorted(filter(lambda x: x[0] < endTime, batAllocateState.availableExportRates), 
-                                         key=lambda x: ( x[2], 
-                                                         -x[0].replace(hour=0, minute=0, second=0, microsecond=0).timestamp(), 
-                                                         x[0].replace(year=2000, month=1, day=1).timestamp() ))
-        # We also need to filter out any slots that we're importing / charging from potential discharge 
+        # we can export more. We only do this if we still end up fully charged. We can't use the
+        # availableExportRates list directly, as we need to remove entries as we go, and we still need
+        # to have a list of available charge slots after this step. We sort the list to favour the most
+        # profitable slots, then the earliest day, then the latest slot on that day (which is likely to
+        # be when there's the least solar, so we consider the largest power slots first). Each potential
+        # discharge rate is a list of [slot index, rate].
+        # The time of day is compared in UTC (as the old year 2000 timestamps were).
+        potentialDischargeRates = sorted(filter(lambda x: grid.startEpochs[x] < endEpoch, batAllocateState.availableExportRates),
+                                         key=lambda x: ( batAllocateState.exportRates[x],
+                                                         -grid.dayStartEpochs[x],
+                                                         grid.timesOfDay[x] - grid.utcOffsets[x] ))
+        potentialDischargeRates = list(map(lambda x: [x, batAllocateState.exportRates[x]], potentialDischargeRates))
+        # We also need to filter out any slots that we're importing / charging from potential discharge
         # opertinuties
         def filterOutChangeSlotsFromPotentialDischargeSlots(potentialDischargeRates, batState):
-            potentialDischargeRates = self.utils.opOnSeries(potentialDischargeRates, batState.solarChargingPlan,    lambda a, b: 0 if b else a)
-            potentialDischargeRates = self.utils.opOnSeries(potentialDischargeRates, batState.houseGridPoweredPlan, lambda a, b: 0 if b else a)
-            potentialDischargeRates = self.utils.opOnSeries(potentialDischargeRates, batState.gridChargingPlan,     lambda a, b: 0 if b else a)
+            for rate in potentialDischargeRates:
+                if (batState.planValue(batState.solarChargingPlan,    rate[0]) or
+                    batState.planValue(batState.houseGridPoweredPlan, rate[0]) or
+                    batState.planValue(batState.gridChargingPlan,     rate[0])):
+                    rate[1] = 0
             return potentialDischargeRates
         potentialDischargeRates = filterOutChangeSlotsFromPotentialDischargeSlots(potentialDischargeRates, batAllocateState)
-        
+
         while potentialDischargeRates:
-            mostExpenciveRate = potentialDischargeRates[-1]
-            del potentialDischargeRates[-1]
-            # Do a quick test between the previous max change cost and the export rate we're testing to see 
-            # if it's we exceed the minimum dischange margin. This isn't the full store as dischanging in a
-            # slot may mean we need extra (more expensive) charge slots, but it gives us a early test to 
-            # reduce CPU overheads that won't give us false negatives.
-            if mostExpenciveRate[2] - batAllocateState.maxChargeCost <= self.minBuySelMargin:
-                continue
-            
-            # Check if discharging in this slot is plausable. The slot test function must return a new 
-            # state object if it is, and it can't be the same as the existing state object as we need
-            # to modify it during the checks to see if this slot is indeed possible to discharge in.
-            newBatAllocateState = slotTest(batAllocateState, mostExpenciveRate)
-            assert(newBatAllocateState != batAllocateState)
-            if newBatAllocateState:
-                # We can't change in the slot we're trying to discharge in, so remove this from the trial list.
-                newBatAllocateState.availableExportRates.remove(mostExpenciveRate)
-                # We can't charge and discharge at the same time, so remove the proposed discharge slot from 
-                # the available charge rates. We also do the same for the existing import slots. It can make
-                # sense to swap one import slot for export because the import and export prices are so different.
-                newBatAllocateState.availableImportRates           = list(filter(lambda x: x[0] != mostExpenciveRate[0], newBatAllocateState.availableImportRates))
-                newBatAllocateState.availableHouseGridPoweredRates = list(filter(lambda x: x[0] != mostExpenciveRate[0], newBatAllocateState.availableHouseGridPoweredRates))
-                newBatAllocateState.gridChargingPlan               = list(filter(lambda x: x[0] != mostExpenciveRate[0], newBatAllocateState.gridChargingPlan))
-                newBatAllocateState.houseGridPoweredPlan           = list(filter(lambda x: x[0] != mostExpenciveRate[0], newBatAllocateState.houseGridPoweredPlan))
-                (fullyCharged, empty)                              = self.allocateChangingSlots(newBatAllocateState, now, maxImportRate)  
-                # If we're still fully charged after swapping a slot to discharging, then make that the plan 
-                # of record by updating the arrays. We also skip a potential discharge period if the 
-                # difference between the cost of the charge / discharge periods isn't greater than the 
-                # threshold. This reduces battery cycling if there's not much to be gained from it.
-                newMaxCostRate          = newBatAllocateState.maxChargeCost
-                newMaxHouseRateForEmpty = self.maxHouseRateForEmpty(newBatAllocateState)
-                if newMaxHouseRateForEmpty != None:
-                    newMaxCostRate = max(newBatAllocateState.maxChargeCost, newMaxHouseRateForEmpty)
-                buySelMargin = mostExpenciveRate[2] - newMaxCostRate
-                reqMargin    = self.minBuySelMargin if fullyCharged else self.minBuySelNotFullMargin
-                if  buySelMargin > reqMargin:
+            # Take the next candidates to try. Without a pool they're tried one at a time, with a pool we 
+            # speculatively try a batch of them in parallel, all against the current state.
+            batchSize  = self.dischargeTrialWorkers() if trialRunner else 1
+            considered = []
+            trials     = []
+            while potentialDischargeRates and len(trials) < batchSize:
+                considered.append(potentialDischargeRates.pop())
+                # Do a quick test between the previous max change cost and the export rate we're testing to see
+                # if it's we exceed the minimum dischange margin. This isn't the full store as dischanging in a
+                # slot may mean we need extra (more expensive) charge slots, but it gives us a early test to
+                # reduce CPU overheads that won't give us false negatives.
+                if considered[-1][1] - batAllocateState.maxChargeCost > self.minBuySelMargin:
+                    trials.append(len(considered) - 1)
+            trialArgs = list(map(lambda x: (considered[x][0], considered[x][1], now, maxImportRate, slotTestName), trials))
+            self.stageTimer.count("dischargeTrials", len(trialArgs))
+            # Small batches are quicker to try in turn than to send to the workers. Tried in turn the trials
+            # are only run up to the first one that passes.
+            if trialRunner and trialRunner.worthSending(trialArgs):
+                self.stageTimer.count("dischargeTrialBatches")
+                results = trialRunner.run(batAllocateState, trialArgs)
+            else:
+                results = map(lambda x: self.tryDischargeSlot(batAllocateState, *x), trialArgs)
+            # Accept the first trial that passes, in priority order. This is the same one the sequential 
+            # search would have accepted, as every trial before it was tried against the same state.
+            for (consideredIdx, newBatAllocateState) in zip(trials, results):
+                if newBatAllocateState:
                     batAllocateState.setTo(newBatAllocateState)
+                    # Anything considered after this was checked against the old state, so put it back to
+                    # be considered again against the new state
+                    potentialDischargeRates.extend(reversed(considered[consideredIdx+1:]))
                     # Refilter the potential slots to take account of the new charging slots that have been allocated
                     potentialDischargeRates = filterOutChangeSlotsFromPotentialDischargeSlots(potentialDischargeRates, batAllocateState)
+                    break
+
+
+
+class DischargeTrialRunner():
+    # Runs batches of discharge trials on the worker pool. The workers keep what's fixed for the planning
+    # run (see PowerControlCore.trialContext) between trials, so each trial only sends the parts of the
+    # state that change, and gets the same back (see BatteryAllocateState.changes). The fixed part is sent
+    # with the first batch of the run, and again to any worker that didn't get that batch.
+    def __init__(self, pool, runKey, minBatch, getContext):
+        self.pool        = pool
+        self.runKey      = runKey
+        self.minBatch    = minBatch
+        self.getContext  = getContext
+        self.context     = None
+
+
+    def worthSending(self, trialArgs):
+        return len(trialArgs) >= max(self.minBatch, 2)
+
+
+    def run(self, state, trialArgs):
+        # Returns the new state for each trial (or None if it failed), in the same order as the trials
+        firstBatch   = self.context is None
+        if firstBatch:
+            self.context = self.getContext()
+        changesData  = pickle.dumps(state.changes(), protocol=pickle.HIGHEST_PROTOCOL)
+        taskArgs     = lambda x, context: (self.runKey, context, changesData) + x
+        results      = list(self.pool.map(runDischargeTrial, map(lambda x: taskArgs(x, self.context if firstBatch else None), trialArgs)))
+        missing      = list(filter(lambda x: results[x] == missingTrialContext, range(len(results))))
+        if missing:
+            retried = self.pool.map(runDischargeTrial, map(lambda x: taskArgs(trialArgs[x], self.context), missing))
+            for (resultIdx, result) in zip(missing, retried):
+                results[resultIdx] = result
+        # Only the states up to the one that's accepted are needed, so they're rebuilt as they're used
+        return map(lambda x: state.withChanges(x) if x else None, results)
+
+
+
+# The discharge trial workers run in separate processes, so these need to be module level functions. Each
+# worker holds the core and base state for the latest planning run it's seen, built from the trial context.
+missingTrialContext = "missingTrialContext"
+dischargeTrialRun   = None
+
+
+def runDischargeTrial(args):
+    global dischargeTrialRun
+    (runKey, contextData, changesData, slotIdx, rate, now, maxImportRate, slotTestName) = args
+    if dischargeTrialRun is None or dischargeTrialRun[0] != runKey:
+        if contextData is None:
+            return missingTrialContext
+        (settings, inputs) = pickle.loads(contextData)
+        core               = PowerControlCore.__new__(PowerControlCore)
+        core.__dict__.update(settings)
+        core.log           = lambda *args, **kwargs: None
+        core.utils         = PowerUtils(core.log)
+        core.stageTimer    = StageTimer()
+        dischargeTrialRun  = (runKey, core, BatteryAllocateState(*inputs, core))
+    (_, core, baseState) = dischargeTrialRun
+    newState = core.tryDischargeSlot(baseState.withChanges(pickle.loads(changesData)), slotIdx, rate, now, maxImportRate, slotTestName)
+    return newState.changes() if newState else None
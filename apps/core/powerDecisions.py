@@ -0,0 +1,99 @@
+import bisect
+
+
+
+class DecisionTable():
+    # What the plan has decided for each slot on the grid, as columns with an entry per slot: the plans
+    # the slot is part of (as a string of plan codes), the battery mode, the eddi mode, and the rate and
+    # charge cost of any charging in the slot (None if the battery isn't charging). The outputs only need
+    # the current slot, and the summary of the whole plan, so this is built once when the plan is made
+    # and everything is read from it, rather than searching each of the plan series in turn.
+    # The plan codes used in the summary, in the order they're listed for slots that start at the same time
+    planCodes = [("D", "dischargeExportSolarPlan"),
+                 ("E", "dischargeToGridPlan"),
+                 ("C", "solarChargingPlan"),
+                 ("G", "gridChargingPlan"),
+                 ("H", "houseGridPoweredPlan"),
+                 ("S", "standbyPlan"),
+                 ("B", "dischargeToHousePlan")]
+    # The battery mode for a slot is the first of these the slot is planned for, or solar charging if none
+    modeNames = [("D", "Discharge"),
+                 ("E", "Discharge to grid"),
+                 ("S", "Standby"),
+                 ("G", "Grid charge"),
+                 ("H", "House grid powered")]
+    noDecision = ("Solar charge", "off", None, None)
+
+
+    def __init__(self, startTimes, startEpochs, endEpochs, codes, modes, eddiModes, rates, chargeCosts):
+        self.startTimes  = startTimes
+        self.startEpochs = startEpochs
+        self.endEpochs   = endEpochs
+        self.codes       = codes
+        self.modes       = modes
+        self.eddiModes   = eddiModes
+        self.rates       = rates
+        self.chargeCosts = chargeCosts
+        # Slots are normally all the same length, one after the other, so the slot for a time can be
+        # worked out directly. Otherwise we fall back to a binary search.
+        lengths          = set(map(lambda x: x[1] - x[0], zip(self.startEpochs, self.endEpochs)))
+        contiguous       = all(map(lambda x: x[0] == x[1], zip(self.endEpochs[:-1], self.startEpochs[1:])))
+        self.slotLength  = lengths.pop() if len(lengths) == 1 and contiguous else None
+
+
+    def fromPlans(grid, plans, exportRates, importRates, batEfficiency):
+        # Builds the table from the plans on the grid (a dict of plan name to a list with an entry per
+        # slot), and the rates for each slot before any overrides
+        codes       = list(map(lambda x: "".join(code for (code, planName) in DecisionTable.planCodes if plans[planName][x] is not None),
+                               range(len(grid))))
+        modes       = list(map(lambda x: next((name for (code, name) in DecisionTable.modeNames if code in x), DecisionTable.noDecision[0]), codes))
+        eddiModes   = list(map(lambda x: "boost" if plans["eddiGridPlan"][x]  is not None else
+                                         "on"    if plans["eddiSolarPlan"][x] is not None else "off", range(len(grid))))
+        # Charging from solar costs the export rate we could have had, and from the grid the import rate.
+        # Both are adjusted for the battery efficiency, but powering the house from the grid isn't.
+        rates       = list(map(lambda x: exportRates[x] if "C" in codes[x] else
+                                         importRates[x] if "G" in codes[x] or "H" in codes[x] else None, range(len(grid))))
+        chargeCosts = list(map(lambda x: None                   if x[1] is None else
+                                         x[1] / batEfficiency   if "C" in x[0] or "G" in x[0] else x[1], zip(codes, rates)))
+        return DecisionTable(grid.startTimes, grid.startEpochs, grid.endEpochs, codes, modes, eddiModes, rates, chargeCosts)
+
+
+    def slotAt(self, time):
+        # Returns the index of the slot the time is inside of (not on the boundary), or None if there isn't one
+        epoch = time.timestamp()
+        if not self.startEpochs or epoch <= self.startEpochs[0] or epoch >= self.endEpochs[-1]:
+            return None
+        if self.slotLength:
+            slotIdx = int((epoch - self.startEpochs[0]) // self.slotLength)
+        else:
+            slotIdx = bisect.bisect_left(self.startEpochs, epoch) - 1
+        return slotIdx if self.startEpochs[slotIdx] < epoch < self.endEpochs[slotIdx] else None
+
+
+    def decisionAt(self, time):
+        # Returns the (battery mode, eddi mode, rate, charge cost) for the slot the time is in
+        slotIdx = self.slotAt(time)
+        if slotIdx is None:
+            return DecisionTable.noDecision
+        return (self.modes[slotIdx], self.eddiModes[slotIdx], self.rates[slotIdx], self.chargeCosts[slotIdx])
+
+
+    def after(self, time):
+        # Returns the table without the slots that have ended before the time
+        epoch = time.timestamp()
+        first = next(filter(lambda x: self.endEpochs[x] >= epoch, range(len(self.endEpochs))), len(self.endEpochs))
+        return DecisionTable(self.startTimes[first:], self.startEpochs[first:], self.endEpochs[first:], self.codes[first:],
+                             self.modes[first:], self.eddiModes[first:], self.rates[first:], self.chargeCosts[first:])
+
+
+    def summary(self):
+        # A compact summary of the plan, with the plan code and start time of each run of slots in a plan
+        # (EG "C103,D160" for solar charging from 10:30, then discharging from 16:00, the last digit of the
+        # time is dropped). Runs starting at the same time are listed in the plan code order.
+        runs = []
+        for (slotIdx, codes) in enumerate(self.codes):
+            continues = slotIdx > 0 and self.endEpochs[slotIdx-1] == self.startEpochs[slotIdx]
+            for code in codes:
+                if not (continues and code in self.codes[slotIdx-1]):
+                    runs.append("{0}{1:%H%M}".format(code, self.startTimes[slotIdx])[:-1])
+        return ",".join(runs)
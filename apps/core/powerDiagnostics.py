@@ -0,0 +1,139 @@
+from collections import deque
+import contextlib
+import functools
+import time
+
+
+
+class StageTimer():
+    # Records the wall time and call / iteration counts for each stage of a planning run, and keeps them
+    # for the last few runs. Stages can be nested, and the time for a stage excludes the time spent in any
+    # stages nested inside it, so the stage times for a run add up to its total. Any time in a run that's
+    # not inside a stage is recorded against "other". When disabled every method returns straight away
+    # so the calls can be left in the hot paths.
+    def __init__(self, enabled=False, windowSize=48):
+        self.enabled = enabled
+        self.runs    = deque(maxlen=windowSize)
+        self.current = None
+        self.depth   = 0
+        self.stack   = []
+
+
+    def startRun(self):
+        # Runs can be nested (EG updateOutputs and mergeAndProcessData both start one), only the outer
+        # most one is recorded.
+        if not self.enabled:
+            return
+        self.depth = self.depth + 1
+        if self.depth == 1:
+            self.current = {"startTime": time.time(),
+                            "times":     {},
+                            "counts":    {}}
+            self.stack   = [["other", time.perf_counter()]]
+
+
+    def endRun(self):
+        if not self.enabled or not self.depth:
+            return
+        self.depth = self.depth - 1
+        if self.depth == 0:
+            self.leave()
+            self.current["total"] = sum(self.current["times"].values())
+            self.runs.append(self.current)
+            self.current = None
+
+
+    def __getstate__(self):
+        # A run that's in progress when the state is saved isn't complete, so leave it out
+        state            = dict(self.__dict__)
+        state['current'] = None
+        state['depth']   = 0
+        state['stack']   = []
+        return state
+
+
+    def enter(self, name):
+        now    = time.perf_counter()
+        parent = self.stack[-1]
+        times  = self.current["times"]
+        times[parent[0]] = times.get(parent[0], 0.0) + now - parent[1]
+        self.stack.append([name, now])
+        self.count(name)
+
+
+    def leave(self):
+        now    = time.perf_counter()
+        (name, startTime) = self.stack.pop()
+        times  = self.current["times"]
+        times[name] = times.get(name, 0.0) + now - startTime
+        # The parent stage carries on from here
+        if self.stack:
+            self.stack[-1][1] = now
+
+
+    @contextlib.contextmanager
+    def timedStage(self, name):
+        self.enter(name)
+        try:
+            yield
+        finally:
+            self.leave()
+
+
+    def stage(self, name):
+        # Returns a context manager that times the block it wraps as the named stage
+        if self.current is None:
+            return nullStage
+        return self.timedStage(name)
+
+
+    def count(self, name, increment=1):
+        if self.current is None:
+            return
+        counts       = self.current["counts"]
+        counts[name] = counts.get(name, 0) + increment
+
+
+    def summary(self):
+        # Summarises the last run and the rolling window as a dict of plain values (in milliseconds) so
+        # it can be published as entity attributes. statistics is only imported if the timer's used, as
+        # it's slow to import.
+        import statistics
+        toMs    = lambda x: round(x * 1000, 1)
+        summary = {"enabled": self.enabled,
+                   "runs":    len(self.runs)}
+        if self.runs:
+            lastRun            = self.runs[-1]
+            summary["lastRun"] = {"startTime": lastRun["startTime"],
+                                  "totalMs":   toMs(lastRun["total"]),
+                                  "stagesMs":  dict(map(lambda x: (x[0], toMs(x[1])), lastRun["times"].items())),
+                                  "counts":    dict(lastRun["counts"])}
+            stageTimes = {}
+            for run in self.runs:
+                for (name, stageTime) in run["times"].items():
+                    stageTimes.setdefault(name, []).append(stageTime)
+            totals            = list(map(lambda x: x["total"], self.runs))
+            summary["window"] = {"totalMs":  {"median": toMs(statistics.median(totals)),
+                                              "max":    toMs(max(totals))},
+                                 "stagesMs": dict(map(lambda x: (x[0], {"median": toMs(statistics.median(x[1])),
+                                                                         "max":    toMs(max(x[1]))}), stageTimes.items()))}
+        return summary
+
+
+
+nullStage = contextlib.nullcontext()
+
+
+def timedRun(getTimer):
+    # Method decorator that records each call as a run on the timer returned by getTimer(self)
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            timer = getTimer(self)
+            timer.startRun()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                timer.endRun()
+        return wrapper
+    return decorator
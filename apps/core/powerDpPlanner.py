@@ -0,0 +1,222 @@
+import math
+import numpy
+
+
+
+class DpChargePlanner():
+    # An alternative to the greedy allocateChangingSlots / addDischargeSlots search, that plans the battery
+    # by dynamic programming over the slot grid. The battery energy between the absolute minimum reserve
+    # and full is split into a number of levels. Working backwards from the end of the plan we find the
+    # cheapest action for each level in each slot, given the value of the energy it leaves in the battery
+    # for the next slot (interpolated between the levels). The plan is then found by working forwards from
+    # the current battery energy. The runtime is O(slots x levels x actions) whatever the rates are.
+    #
+    # The actions for each slot match the plans the greedy search produces:
+    #   0: Run the house off the battery, and export any solar surplus
+    #   1: Charge the battery from the solar surplus
+    #   2: Charge the battery from the grid (and any solar surplus), running the house off the grid
+    #   3: Run the house off the grid, leaving the battery alone
+    #   4: Discharge the battery to the grid
+    #   5: Run the house off the battery so all the solar is exported
+    # The battery is modelled the same way as genBatLevelForecast, so the plan gives the profile the DP
+    # expects. Charge is added to the battery at face value, with the battery losses added to the cost of
+    # charging (as they are for the max charge cost), and the level is limited to between the absolute
+    # minimum reserve and full at the end of each slot. Any house usage the battery can't cover comes from
+    # the grid. Rather than hard rules, the margins are applied as costs. Every kWh discharged to export
+    # costs the buy / sell margin (for the battery wear), and every kWh charged from the grid costs
+    # minBuyUseMargin. Using energy below the target reserve is costed at the max import rate, so we only
+    # go below it if there's no other choice.
+    #
+    # As with the greedy search, the buy / sell margin depends on whether the battery is full after the
+    # target full time (22:30 on the last day of the plan). The plan is found with minBuySelMargin, and
+    # the battery required to be full after the target time, and again with minBuySelNotFullMargin and no
+    # requirement, and the cheapest is used. Being full is tracked as part of the state for the slots after
+    # the target time, so the battery only has to be full in one of them.
+    # A plan that isn't full when it has to be costs far more than any plan could
+    notFullCost = 1e9
+
+
+    def __init__(self, core, state, maxImportRate):
+        self.core          = core
+        self.state         = state
+        self.grid          = state.grid
+        self.maxImportRate = maxImportRate
+        self.numLevels     = max(2, int(core.args.get('dpPlannerLevels', 101)))
+        self.efficiency    = core.batEfficiency
+        self.capacity      = core.batteryCapacity
+        self.absMinEnergy  = core.batteryCapacity * (core.convertToRealPercentage(core.batAbsMinReservePct) / 100)
+        self.targetEnergy  = core.batteryCapacity * (core.convertToRealPercentage(core.batTargetReservePct) / 100)
+        self.fullEnergy    = core.batteryCapacity * ((min(core.batFullPct, 99) + core.batFullPctHysteresis) / 100)
+        self.levels        = numpy.linspace(self.absMinEnergy, self.capacity, self.numLevels)
+        # Any energy left in the battery at the end of the plan saves importing it later, so it's valued
+        # at the average import rate
+        knownImportRates   = list(filter(lambda x: x is not None, state.importRates))
+        self.endEnergyRate = (sum(knownImportRates) / len(knownImportRates)) if knownImportRates else 0.0
+
+
+    def slotActions(self, slotIdx, energy, allowDischarge, buySelMargin):
+        # Returns the energy after each action, the cost of each action, and the amount of energy in each
+        # plan for each action, for the battery energies given. Actions that aren't possible cost infinity.
+        core           = self.core
+        state          = self.state
+        hours          = self.grid.slotHours[slotIdx]
+        surplus        = state.solarSurplus[slotIdx][0]
+        usage          = state.usageAfterSolar[slotIdx][0]
+        solarUsage     = state.solarUsage[slotIdx][0]
+        exportRate     = state.exportRates[slotIdx]
+        importRate     = state.importRates[slotIdx]
+        gridAllowed    = importRate is not None and importRate < self.maxImportRate
+        houseRate      = importRate if importRate is not None else self.maxImportRate
+        maxDischarge   = hours * core.maxDischargeRate
+        available      = energy - self.absMinEnergy
+        numEnergies    = len(energy)
+        zeros          = numpy.zeros(numEnergies)
+        infinite       = numpy.full(numEnergies, math.inf)
+        # The battery level at the end of the slot, and the cost of the house usage it couldn't cover
+        def settle(level):
+            return (numpy.clip(level, self.absMinEnergy, self.capacity), numpy.maximum(self.absMinEnergy - level, 0) * houseRate)
+        # 0: Run the house off the battery
+        (houseLevel, houseCost) = settle(energy - usage)
+        actions        = [(houseLevel, houseCost - surplus * exportRate, {})]
+        # 1: Charge from the solar surplus, the house is still run off the battery
+        solarCharge    = numpy.minimum(min(surplus, hours * core.maxChargeRate), numpy.maximum(self.capacity - energy + usage, 0))
+        (level, cost)  = settle(energy + solarCharge - usage)
+        actions.append((level,
+                        numpy.where(solarCharge > 0, cost - surplus * exportRate + solarCharge * exportRate / self.efficiency, infinite),
+                        {"solarChargingPlan": solarCharge}))
+        # 2: Charge from the grid, topping up any solar charge to the grid charge rate. The house is run off
+        #    the grid, so the battery only gets the charge.
+        if gridAllowed:
+            solarCharge = numpy.minimum(min(surplus, hours * core.maxChargeRate), numpy.maximum(self.capacity - energy, 0))
+            gridCharge  = numpy.maximum(numpy.minimum(hours * core.batteryGridChargeRate - solarCharge, self.capacity - energy - solarCharge), 0)
+            actions.append((numpy.minimum(energy + solarCharge + gridCharge, self.capacity),
+                            numpy.where(gridCharge > 0, usage * importRate - surplus * exportRate + 
+                                                        (solarCharge * exportRate + gridCharge * importRate) / self.efficiency +
+                                                        gridCharge * core.minBuyUseMargin, infinite),
+                            {"solarChargingPlan": solarCharge, "gridChargingPlan": gridCharge, "houseGridPoweredPlan": zeros + usage}))
+        else:
+            actions.append((energy, infinite, {}))
+        # 3: Run the house off the grid
+        if gridAllowed and usage > 0:
+            actions.append((energy, numpy.full(numEnergies, usage * importRate - surplus * exportRate), {"houseGridPoweredPlan": zeros + usage}))
+        else:
+            actions.append((energy, infinite, {}))
+        # 4: Discharge to the grid, limited by the discharge rate and the export limit
+        toGrid         = numpy.minimum(min(maxDischarge - usage, max(0, hours * core.gridExportLimit - surplus)), available - usage)
+        if allowDischarge:
+            actions.append((energy - usage - toGrid,
+                            numpy.where(toGrid > 0, -(surplus + toGrid) * exportRate + toGrid * buySelMargin, infinite),
+                            {"dischargeToGridPlan": toGrid}))
+        else:
+            actions.append((energy, infinite, {}))
+        # 5: Run the house off the battery, and export all the solar
+        if allowDischarge and solarUsage > 0 and usage + solarUsage <= maxDischarge:
+            actions.append((energy - usage - solarUsage,
+                            numpy.where(available >= usage + solarUsage, -(surplus + solarUsage) * exportRate + solarUsage * buySelMargin, infinite),
+                            {"dischargeExportSolarPlan": zeros + solarUsage}))
+        else:
+            actions.append((energy, infinite, {}))
+        # Any energy used below the target reserve is costed at the max import rate
+        return list(map(lambda x: (x[0], x[1] + numpy.maximum(numpy.minimum(energy, self.targetEnergy) - x[0], 0) * self.maxImportRate, x[2]),
+                        actions))
+
+
+    def nextValues(self, slotIdx, nextEnergy, full, values, fullFromSlot):
+        # The value of the energy left in the battery for the next slot. After the target full time the
+        # values depend on whether the battery has been full, which it is if it's full at the end of the slot.
+        (notFullValues, fullValues) = values[slotIdx + 1]
+        if fullFromSlot is None or slotIdx < fullFromSlot:
+            return numpy.interp(nextEnergy, self.levels, notFullValues)
+        return numpy.where(full | (nextEnergy >= self.fullEnergy), numpy.interp(nextEnergy, self.levels, fullValues),
+                                                                   numpy.interp(nextEnergy, self.levels, notFullValues))
+
+
+    def solve(self, allowDischarge, buySelMargin, fullFromSlot):
+        # Works backwards finding the cost from each level in each slot to the end of the plan, if the
+        # battery hasn't, and has, been full after the target time. Then works forwards from the current
+        # battery energy choosing the cheapest action for each slot. Returns the total cost, if the battery
+        # was full after the target time, and the action and plan energies for each slot.
+        core         = self.core
+        numSlots     = len(self.grid)
+        endValues    = -(self.levels - self.absMinEnergy) * self.endEnergyRate
+        values       = [None] * numSlots + [(endValues + (self.notFullCost if fullFromSlot is not None else 0), endValues)]
+        notFull      = numpy.zeros(self.numLevels, dtype=bool)
+        for slotIdx in reversed(range(numSlots)):
+            core.stageTimer.count("dpSlots")
+            actions         = self.slotActions(slotIdx, self.levels, allowDischarge[slotIdx], buySelMargin)
+            slotValues      = lambda full: numpy.min(list(map(lambda x: x[1] + self.nextValues(slotIdx, x[0], full, values, fullFromSlot), actions)), axis=0)
+            notFullValues   = slotValues(notFull)
+            values[slotIdx] = (notFullValues, slotValues(~notFull) if fullFromSlot is not None and slotIdx >= fullFromSlot else notFullValues)
+        energy       = numpy.array([min(max(core.batteryEnergy, self.absMinEnergy), self.capacity)])
+        full         = numpy.array([False])
+        totalCost    = 0.0
+        steps        = []
+        for slotIdx in range(numSlots):
+            actions                          = self.slotActions(slotIdx, energy, allowDischarge[slotIdx], buySelMargin)
+            costs                            = list(map(lambda x: x[1][0] + self.nextValues(slotIdx, x[0], full, values, fullFromSlot)[0], actions))
+            actionIdx                        = min(range(len(actions)), key=lambda x: (costs[x], x))
+            (nextEnergy, cost, planEnergies) = actions[actionIdx]
+            steps.append((actionIdx, dict(map(lambda x: (x[0], float(x[1][0])), planEnergies.items())), float(nextEnergy[0])))
+            totalCost                        = totalCost + cost[0]
+            full                             = full | (fullFromSlot is not None and slotIdx >= fullFromSlot and nextEnergy >= self.fullEnergy)
+            energy                           = nextEnergy
+        totalCost = totalCost - (energy[0] - self.absMinEnergy) * self.endEnergyRate
+        return (totalCost, bool(full[0]), steps)
+
+
+    def plan(self, now, dischargeEndEpoch):
+        core           = self.core
+        state          = self.state
+        grid           = self.grid
+        numSlots       = len(grid)
+        allowDischarge = list(map(lambda x: grid.startEpochs[x] < dischargeEndEpoch, range(numSlots)))
+        # The first slot after the target full time, as genBatLevelForecast works it out
+        targetEpoch    = grid.dayStartEpochs[-1] + (22 * 60 + 30) * 60 if numSlots else None
+        fullFromSlot   = next(filter(lambda x: grid.startEpochs[x] >= targetEpoch, range(numSlots)), None)
+        if core.batteryEnergy > self.fullEnergy and numSlots and now.timestamp() >= targetEpoch:
+            # Already full after the target time
+            trials = [(core.minBuySelMargin,        None)]
+        elif fullFromSlot is None:
+            # The plan doesn't reach the target time, so can't be full after it
+            trials = [(core.minBuySelNotFullMargin, None)]
+        else:
+            trials = [(core.minBuySelMargin,        fullFromSlot),
+                      (core.minBuySelNotFullMargin, None)]
+        plans = list(map(lambda x: self.solve(allowDischarge, x[0], x[1]), trials))
+        plans = list(filter(lambda x: x[1][1] or x[0][1] is None, zip(trials, plans)))
+        (_, (_, _, steps)) = min(plans, key=lambda x: x[1][0])
+        for (slotIdx, (actionIdx, planEnergies, _)) in enumerate(steps):
+            self.applyAction(slotIdx, actionIdx, planEnergies)
+        core.genBatLevelForecast(state, now, 0)
+        # The DP models the battery the same way as genBatLevelForecast, so the levels should be the same
+        levels     = state.batProfile.select(0)[0]
+        mismatches = list(filter(lambda x: abs(levels[x][0] - steps[x][2]) > 1e-6, range(numSlots)))
+        if mismatches:
+            core.log("DP planner battery levels differ from the profile from {0}, {1:.3f} kWh planned, {2:.3f} kWh in the profile".format(
+                     grid.startTimes[mismatches[0]], steps[mismatches[0]][2], levels[mismatches[0]][0]))
+        return state
+
+
+    def applyAction(self, slotIdx, actionIdx, planEnergies):
+        # Adds the action to the plans in the same form the greedy search does, and updates the max 
+        # charge cost with the cost of any charging
+        core  = self.core
+        state = self.state
+        if planEnergies.get("solarChargingPlan", 0) > 0:
+            maxCharge = self.grid.slotHours[slotIdx] * core.maxChargeRate
+            power     = state.solarSurplus[slotIdx]
+            state.updatePlan("solarChargingPlan", slotIdx, (planEnergies["solarChargingPlan"], min(power[1], maxCharge), min(power[2], maxCharge)))
+            state.updateChangeCost(state.exportRates[slotIdx] / core.batEfficiency)
+        if planEnergies.get("gridChargingPlan", 0) > 0:
+            state.updatePlan("gridChargingPlan", slotIdx, (planEnergies["gridChargingPlan"],))
+            state.updateChangeCost(state.importRates[slotIdx] / core.batEfficiency)
+        if actionIdx == 2 or actionIdx == 3:
+            # The house is run off the grid while grid charging, as the greedy search plans it, this overlap
+            # is removed from the plan with the greedy one
+            state.updatePlan("houseGridPoweredPlan", slotIdx, state.usageAfterSolar[slotIdx])
+        if actionIdx == 3:
+            state.updateChangeCost(state.importRates[slotIdx])
+        if planEnergies.get("dischargeToGridPlan", 0) > 0:
+            state.updatePlan("dischargeToGridPlan", slotIdx, (planEnergies["dischargeToGridPlan"],))
+        if actionIdx == 5:
+            state.updatePlan("dischargeExportSolarPlan", slotIdx, (planEnergies["dischargeExportSolarPlan"],))
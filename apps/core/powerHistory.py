@@ -0,0 +1,162 @@
+from datetime   import datetime
+from datetime   import timezone
+import numpy
+import os
+import sqlite3
+import threading
+
+
+
+class HistoryStore():
+    # A local store of the (startTime, endTime, delta) samples we derive from the Home Assistant history,
+    # so each refresh only has to fetch the history since the last sample we've already got. This takes
+    # the load off the recorder, and means the forecasts can be built straight away after a restart. The
+    # samples are held in SQLite, keyed by entity and start time, with the times as epoch seconds. Samples
+    # that are fetched again replace the stored copy, so overlapping fetches are harmless.
+    def __init__(self, fileName):
+        self.lock       = threading.Lock()
+        self.connection = sqlite3.connect(fileName, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS samples (entity TEXT NOT NULL, startTime REAL NOT NULL, "
+                                    "endTime REAL NOT NULL, value REAL NOT NULL, PRIMARY KEY (entity, startTime))")
+
+
+    def timeRange(self, entity):
+        # Returns the start of the first sample and the end of the last sample for the entity, or None if
+        # we've not got any samples for it
+        with self.lock:
+            (firstTime, lastTime) = self.connection.execute("SELECT MIN(startTime), MAX(endTime) FROM samples WHERE entity = ?",
+                                                            (entity,)).fetchone()
+        if firstTime is None:
+            return None
+        return (datetime.fromtimestamp(firstTime, timezone.utc), datetime.fromtimestamp(lastTime, timezone.utc))
+
+
+    def fetchFromTime(self, entity, startTime):
+        # The time to fetch the history for the entity from, so we've got all the samples since startTime.
+        # If the samples we've stored don't go back that far we have to fetch the lot again.
+        timeRange = self.timeRange(entity)
+        if timeRange and timeRange[0] <= startTime < timeRange[1]:
+            return timeRange[1]
+        return startTime
+
+
+    def append(self, entity, samples):
+        with self.lock, self.connection:
+            self.connection.executemany("INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?)",
+                                        map(lambda x: (entity, x[0].timestamp(), x[1].timestamp(), x[2]), samples))
+
+
+    def load(self, entity, startTime):
+        # Returns the samples for the entity that end after startTime, in time order
+        with self.lock:
+            rows = self.connection.execute("SELECT startTime, endTime, value FROM samples WHERE entity = ? AND endTime > ? ORDER BY startTime",
+                                           (entity, startTime.timestamp())).fetchall()
+        return list(map(lambda x: (datetime.fromtimestamp(x[0], timezone.utc), datetime.fromtimestamp(x[1], timezone.utc), x[2]), rows))
+
+
+    def prune(self, beforeTime):
+        # Drops all the samples that end before the given time
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM samples WHERE endTime < ?", (beforeTime.timestamp(),))
+
+
+
+class HistoryJoin():
+    # Collects the results of a set of history requests that are made at the same time, and calls
+    # onComplete with a dict of the results (by entity name) once they've all arrived. If the timeout
+    # callback runs first onComplete is called with the results we've got so far, so the missing entities
+    # fall back to the data we already had. Either way onComplete is only called once. Any results that
+    # arrive after the timeout are passed to onLate (with the entity name) as they arrive, so they're not
+    # lost. The callbacks can run on different threads, so the results are updated under a lock.
+    def __init__(self, entityNames, onComplete, onLate=None):
+        self.lock       = threading.Lock()
+        self.pending    = set(entityNames)
+        self.results    = {}
+        self.onComplete = onComplete
+        self.onLate     = onLate
+        self.complete   = False
+
+
+    def resultCallback(self, entityName):
+        # Returns the callback for the history request for the entity
+        return lambda kwargs: self.resultReceived(entityName, kwargs)
+
+
+    def resultReceived(self, entityName, kwargs):
+        with self.lock:
+            late = self.complete
+            if not late:
+                self.results[entityName] = kwargs
+            self.pending.discard(entityName)
+            results = self.finish(not self.pending)
+        if results is not None:
+            self.onComplete(results)
+        elif late and self.onLate:
+            self.onLate(entityName, kwargs)
+
+
+    def timeoutCallback(self, kwargs):
+        with self.lock:
+            results = self.finish(True)
+        if results is not None:
+            self.onComplete(results)
+
+
+    def finish(self, finished):
+        # Returns a copy of the results if we've just finished (and so need to call onComplete)
+        if not finished or self.complete:
+            return None
+        self.complete = True
+        return dict(self.results)
+
+
+
+class SampleLog():
+    # An append only log of (startTime, endTime, value) samples, held as fixed size binary records of the
+    # epoch start and end times and the value. Adding samples only writes the new records, and loading is
+    # a single read straight into a numpy array. If a sample is logged again (EG with an updated value) the
+    # latest record for the start time wins. Old and replaced records are dropped by compact, which writes
+    # the records to keep to a new file and then swaps it in, so the log is never left half written.
+    recordType = numpy.dtype([('start', '<i8'), ('end', '<i8'), ('value', '<f8')])
+    
+    
+    def __init__(self, fileName):
+        self.fileName = fileName
+
+
+    def exists(self):
+        return os.path.isfile(self.fileName)
+
+
+    def append(self, samples):
+        # Takes a list of (startTime, endTime, value) tuples, with the times as epoch seconds
+        records = numpy.array(list(samples), dtype=SampleLog.recordType)
+        if len(records):
+            with open(self.fileName, 'ab') as file:
+                # Drop any partly written record, so the new records line up
+                size = file.seek(0, os.SEEK_END)
+                file.truncate(size - size % SampleLog.recordType.itemsize)
+                file.write(records.tobytes())
+
+
+    def load(self):
+        # Returns the latest record for each start time, in start time order. Any partly written record at
+        # the end of the file (EG if we were stopped mid write) is ignored.
+        if not self.exists():
+            return numpy.zeros(0, dtype=SampleLog.recordType)
+        numRecords = os.path.getsize(self.fileName) // SampleLog.recordType.itemsize
+        records    = numpy.fromfile(self.fileName, dtype=SampleLog.recordType, count=numRecords)
+        # Unique returns the first of any duplicates, so search the records latest first
+        (starts, idxs) = numpy.unique(records['start'][::-1], return_index=True)
+        return records[::-1][idxs]
+
+
+    def compact(self, discardTime):
+        # Rewrites the log without any replaced records, or records that start before the discard time
+        records = self.load()
+        records = records[records['start'] >= discardTime]
+        with open(self.fileName + ".tmp", 'wb') as file:
+            file.write(records.tobytes())
+        os.replace(self.fileName + ".tmp", self.fileName)
+        return records
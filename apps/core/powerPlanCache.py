@@ -0,0 +1,65 @@
+from collections import OrderedDict
+import hashlib
+import pickle
+
+
+
+class PlanCache():
+    # Remembers the outputs of the last few planning runs, keyed by a fingerprint of the planner inputs.
+    # Each entry also records the start of the slot the plan was made in, so the plan can be reused as is
+    # if we're asked to plan again in the same slot with the same inputs. If re-slicing is enabled a plan
+    # made in an earlier slot can also be reused, by dropping the slots that have since passed. This is an
+    # approximation (a full plan from a later slot could differ) so it's off by default. The entries are
+    # looked up most recently used first, and the least recently used entry is dropped when it's full.
+    def __init__(self, size=4, reslice=False):
+        self.size    = size
+        self.reslice = reslice
+        self.entries = OrderedDict()
+        self.stats   = {"hits":     0,
+                        "reslices": 0,
+                        "misses":   0}
+
+
+    def __getstate__(self):
+        # The entries hold a full set of plans each, so only the stats are saved
+        state            = dict(self.__dict__)
+        state['entries'] = OrderedDict()
+        return state
+
+
+    def fingerprint(inputs):
+        return hashlib.blake2b(pickle.dumps(inputs, protocol=pickle.HIGHEST_PROTOCOL), digest_size=16).hexdigest()
+
+
+    def lookup(self, fingerprint, slotStart):
+        # Returns a tuple of the type of match ("hit", "reslice" or None) and the outputs of the cached plan
+        entry  = self.entries.get(fingerprint) if self.size else None
+        result = None
+        if entry is not None:
+            if entry["slotStart"] == slotStart:
+                result = "hit"
+            elif self.reslice and entry["slotStart"] < slotStart < entry["planEnd"]:
+                result = "reslice"
+        if result:
+            self.entries.move_to_end(fingerprint)
+            self.stats[result + "s"] = self.stats[result + "s"] + 1
+            return (result, entry["outputs"])
+        self.stats["misses"] = self.stats["misses"] + 1
+        return (None, None)
+
+
+    def store(self, fingerprint, slotStart, planEnd, outputs):
+        if not self.size:
+            return
+        self.entries[fingerprint] = {"slotStart": slotStart,
+                                     "planEnd":   planEnd,
+                                     "outputs":   outputs}
+        self.entries.move_to_end(fingerprint)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+    def summary(self):
+        lookups = sum(self.stats.values())
+        return dict(self.stats, entries=len(self.entries),
+                                hitRate=round((self.stats["hits"] + self.stats["reslices"]) / lookups, 3) if lookups else 0)
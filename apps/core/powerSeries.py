@@ -0,0 +1,384 @@
+from datetime   import datetime
+from datetime   import timedelta
+from datetime   import timezone
+from core.powerUtils import IndexedSeries
+from core.powerUtils import PowerUtils
+import numpy
+import math
+import bisect
+import copy
+
+
+
+secondsPerDay = 24 * 60 * 60
+
+
+
+class ColumnSeries():
+    # A columnar version of a series. Rather than a list of (start, end, value...) tuples the start and
+    # end times are held as float64 epoch seconds, and the values as a float64 matrix with one column per
+    # value. This lets us align, combine and operate on whole series at once with numpy, rather than
+    # running a lambda and a powerForPeriod call for every sample. The original datetime objects are kept
+    # alongside the arrays so we can convert back to tuples (for the allocator and Home Assistant) without
+    # changing the timezone of any of the samples. The epochs keep the fractions of a second, as the
+    # history from Home Assistant has sample times with microseconds.
+    def __init__(self, startTimes, endTimes, values, starts=None, ends=None):
+        self.startTimes = startTimes
+        self.endTimes   = endTimes
+        self.starts     = starts if starts is not None else numpy.array([x.timestamp() for x in startTimes], dtype=numpy.float64)
+        self.ends       = ends   if ends   is not None else numpy.array([x.timestamp() for x in endTimes],   dtype=numpy.float64)
+        self.values     = numpy.asarray(values, dtype=numpy.float64)
+        self.prefixSums = None
+        # Single columns of values are always held as a 2D matrix
+        if self.values.ndim == 1:
+            self.values = self.values[:, None]
+
+
+    def fromSeries(series, numValues=None):
+        # Converts a series of tuples. By default all the values in the tuple are used, but the number of
+        # values can be limited so trailing non-numeric data (like the solar meta data) is dropped.
+        series = list(series)
+        if numValues is None:
+            numValues = len(series[0]) - 2 if series else 1
+        values = numpy.array([x[2:2+numValues] for x in series], dtype=numpy.float64).reshape(len(series), numValues)
+        return ColumnSeries([x[0] for x in series], [x[1] for x in series], values)
+
+
+    def toSeries(self, seriesClass=IndexedSeries):
+        return seriesClass(map(lambda x: (x[0], x[1], *x[2]), zip(self.startTimes, self.endTimes, self.values.tolist())))
+
+
+    def __len__(self):
+        return len(self.starts)
+
+
+    def withValues(self, values):
+        # Returns a new series with the same time slots as this one, but different values
+        return ColumnSeries(self.startTimes, self.endTimes, values, self.starts, self.ends)
+
+
+    def column(self, valueIdx):
+        return self.withValues(self.values[:, valueIdx])
+
+
+    def combine(self, *args):
+        # Appends the value columns of the other series (which must have the same time slots) to this one
+        return self.withValues(numpy.hstack([self.values] + list(map(lambda x: x.values, args))))
+
+
+    def mask(self, keep):
+        keepIdxs = numpy.flatnonzero(keep)
+        return ColumnSeries([self.startTimes[x] for x in keepIdxs],
+                            [self.endTimes[x]   for x in keepIdxs],
+                            self.values[keepIdxs], self.starts[keepIdxs], self.ends[keepIdxs])
+
+
+    def nonZero(self, valueIdx=0):
+        return self.mask(self.values[:, valueIdx] != 0)
+
+
+    def isOrdered(self):
+        # True if the samples are in time order, don't overlap, and have a non-zero length
+        return bool(numpy.all(self.starts < self.ends) and numpy.all(self.ends[:-1] <= self.starts[1:]))
+
+
+    def total(self):
+        return self.values.sum(axis=0)
+
+
+    def merge(self):
+        # Vectorised version of PowerUtils.mergeSeries. Slots that start at the same time the previous
+        # slot ends are merged, and their values summed.
+        if len(self) == 0:
+            return self
+        newGroup = numpy.ones(len(self), dtype=bool)
+        newGroup[1:] = self.starts[1:] != self.ends[:-1]
+        groupStarts  = numpy.flatnonzero(newGroup)
+        groupEnds    = numpy.append(groupStarts[1:], len(self)) - 1
+        return ColumnSeries([self.startTimes[x] for x in groupStarts],
+                            [self.endTimes[x]   for x in groupEnds],
+                            numpy.add.reduceat(self.values, groupStarts, axis=0),
+                            self.starts[groupStarts], self.ends[groupEnds])
+
+
+    def energyFor(self, other):
+        # Resamples this series onto the time slots of the other series, and returns the values matrix.
+        # This follows the same rules as PowerUtils.powerForPeriod, so any sample that partially overlaps
+        # a slot is pro-rated by the amount of overlap. For a slot that covers a number of samples the
+        # samples in the middle are taken from a running total, so only the first and last samples need
+        # pro-rating. This relies on the samples not overlapping each other.
+        numSamples = len(self)
+        numValues  = self.values.shape[1]
+        if numSamples == 0:
+            return numpy.zeros((len(other), numValues))
+        if not self.isOrdered():
+            # Fallback to the slow, but general, implementation for overlapping / unordered samples
+            utils  = PowerUtils(None)
+            series = self.toSeries(list)
+            return numpy.array([[utils.powerForPeriod(series, start, end, valueIdx) for valueIdx in range(numValues)]
+                                for (start, end) in zip(other.startTimes, other.endTimes)]).reshape(len(other), numValues)
+        if self.prefixSums is None:
+            self.prefixSums = numpy.vstack([numpy.zeros((1, numValues)), numpy.cumsum(self.values, axis=0)])
+        # The index of the first sample that ends after the slot start, and one past the index of the last
+        # sample that starts before the slot end. Samples that just touch the slot don't contribute anything.
+        firstIdx   = numpy.searchsorted(self.ends,   other.starts, side='right')
+        lastIdx    = numpy.searchsorted(self.starts, other.ends,   side='left') - 1
+        numInSlot  = lastIdx - firstIdx + 1
+        def proRata(idx):
+            idx      = numpy.clip(idx, 0, numSamples-1)
+            overlap  = (numpy.minimum(other.ends,   self.ends[idx]) -
+                        numpy.maximum(other.starts, self.starts[idx]))
+            fraction = overlap / (self.ends[idx] - self.starts[idx])
+            return self.values[idx] * fraction[:, None]
+        first  = proRata(firstIdx)
+        last   = proRata(lastIdx)
+        middle = (self.prefixSums[numpy.clip(lastIdx,    0, numSamples)] -
+                  self.prefixSums[numpy.clip(firstIdx+1, 0, numSamples)])
+        numInSlot = numInSlot[:, None]
+        return numpy.where(numInSlot <= 0, 0.0,
+               numpy.where(numInSlot == 1, first,
+               numpy.where(numInSlot == 2, first + last, (middle + first) + last)))
+
+
+    def alignTo(self, other):
+        # Returns this series resampled onto the time slots of the other series
+        return other.withValues(self.energyFor(other))
+
+
+    def append(self, other):
+        # Returns a new series with the samples of the other series after the samples of this one
+        return ColumnSeries(self.startTimes + other.startTimes, self.endTimes + other.endTimes,
+                            numpy.vstack([self.values, other.values]),
+                            numpy.concatenate([self.starts, other.starts]), numpy.concatenate([self.ends, other.ends]))
+
+
+    def localTime(epoch, timeZone):
+        # Converts an epoch to a time in the given time zone, but with a fixed offset. Times in a zone with
+        # DST are compared on their wall clock time, so the repeated hour at the end of DST would sort out
+        # of order. Times with different fixed offsets are compared on the actual time.
+        time = datetime.fromtimestamp(epoch, timeZone)
+        return time.astimezone(timezone(time.utcoffset()))
+
+
+    def dayBefore(epoch, timeZone):
+        # The same time of day on the day before, in the given time zone. Across a DST change this isn't
+        # exactly 24 hours earlier. For fixed offset time zones it always is.
+        localTime = datetime.fromtimestamp(epoch, timeZone).replace(tzinfo=None) - timedelta(days=1)
+        return localTime.replace(tzinfo=timeZone).timestamp()
+
+
+    def extendDaily(self, endTime):
+        # Returns the samples needed to extend this series up to (at least) endTime, by repeating the 
+        # samples from the day before. The new samples are the same length as the last sample, so they
+        # don't need to line up with the samples they repeat (EG if the length doesn't divide a day). Each
+        # new sample gets the pro-rata total of the samples it overlaps the day before, using energyFor. 
+        # As new samples more than a day after the end repeat earlier new samples, the new samples are 
+        # generated in passes. Each pass adds all the remaining samples whose day before is covered by the
+        # samples we've got so far (normally all of them on the first pass).
+        if len(self) == 0:
+            return self
+        timeZone    = self.endTimes[-1].tzinfo
+        duration    = float(self.ends[-1] - self.starts[-1])
+        numNew      = int(max(0, math.ceil((endTime.timestamp() - self.ends[-1]) / duration))) if duration > 0 else 0
+        newStarts   = self.ends[-1] + duration * numpy.arange(numNew, dtype=numpy.float64)
+        newEnds     = newStarts + duration
+        refStarts   = numpy.array(list(map(lambda x: ColumnSeries.dayBefore(x, timeZone), newStarts.tolist())), dtype=numpy.float64)
+        refEnds     = numpy.array(list(map(lambda x: ColumnSeries.dayBefore(x, timeZone), newEnds.tolist())),   dtype=numpy.float64)
+        extended    = self
+        firstNewIdx = 0
+        while firstNewIdx < numNew:
+            lastNewIdx = max(int(numpy.searchsorted(refEnds, extended.ends[-1], side='right')), firstNewIdx + 1)
+            toTimes    = lambda epochs: list(map(lambda x: ColumnSeries.localTime(x, timeZone), epochs.tolist()))
+            refSlots   = ColumnSeries(toTimes(refStarts[firstNewIdx:lastNewIdx]), toTimes(refEnds[firstNewIdx:lastNewIdx]),
+                                      numpy.zeros((lastNewIdx - firstNewIdx, 0)), refStarts[firstNewIdx:lastNewIdx], refEnds[firstNewIdx:lastNewIdx])
+            newSamples = ColumnSeries(toTimes(newStarts[firstNewIdx:lastNewIdx]), toTimes(newEnds[firstNewIdx:lastNewIdx]),
+                                      extended.energyFor(refSlots), newStarts[firstNewIdx:lastNewIdx], newEnds[firstNewIdx:lastNewIdx])
+            extended    = extended.append(newSamples)
+            firstNewIdx = lastNewIdx
+        return extended.mask(numpy.arange(len(extended)) >= len(self))
+
+
+    def binTotals(self, startEpoch, binLength, numBins, valueIdx=0):
+        # Returns the total of the values in each of numBins fixed length bins, starting at startEpoch. As
+        # with energyFor samples are pro-rated by the amount they overlap each bin. Each sample is split
+        # into one piece per bin it overlaps, then the pieces are summed into their bins with a bincount.
+        # Samples with no length are ignored.
+        endEpoch  = startEpoch + binLength * numBins
+        starts    = numpy.clip(self.starts, startEpoch, endEpoch)
+        ends      = numpy.clip(self.ends,   startEpoch, endEpoch)
+        keep      = numpy.flatnonzero(ends > starts)
+        if len(keep) == 0:
+            return numpy.zeros(numBins)
+        starts    = starts[keep]
+        ends      = ends[keep]
+        lengths   = self.ends[keep] - self.starts[keep]
+        values    = self.values[keep, valueIdx]
+        # A sample that ends exactly on a bin boundary doesn't overlap the next bin
+        firstBin  = numpy.floor((starts - startEpoch) / binLength).astype(numpy.int64)
+        lastBin   = numpy.ceil( (ends   - startEpoch) / binLength).astype(numpy.int64) - 1
+        numPieces = lastBin - firstBin + 1
+        sampleIdx = numpy.repeat(numpy.arange(len(keep)), numPieces)
+        # The bin of each piece counts up from the first bin of its sample
+        pieceIdx  = numpy.arange(len(sampleIdx)) - numpy.repeat(numpy.cumsum(numPieces) - numPieces, numPieces)
+        binIdx    = firstBin[sampleIdx] + pieceIdx
+        binStarts = startEpoch + binIdx * binLength
+        overlap   = (numpy.minimum(ends[sampleIdx],   binStarts + binLength) -
+                     numpy.maximum(starts[sampleIdx], binStarts))
+        return numpy.bincount(binIdx, weights=values[sampleIdx] * overlap / lengths[sampleIdx], minlength=numBins)
+
+
+
+class SlotGrid(ColumnSeries):
+    # The common set of time slots (the rate slots) that the planner works on. All the planner inputs are 
+    # resampled onto this grid once per run, so plans, profiles and rates can be held as plain lists indexed
+    # by slot number, rather than as series that have to be realigned with each other. Plans are held as a 
+    # list with an entry per slot, that's either None (not in the plan) or a tuple of the plan values. 
+    def __init__(self, series):
+        series = list(series)
+        super().__init__([x[0] for x in series], [x[1] for x in series], numpy.zeros((len(series), 0)))
+        # The grid slots are whole seconds, so the planner works with int epochs
+        self.startEpochs = list(map(int, self.starts.tolist()))
+        self.endEpochs   = list(map(int, self.ends.tolist()))
+        self.slotHours   = list(map(lambda x: (x[1] - x[0]) / (60 * 60), zip(self.startEpochs, self.endEpochs)))
+        self.slotIndexes = dict(map(lambda x: (x[1], x[0]), enumerate(self.startEpochs)))
+        # The local time of day and start of the local day (as epochs) for each slot, in the time zone 
+        # offset of the slot, so the planner can work with local days without going back to datetimes
+        self.utcOffsets     = list(map(lambda x: int(x.utcoffset().total_seconds()), self.startTimes))
+        self.timesOfDay     = list(map(lambda x: (x[0] + x[1]) % secondsPerDay, zip(self.startEpochs, self.utcOffsets)))
+        self.dayStartEpochs = list(map(lambda x: x[0] - x[1], zip(self.startEpochs, self.timesOfDay)))
+
+
+    def dayStartEpoch(time):
+        # The start of the local day of the time, as an epoch, in the time zone offset of the time
+        epoch = int(time.timestamp())
+        return epoch - (epoch + int(time.utcoffset().total_seconds())) % secondsPerDay
+
+
+    def slotIndex(self, time):
+        # Returns the index of the slot that starts at the given time, or None if there isn't one
+        return self.slotIndexes.get(int(time.timestamp()))
+
+
+    def resample(self, series, numValues=None):
+        # Returns the values of the series for each slot on the grid as a list of tuples
+        return list(map(tuple, ColumnSeries.fromSeries(series, numValues).energyFor(self).tolist()))
+
+
+    def slotValues(self, series):
+        # Returns the value of a series for any slots on the grid that have an exact match in the series.
+        # Slots without a match are None. This is used for rates, where we want to know if a rate exists.
+        values = [None] * len(self)
+        for sample in series:
+            slotIdx = self.slotIndex(sample[0])
+            if slotIdx is not None and self.endEpochs[slotIdx] == int(sample[1].timestamp()):
+                values[slotIdx] = sample[2]
+        return values
+
+
+    def emptyPlan(self):
+        return [None] * len(self)
+
+
+    def planToColumns(self, plan, valueIdx=0):
+        # Returns a single value from each slot of the plan as an array, with zero for slots not in the plan
+        return numpy.array(list(map(lambda x: x[valueIdx] if x is not None else 0.0, plan)), dtype=numpy.float64)
+
+
+    def planToSeries(self, plan, seriesClass=IndexedSeries):
+        # Converts a slot plan back to a series of (start, end, value...) tuples
+        return seriesClass(map(lambda x: (self.startTimes[x[0]], self.endTimes[x[0]], *x[1]), 
+                               filter(lambda x: x[1] is not None, enumerate(plan))))
+
+
+
+class RatePool():
+    # A pool of the slots on the grid that are still available for a particular use (EG charging from 
+    # solar). The allocator repeatedly needs the cheapest available slot, optionally only considering 
+    # slots that start before a given time, and then removes the slot it's used. To make both of these 
+    # O(log n) the slots are held in a tournament tree. This is a heap shaped array with the slots as the
+    # leaves (in time order), where every other node holds the cheapest (rate, slot index) of its two 
+    # children. Ties in the rate go to the earliest slot. Copies share the array until one of them 
+    # removes a slot, so taking a snapshot of a pool is cheap.
+    def __init__(self, grid, rates, slotIdxs=()):
+        self.grid      = grid
+        self.rates     = rates
+        self.numLeaves = 1
+        while self.numLeaves < len(grid):
+            self.numLeaves = self.numLeaves * 2
+        self.tree      = [None] * (2 * self.numLeaves)
+        self.count     = 0
+        self.shared    = False
+        for slotIdx in slotIdxs:
+            self.tree[self.numLeaves + slotIdx] = (rates[slotIdx], slotIdx)
+            self.count                          = self.count + 1
+        for node in reversed(range(1, self.numLeaves)):
+            self.tree[node] = RatePool.cheapestOf(self.tree[2 * node], self.tree[(2 * node) + 1])
+
+
+    def cheapestOf(a, b):
+        if a is None:
+            return b
+        if b is None:
+            return a
+        return a if a <= b else b
+
+
+    def copy(self):
+        newPool     = copy.copy(self)
+        self.shared = newPool.shared = True
+        return newPool
+
+
+    def __len__(self):
+        return self.count
+
+
+    def __contains__(self, slotIdx):
+        return self.tree[self.numLeaves + slotIdx] is not None
+
+
+    def __iter__(self):
+        # Iterates over the available slot indexes in time order
+        return map(lambda x: x[1], filter(None, self.tree[self.numLeaves:]))
+
+
+    def remove(self, slotIdx):
+        node = self.numLeaves + slotIdx
+        if self.tree[node] is None:
+            raise ValueError("Slot {0} is not in the rate pool".format(slotIdx))
+        if self.shared:
+            self.tree   = list(self.tree)
+            self.shared = False
+        self.tree[node] = None
+        self.count      = self.count - 1
+        node            = node // 2
+        while node:
+            self.tree[node] = RatePool.cheapestOf(self.tree[2 * node], self.tree[(2 * node) + 1])
+            node            = node // 2
+
+
+    def discard(self, slotIdx):
+        if slotIdx in self:
+            self.remove(slotIdx)
+
+
+    def cheapest(self, notAfterTime=None):
+        # Returns the (slot index, rate) of the cheapest available slot, or None if there isn't one. If a 
+        # time is given (as an epoch) only slots that start at or before that time are considered.
+        if notAfterTime is None:
+            found = self.tree[1]
+        else:
+            # Find the cheapest of the leaves in the range [0, endSlot) by walking up the tree
+            found = None
+            lo    = self.numLeaves
+            hi    = self.numLeaves + bisect.bisect_right(self.grid.startEpochs, notAfterTime)
+            while lo < hi:
+                if lo & 1:
+                    found = RatePool.cheapestOf(found, self.tree[lo])
+                    lo    = lo + 1
+                if hi & 1:
+                    hi    = hi - 1
+                    found = RatePool.cheapestOf(found, self.tree[hi])
+                lo = lo // 2
+                hi = hi // 2
+        return (found[1], found[0]) if found is not None else None
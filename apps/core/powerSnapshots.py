@@ -0,0 +1,167 @@
+import os
+import pickle
+import struct
+import zlib
+
+
+
+# Snapshot files start with this header, the last byte is the format version
+snapshotHeader  = b"PCSNAP"
+snapshotVersion = 1
+lengthFormat    = struct.Struct("<I")
+
+
+class SnapshotWriter():
+    # Saves snapshots of the planner inputs, so any planning run can be replayed later. There's a file for
+    # each day, made up of a sequence of zlib compressed records. Each record only holds the inputs that
+    # have changed since the previous record in the file (the first record in a file holds them all), so
+    # an input like the rates that only changes once a day is only saved once a day. The inputs are
+    # pickled on the callers thread (so later changes to them don't affect the snapshot), but comparing,
+    # compressing and writing them is done on a background thread so planning never waits for the disk.
+    # Only the files for the last few days are kept.
+    def __init__(self, path, daysKept=14, log=None):
+        self.path       = path
+        self.daysKept   = daysKept
+        self.log        = log
+        self.executor   = None
+        self.fileName   = None
+        self.prevFields = {}
+
+
+    def __getstate__(self):
+        # The background thread can't be saved, it's restarted with the next snapshot
+        state             = dict(self.__dict__)
+        state['executor'] = None
+        state['log']      = None
+        return state
+
+
+    def save(self, time, inputs):
+        fields = dict(map(lambda x: (x[0], pickle.dumps(x[1], protocol=pickle.HIGHEST_PROTOCOL)), inputs.items()))
+        if self.executor is None:
+            import concurrent.futures
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        return self.executor.submit(self.write, time, fields)
+
+
+    def write(self, time, fields):
+        try:
+            fileName = os.path.join(self.path, "{0:%Y-%m-%d}.snapshots".format(time))
+            # Start a new file at the start of each day, or if the file's been removed
+            if fileName != self.fileName or not os.path.isfile(fileName):
+                self.fileName   = fileName
+                self.prevFields = {}
+                self.rotate(fileName)
+                # If we're adding to a file from before a restart, drop any partly written record at the end
+                if os.path.isfile(fileName):
+                    with open(fileName, 'r+b') as file:
+                        file.truncate(snapshotsEnd(file))
+            changed = dict(filter(lambda x: self.prevFields.get(x[0]) != x[1], fields.items()))
+            record  = zlib.compress(pickle.dumps({"time":   time,
+                                                  "fields": changed}, protocol=pickle.HIGHEST_PROTOCOL))
+            with open(fileName, 'ab') as file:
+                if file.seek(0, os.SEEK_END) == 0:
+                    file.write(snapshotHeader + bytes([snapshotVersion]))
+                file.write(lengthFormat.pack(len(record)) + record)
+            self.prevFields = fields
+        except Exception as error:
+            if self.log:
+                self.log("Error saving state: " + str(error))
+
+
+    def rotate(self, currentFileName):
+        # Removes the oldest files, so there's only the current file and the files for the days before it left
+        os.makedirs(self.path, exist_ok=True)
+        current   = os.path.basename(currentFileName)
+        fileNames = sorted(filter(lambda x: x.endswith(".snapshots") and x < current, os.listdir(self.path)))
+        for fileName in fileNames[:max(len(fileNames) - (self.daysKept - 1), 0)]:
+            os.remove(os.path.join(self.path, fileName))
+
+
+
+def readRecords(file):
+    # Generates the raw (compressed) records from the file, after the header
+    while True:
+        length = file.read(lengthFormat.size)
+        if len(length) < lengthFormat.size:
+            break
+        record = file.read(lengthFormat.unpack(length)[0])
+        if len(record) < lengthFormat.unpack(length)[0]:
+            break
+        yield record
+
+
+def snapshotsEnd(file):
+    # The position after the last complete record in the file
+    end = 0
+    if file.read(len(snapshotHeader) + 1)[:len(snapshotHeader)] == snapshotHeader:
+        end = file.tell()
+        for record in readRecords(file):
+            end = file.tell()
+    return end
+
+
+def openSnapshots(fileName):
+    # Opens a snapshot file, positioned at the first record
+    file   = open(fileName, 'rb')
+    header = file.read(len(snapshotHeader) + 1)
+    if header[:len(snapshotHeader)] != snapshotHeader:
+        file.close()
+        raise ValueError(fileName + " isn't a snapshot file")
+    if header[-1] > snapshotVersion:
+        file.close()
+        raise ValueError("{0} is snapshot version {1}, only up to version {2} is supported".format(fileName, header[-1], snapshotVersion))
+    return file
+
+
+def snapshotFields(file):
+    # Generates a (time, fields) tuple for each snapshot in the file, where fields has all the inputs of
+    # the snapshot still pickled. Only the record itself has to be decompressed and unpickled to track the
+    # inputs that have changed, so the inputs of snapshots that aren't needed are never unpickled.
+    fields = {}
+    for record in readRecords(file):
+        record = pickle.loads(zlib.decompress(record))
+        fields.update(record["fields"])
+        yield (record["time"], fields)
+
+
+def unpickleFields(fields):
+    return dict(map(lambda x: (x[0], pickle.loads(x[1])), fields.items()))
+
+
+def countSnapshots(fileName):
+    # The number of complete snapshots in the file. The records are seeked over without being read.
+    count = 0
+    with openSnapshots(fileName) as file:
+        fileSize = os.fstat(file.fileno()).st_size
+        while True:
+            length = file.read(lengthFormat.size)
+            if len(length) < lengthFormat.size:
+                break
+            end = file.tell() + lengthFormat.unpack(length)[0]
+            if end > fileSize:
+                break
+            file.seek(end)
+            count = count + 1
+    return count
+
+
+def readSnapshots(fileName):
+    # Generates a (time, inputs) tuple for each snapshot in the file, in the order they were saved. Any
+    # partly written record at the end of the file is ignored.
+    with openSnapshots(fileName) as file:
+        for (time, fields) in snapshotFields(file):
+            yield (time, unpickleFields(fields))
+
+
+def readSnapshot(fileName, index=-1):
+    # Returns the (time, inputs) tuple for a single snapshot in the file, indexed like a list. Only the
+    # inputs of that snapshot are unpickled.
+    if index < 0:
+        index = index + countSnapshots(fileName)
+    with openSnapshots(fileName) as file:
+        if index >= 0:
+            for (snapshotIdx, (time, fields)) in enumerate(snapshotFields(file)):
+                if snapshotIdx == index:
+                    return (time, unpickleFields(fields))
+    raise IndexError("snapshot index out of range")
@@ -0,0 +1,164 @@
+from datetime   import date
+from datetime   import timezone
+import numpy
+import os
+
+
+
+class SolarForecastBuilder():
+    # Turns the Solcast forecast samples into the tuned and untuned solar series, for all the samples at
+    # once. The low and high estimates come from a cubic through the 0th (always 0 power), 10th, 50th and
+    # 90th percentiles. As the percentiles are the same for every sample the cubic evaluated at the low and
+    # high percentiles is a fixed linear combination of the forecast values, so rather than fitting a cubic
+    # for each sample we precompute the weights once and apply them to all the samples as a matrix product.
+    def __init__(self, lowPercentile, highPercentile, margin):
+        self.margin  = margin
+        self.weights = SolarForecastBuilder.interpolationWeights([10, 50, 90], [lowPercentile, highPercentile])
+
+
+    def interpolationWeights(knownPercentiles, percentiles):
+        # Returns a matrix that maps the values at the known percentiles to the values of the interpolating
+        # polynomial (which also passes through 0 at the 0th percentile) at the requested percentiles
+        points  = [0] + list(knownPercentiles)
+        weights = numpy.vander(percentiles, len(points)) @ numpy.linalg.inv(numpy.vander(points, len(points)))
+        # The value at the 0th percentile is always 0, so its weights aren't needed
+        return weights[:, 1:]
+
+
+    def roundAll(values):
+        # Uses round rather than numpy.round, so the values are exactly what we'd get rounding them one at a time
+        return numpy.array(list(map(lambda x: round(x, 3), values.tolist())))
+
+
+    def modelCoeffs(models, keys):
+        # Returns the slope and intercept of the linear tuning model for each key, and whether there's a model
+        slopes     = numpy.zeros(len(keys))
+        intercepts = numpy.zeros(len(keys))
+        hasModel   = numpy.zeros(len(keys), dtype=bool)
+        for (idx, key) in enumerate(keys):
+            model = models.get(key)
+            if model:
+                coeffs          = model.coeffs
+                slopes[idx]     = coeffs[-2] if len(coeffs) > 1 else 0.0
+                intercepts[idx] = coeffs[-1]
+                hasModel[idx]   = True
+        return (slopes, intercepts, hasModel)
+
+
+    def build(self, powerData, models):
+        # Takes a sorted list of (startTime, percentile50, percentile10, percentile90) samples, and returns
+        # the untuned series, the tuned series (with the low and high estimates and the forecast meta data),
+        # and the daily totals of the tuned series. Each sample ends at the start of the next sample, so the
+        # last sample isn't used. Samples with no power are left out.
+        percentile50   = numpy.array(list(map(lambda x: x[1], powerData)), dtype=numpy.float64)
+        percentile10   = list(map(lambda x: round(x[2], 3) if x[2] else x[2], powerData))
+        percentile90   = list(map(lambda x: round(x[3], 3) if x[3] else x[3], powerData))
+        # Samples without both the 10th and 90th percentiles use the margin instead
+        usePercentiles = numpy.array(list(map(lambda x: bool(x[0] and x[1]), zip(percentile10, percentile90))), dtype=bool)
+        percentiles    = numpy.column_stack([numpy.array(list(map(lambda x: x if x else 0.0, percentile10)), dtype=numpy.float64),
+                                             percentile50,
+                                             numpy.array(list(map(lambda x: x if x else 0.0, percentile90)), dtype=numpy.float64)])
+        estimates      = percentiles @ self.weights.T if len(powerData) else numpy.zeros((0, 2))
+        minEstimates   = SolarForecastBuilder.roundAll(numpy.where(usePercentiles, estimates[:, 0], percentile50 * self.margin))
+        maxEstimates   = SolarForecastBuilder.roundAll(numpy.where(usePercentiles, estimates[:, 1], percentile50))
+        power          = SolarForecastBuilder.roundAll(percentile50)
+        # Pick out the samples we output, and apply the tuning models
+        sampleIdxs   = [idx for idx in range(len(powerData) - 1) if power[idx]]
+        startTimes   = list(map(lambda x: powerData[x][0],     sampleIdxs))
+        endTimes     = list(map(lambda x: powerData[x + 1][0], sampleIdxs))
+        keys         = list(map(lambda x: (x[0].astimezone(timezone.utc).replace(year=2000, month=1, day=1),
+                                           x[1].astimezone(timezone.utc).replace(year=2000, month=1, day=1)), zip(startTimes, endTimes)))
+        (slopes, intercepts, hasModel) = SolarForecastBuilder.modelCoeffs(models, keys)
+        untuned      = power[sampleIdxs]
+        tune         = lambda x: numpy.where(hasModel, SolarForecastBuilder.roundAll(numpy.maximum(slopes * x + intercepts, 0)), x)
+        tuned        = numpy.column_stack([tune(untuned), tune(minEstimates[sampleIdxs]), tune(maxEstimates[sampleIdxs])])
+        metaData     = list(map(lambda x: (percentile10[x], float(power[x]), percentile90[x]), sampleIdxs))
+        untunedData  = list(zip(startTimes, endTimes, untuned.tolist()))
+        tunedData    = list(map(lambda x: (x[0], x[1], *x[2], x[3]), zip(startTimes, endTimes, tuned.tolist(), metaData)))
+        # Sum the tuned values for each day
+        (days, dayIdxs) = numpy.unique(list(map(lambda x: x.date().toordinal(), startTimes)), return_inverse=True)
+        dayTotals       = numpy.column_stack(list(map(lambda x: numpy.bincount(dayIdxs, weights=tuned[:, x], minlength=len(days)), range(3))))
+        dailyTotals     = dict(map(lambda x: (date.fromordinal(int(x[0])), x[1]), zip(days.tolist(), dayTotals.tolist())))
+        return (untunedData, tunedData, dailyTotals)
+
+
+
+class SolarTuner():
+    # Fits the models used to tune the solar forecast from the history of (estimated actuals, production)
+    # pairs. There's a linear model for each time of day, and the fits for all the times of day are done
+    # at once by summing the centred data for each time of day with bincount. Plotting the models is kept
+    # separate (see SolarTuningPlotter) so it doesn't hold up the fitting.
+    def __init__(self, minSamples=7):
+        self.minSamples = minSamples
+
+
+    def fit(self, pairedValues):
+        # Returns a dict of the models to use (by time of day), and a dict of the data and model for every
+        # time of day (including those without enough data to use) for plotting
+        keyIdxs = {}
+        idxs    = numpy.array(list(map(lambda x: keyIdxs.setdefault((x[0].replace(year=2000, month=1, day=1),
+                                                                       x[1].replace(year=2000, month=1, day=1)), len(keyIdxs)),
+                                       pairedValues)), dtype=numpy.int64)
+        estimatedActuals = numpy.array(list(map(lambda x: x[2], pairedValues)), dtype=numpy.float64)
+        production       = numpy.array(list(map(lambda x: x[3], pairedValues)), dtype=numpy.float64)
+        # Filter out obviously wrong values
+        keep             = (estimatedActuals < 0.75) | (production != 0)
+        (idxs, estimatedActuals, production) = (idxs[keep], estimatedActuals[keep], production[keep])
+        numKeys          = len(keyIdxs)
+        groupSum         = lambda x: numpy.bincount(idxs, weights=x, minlength=numKeys)
+        counts           = numpy.bincount(idxs, minlength=numKeys)
+        meanX            = groupSum(estimatedActuals) / numpy.maximum(counts, 1)
+        meanY            = groupSum(production)       / numpy.maximum(counts, 1)
+        centredX         = estimatedActuals - meanX[idxs]
+        centredY         = production       - meanY[idxs]
+        varianceX        = groupSum(centredX * centredX)
+        # If all the estimates for a time of day are the same the best we can do is the average production
+        slopes           = numpy.where(varianceX > 0, groupSum(centredX * centredY) / numpy.where(varianceX > 0, varianceX, 1), 0.0)
+        intercepts       = meanY - slopes * meanX
+        # Split the data up by time of day for the plots
+        order            = numpy.argsort(idxs, kind='stable')
+        splits           = numpy.cumsum(counts)[:-1]
+        groupX           = numpy.split(estimatedActuals[order], splits)
+        groupY           = numpy.split(production[order],       splits)
+        models           = {}
+        fits             = {}
+        for (key, keyIdx) in keyIdxs.items():
+            if counts[keyIdx] == 0:
+                continue
+            model = numpy.poly1d([slopes[keyIdx], intercepts[keyIdx]])
+            fits[key] = (groupX[keyIdx], groupY[keyIdx], model)
+            # Don't publish the model to use in tuning forecasts if we don't have many points
+            if counts[keyIdx] >= self.minSamples:
+                models[key] = model
+        return (models, fits)
+
+
+
+class SolarTuningPlotter():
+    # Saves a small graph of the tuning data and model for each time of day. The plots are rendered on a
+    # background thread, one set at a time, so they don't hold up the callback that fitted the models.
+    # The thread (and matplotlib) are only started / imported when the first set of plots is submitted.
+    def __init__(self, path):
+        self.path     = path
+        self.executor = None
+
+
+    def submit(self, fits):
+        if self.executor is None:
+            import concurrent.futures
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        return self.executor.submit(self.render, fits)
+
+
+    def render(self, fits):
+        # The object oriented interface is used rather than pyplot, as pyplot isn't safe to use off the main thread
+        from matplotlib.figure import Figure
+        # Make sure the plot output dir exists
+        os.makedirs(self.path, exist_ok=True)
+        for (key, (estimatedActuals, production, model)) in fits.items():
+            polyline = numpy.linspace(0, max(estimatedActuals), 50)
+            figure   = Figure()
+            axes     = figure.subplots()
+            axes.scatter(estimatedActuals, production)
+            axes.plot(polyline, model(polyline))
+            figure.savefig(self.path + "/{0:%H-%M}.png".format(key[0].astimezone()))
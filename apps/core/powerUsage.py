@@ -0,0 +1,68 @@
+from datetime   import timedelta
+from core.powerSeries import ColumnSeries
+import numpy
+
+
+
+class UsageForecaster():
+    # Builds the house usage forecast from the usage (and eddi) history. Rather than looking up each slot
+    # on each day of history with powerForPeriod, the history is summed into half hour bins once, giving a
+    # matrix with a row per day of history and a column per slot. The forecast for each slot is then a
+    # weighted average of its column. The weights allow recent days to count for more than older days
+    # (usageHistoryDecay is the weight of each day relative to the day after it), and days of the other
+    # type (weekday or weekend) to count for less than days of the same type as the day being forecast
+    # (usageOtherDayTypeWeight). Both default to 1, which gives a plain average.
+    def __init__(self, args):
+        self.daysHistory        = int(args['usageDaysHistory'])
+        self.margin             = float(args['houseLoadMargin'])
+        self.decay              = float(args.get('usageHistoryDecay', 1.0))
+        self.otherDayTypeWeight = float(args.get('usageOtherDayTypeWeight', 1.0))
+        self.slotLength         = timedelta(minutes=30)
+        self.slotsPerDay        = int(timedelta(days=1) / self.slotLength)
+
+
+    def isWeekend(day):
+        return day.weekday() >= 5
+
+
+    def dayWeights(self, forecastDay, historyStartDay):
+        # The weight of each day of history (oldest first) for the forecast day
+        weights = []
+        for dayIdx in range(self.daysHistory):
+            historyDay = historyStartDay + timedelta(days=dayIdx)
+            weight     = self.decay ** (self.daysHistory - 1 - dayIdx)
+            if UsageForecaster.isWeekend(historyDay) != UsageForecaster.isWeekend(forecastDay):
+                weight = weight * self.otherDayTypeWeight
+            weights.append(weight)
+        weights = numpy.array(weights)
+        # If all the days are the other type, and those are turned off, fallback to a plain average
+        if weights.sum() <= 0:
+            weights = numpy.ones(self.daysHistory)
+        return weights / weights.sum()
+
+
+    def history(self, series, startTime):
+        # The total of the series in each slot of each day of history, as a (days x slots) matrix
+        if not series:
+            return numpy.zeros((self.daysHistory, self.slotsPerDay))
+        totals = ColumnSeries.fromSeries(series, 1).binTotals(startTime.timestamp(), self.slotLength.total_seconds(),
+                                                              self.daysHistory * self.slotsPerDay)
+        return totals.reshape(self.daysHistory, self.slotsPerDay)
+
+
+    def forecast(self, usageData, eddiData, forecastStartTime, numDays=2):
+        # Returns the usage forecast for numDays days from forecastStartTime (which should be the start of
+        # a day). We subtract the eddi usage from the total usage, as we explicitly plan the eddi usage
+        # seperately, and don't want it distorting the usage totals.
+        historyStartTime = forecastStartTime - timedelta(days=self.daysHistory)
+        slotUsage        = self.history(usageData, historyStartTime) - self.history(eddiData, historyStartTime)
+        forecastUsage    = []
+        slotStartTime    = forecastStartTime
+        for dayIdx in range(numDays):
+            forecastDay = forecastStartTime + timedelta(days=dayIdx)
+            avgUsage    = (self.dayWeights(forecastDay, historyStartTime) @ slotUsage) * self.margin
+            for usage in avgUsage.tolist():
+                slotEndTime = slotStartTime + self.slotLength
+                forecastUsage.append((slotStartTime, slotEndTime, usage))
+                slotStartTime = slotEndTime
+        return forecastUsage
@@ -1,18 +1,168 @@
 from datetime   import datetime
 from datetime   import timedelta
 from datetime   import timezone
+import logging
 import re
 import math
+import bisect
+
+
+
+class IndexedSeries(list):
+    # A series (list of (start, end, value...) tuples) that's kept sorted by start time, and maintains 
+    # a lazily built index of the start / end times. This lets us bisect to find the samples that 
+    # overlap a time range rather than having to scan the whole series. The index is thrown away 
+    # whenever the series is modified, and rebuilt on the next lookup.
+    def __init__(self, series=()):
+        super().__init__(series)
+        super().sort(key=lambda x: x[0])
+        self.index = None
+
+
+    def invalidate(self):
+        self.index = None
+
+
+    def getIndex(self):
+        if self.index is None:
+            starts = [x[0] for x in self]
+            ends   = [x[1] for x in self]
+            # We can only bisect if the end times are also in order, which is the case for all the
+            # non-overlapping series we deal with. If not, the index is marked as unusable and 
+            # lookups fallback to scanning the whole series. 
+            if all(a <= b for a, b in zip(ends, ends[1:])):
+                self.index = (starts, ends)
+            else:
+                self.index = False
+        return self.index
+
+
+    def overlapRange(self, startTime, endTime):
+        # Returns the index range of the samples that could contribute to the given time range.
+        index = self.getIndex()
+        if index:
+            return (bisect.bisect_left(index[1], startTime), bisect.bisect_right(index[0], endTime))
+        return (0, len(self))
+
+
+    def append(self, item):
+        # Insert rather than append so the series stays sorted
+        super().insert(bisect.bisect_right(self, item[0], key=lambda x: x[0]), item)
+        self.index = None
+
+
+    def extend(self, items):
+        super().extend(items)
+        super().sort(key=lambda x: x[0])
+        self.index = None
+
+
+    def insert(self, idx, item):
+        super().insert(idx, item)
+        self.index = None
+
+
+    def remove(self, item):
+        super().remove(item)
+        self.index = None
+
+
+    def pop(self, *args):
+        self.index = None
+        return super().pop(*args)
+
+
+    def clear(self):
+        super().clear()
+        self.index = None
+
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self.index = None
+
+
+    def reverse(self):
+        super().reverse()
+        self.index = None
+
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.index = None
+
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.index = None
+
+
+    def __iadd__(self, items):
+        self.extend(items)
+        return self
+
+
+
+class RenderedSeries():
+    # A series that's formatted the first time it's output, and then shared by everything that outputs it
+    # (EG the log and the entity attributes), so it's only merged and formatted once. The formatted lines
+    # are joined with whatever new line string the output needs.
+    def __init__(self, utils, series, mergeable=False):
+        self.utils     = utils
+        self.series    = series
+        self.mergeable = mergeable
+        self.merged    = None
+        self.lines     = None
+
+
+    def mergedSeries(self):
+        if self.merged is None:
+            self.merged = self.utils.mergeSeries(self.series) if self.mergeable else self.series
+        return self.merged
+
+
+    def formattedLines(self):
+        if self.lines is None:
+            self.lines = self.utils.seriesToLines(self.mergedSeries())
+        return self.lines
+
+
+    def join(self, newLineStr):
+        return newLineStr.join(self.formattedLines())
+
+
+    def __str__(self):
+        return self.join("\n")
 
 
 
 class PowerUtils():
-    def __init__(self, log):
-        self.log = log
+    def __init__(self, log, logger=None):
+        self.log    = log
+        # The logger that the log function writes to, if we have it. It's used to skip formatting 
+        # anything that won't be logged.
+        self.logger = logger
+
+
+    def logLevelEnabled(self, level):
+        return self.logger.isEnabledFor(logging.getLevelName(level)) if self.logger else True
 
         
+    def indexSeries(self, series):
+        # Wrap the series in an index so it can be searched quickly. We only do this if the series is 
+        # already sorted, otherwise sorting it could change the result of overlapping lookups.
+        if not isinstance(series, IndexedSeries):
+            if all(a[0] <= b[0] for a, b in zip(series, series[1:])):
+                series = IndexedSeries(series)
+        return series
+
+
     def powerForPeriod(self, data, startTime, endTime, valueIdxOffset=0):
         power = 0.0
+        # If the series is indexed only look at the samples that overlap the time range
+        if isinstance(data, IndexedSeries):
+            (startIdx, endIdx) = data.overlapRange(startTime, endTime)
+            data               = map(data.__getitem__, range(startIdx, endIdx))
         for forecastPeriod in data:
             forecastStartTime = forecastPeriod[0]
             forecastEndTime   = forecastPeriod[1]
@@ -42,16 +192,21 @@ class PowerUtils():
 
 
     def opOnSeries(self, a, b, operation, aValueIdxOffset=0, bValueIdxOffset=0):
-        return list(map(lambda aSample: ( aSample[0], 
-                                          aSample[1], 
-                                          operation(aSample[2+aValueIdxOffset], 
-                                                    self.powerForPeriod(b, aSample[0], aSample[1], bValueIdxOffset)) ),
-                        a))
+        b      = self.indexSeries(b)
+        output = map(lambda aSample: ( aSample[0], 
+                                       aSample[1], 
+                                       operation(aSample[2+aValueIdxOffset], 
+                                                 self.powerForPeriod(b, aSample[0], aSample[1], bValueIdxOffset)) ),
+                     a)
+        # Preserve the indexing of the input series, the output has the same times so is still sorted
+        return IndexedSeries(output) if isinstance(a, IndexedSeries) else list(output)
 
 
     def seriesToString(self, series, newLineStr, mergeable=False):
-        if mergeable:
-            series = self.mergeSeries(series)
+        return RenderedSeries(self, series, mergeable).join(newLineStr)
+
+
+    def seriesToLines(self, series):
         formatStr = "{0:%d %B %H:%M} -> {1:%H:%M} :"
         # Look at the types of the first element of the series to build the rest of the format string
         if series:
@@ -61,8 +216,7 @@ class PowerUtils():
                     formatStr = formatStr + " {{{0}:.3f}}".format(valueIdx)
                 else:
                     formatStr = formatStr + " {{{0}}}".format(valueIdx)            
-        strings = map(lambda x: formatStr.format(*x), series)
-        return newLineStr.join(strings)
+        return list(map(lambda x: formatStr.format(*x), series))
 
 
     def mergeSeries(self, series):
@@ -83,7 +237,15 @@ class PowerUtils():
 
 
     def printSeries(self, series, title, mergeable=False, level="WARNING"):
-        self.log(title + ":\n" + self.seriesToString(series, "\n", mergeable), level=level)
+        # Nothing is formatted unless the level is enabled. The series can be a RenderedSeries, so the 
+        # formatting is shared with other outputs, or a function that returns the series if its 
+        # expensive to generate.
+        if self.logLevelEnabled(level):
+            if callable(series):
+                series = series()
+            if not isinstance(series, RenderedSeries):
+                series = RenderedSeries(self, series, mergeable)
+            self.log(title + ":\n" + series.join("\n"), level=level)
         
         
     def combineSeries(self, baseSeries, *args):
@@ -93,4 +255,4 @@ class PowerUtils():
             for extraSeries in args:
                 outputElement.append(extraSeries[idx][2])
             output.append(tuple(outputElement))
-        return output
\ No newline at end of file
+        return IndexedSeries(output) if isinstance(baseSeries, IndexedSeries) else output
\ No newline at end of file
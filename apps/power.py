@@ -2,13 +2,18 @@ import hassapi as hass
 from datetime   import datetime
 from datetime   import timedelta
 from datetime   import timezone
-from statistics import mean
 from core.powerCore  import PowerControlCore
 from core.powerUtils import PowerUtils
+from core.powerUsage import UsageForecaster
+from core.powerHistory import HistoryStore
+from core.powerHistory import HistoryJoin
+from core.powerHistory import SampleLog
+from core.powerSolar import SolarForecastBuilder
+from core.powerSolar import SolarTuner
+from core.powerSolar import SolarTuningPlotter
+from core.powerDiagnostics import timedRun
 import re
 import math
-import numpy
-import matplotlib.pyplot as plt
 import json
 import os
 import importlib
@@ -21,12 +26,13 @@ import sys
 class PowerControl(hass.Hass):
     def initialize(self):
         self.log("Starting with arguments " + str(self.args))        
-        self.core                              = PowerControlCore(self.args, self.log)
-        self.utils                             = PowerUtils(self.log) 
+        self.core                              = PowerControlCore(self.args, self.log, self.get_main_log())
+        self.utils                             = PowerUtils(self.log, self.get_main_log()) 
         self.solarForecastMargin               = float(self.args['solarForecastMargin'])
         self.solarForecastLowPercentile        = float(self.args['solarForecastLowPercentile'])
         self.solarForecastHighPercentile       = float(self.args['solarForecastHighPercentile'])
-        self.usageMargin                       = float(self.args['houseLoadMargin'])
+        self.solarForecastBuilder              = SolarForecastBuilder(self.solarForecastLowPercentile, self.solarForecastHighPercentile, self.solarForecastMargin)
+        self.usageForecaster                   = UsageForecaster(self.args)
         self.houseLoadEntityName               = self.args['houseLoadEntity']
         self.usageDaysHistory                  = self.args['usageDaysHistory']
         self.eddiOutputEntityName              = self.args['eddiOutputEntity']
@@ -37,32 +43,35 @@ class PowerControl(hass.Hass):
         self.batteryPlanSummaryEntityName      = self.args['batteryPlanSummaryEntity']
         self.prevMaxChargeCostEntity           = self.args['batteryChargeCostEntity']
         self.batOutputTimeOffset               = timedelta(seconds=int(self.args['batteryOutputTimeOffset']))
+        self.diagnosticsEntityName             = self.args.get('diagnosticsEntity')
         self.solarTuningDaysHistory            = 14
-        self.solarActualsFileName              = "/conf/solarActuals.json" 
-        self.solarProductionFileName           = "/conf/solarProduction.json" 
+        self.solarActualsLog                   = SampleLog("/conf/solarActuals.bin")
+        self.solarProductionLog                = SampleLog("/conf/solarProduction.bin")
         self.solarTuningPath                   = "/conf/solarTuning"
+        self.historyStore                      = HistoryStore(self.args.get('historyStoreFile', "/conf/powerHistory.db"))
+        self.historyFetchTimeout               = int(self.args.get('historyFetchTimeout', 30))
         self.prevSolarLifetimeProd             = None
         self.prevSolarLifetimeProdTime         = None
         self.solarTuningModels                 = {}
+        self.solarTuner                        = SolarTuner()
+        self.solarTuningPlotter                = SolarTuningPlotter(self.solarTuningPath) if self.args.get('solarTuningPlots', True) else None
+        self.solarTuningPlotDelay              = 5*60
         self.rawSolarData                      = []
         self.solarDataUntuned                  = []
         self.tariffOverrides                   = {'gas':    {},
                                                   'export': {},
                                                   'import': {}}
 
-        # Leads the solar actuals if there's available
-        self.solarActuals = {}
-        if os.path.isfile(self.solarActualsFileName):
-            with open(self.solarActualsFileName) as file:
-                self.solarActuals = dict(map(lambda x: (int(x[0]), x[1]), json.load(file).items()))
-        # Do the same for the solar production
-        self.solarProduction = []
-        if os.path.isfile(self.solarProductionFileName):
-            with open(self.solarProductionFileName) as file:
-                self.solarProduction = list(map(lambda x: (datetime.fromtimestamp(int(x[0])).astimezone(timezone.utc), 
-                                                           datetime.fromtimestamp(int(x[1])).astimezone(timezone.utc),
-                                                           x[2]), json.load(file)))                
-        self.updateSolarTuning()
+        # Loads the solar actuals and production if there's any available. They used to be saved as JSON, so
+        # if we've not got a log yet start it off with the JSON data.
+        self.importSolarJson(self.solarActualsLog,    "/conf/solarActuals.json",    lambda x: map(lambda y: (int(y[0]), int(y[1][0]), y[1][1]), x.items()))
+        self.importSolarJson(self.solarProductionLog, "/conf/solarProduction.json", lambda x: map(lambda y: (int(y[0]), int(y[1]), y[2]), x))
+        self.solarActuals    = dict(map(lambda x: (x[0], [x[1], x[2]]), self.solarActualsLog.load().tolist()))
+        self.solarProduction = list(map(lambda x: (datetime.fromtimestamp(x[0], timezone.utc), 
+                                                   datetime.fromtimestamp(x[1], timezone.utc),
+                                                   x[2]), self.solarProductionLog.load().tolist()))
+        # The plots aren't needed for the first plan, so they're left until the app's settled down
+        self.updateSolarTuning(plotDelay=self.solarTuningPlotDelay)
         # Setup getting the solar forecast data
         solarTodayEntityName    = self.args['solarForecastTodayEntity']
         solarTomorrowEntityName = self.args['solarForecastTomorrowEntity']
@@ -140,11 +149,17 @@ class PowerControl(hass.Hass):
         while startTime < now:
             startTime = startTime + period
         # Schedule an update of the eddi usage info just before the update of the main outputs. This way we won't delay 
-        # the main computation if the eddi update takes time    
-        self.run_every(self.fastEddiHistoryCallBack1, startTime - timedelta(minutes=1), 30*60)
+        # the main computation if the eddi update takes time. The fetch gives up after the timeout, so its always done
+        # by the time the outputs are updated.
+        self.run_every(self.updateEddiHistory, startTime - timedelta(seconds=self.historyFetchTimeout + 5), 30*60)
         self.run_every(self.updateOutputs, startTime, 30*60)
         
 
+    def terminate(self):
+        # Stop the discharge trial workers (if they were started) when the app is reloaded or stopped
+        self.core.closeDischargeTrialPool()
+
+
     def recordSolarProduction(self, kwargs):
         curSolarLifetimeProd     = float(self.get_state(self.solarLifetimeProdEntityName))
         curSolarLifetimeProdTime = datetime.now(datetime.now(timezone.utc).astimezone().tzinfo)
@@ -154,10 +169,8 @@ class PowerControl(hass.Hass):
             production = curSolarLifetimeProd - self.prevSolarLifetimeProd
             if production:
                 self.solarProduction.append((self.prevSolarLifetimeProdTime, curSolarLifetimeProdTime, production))
-                # Output the updated data to the file for long term persistence
-                with open(self.solarProductionFileName, 'w') as file:
-                    saveData = list(map(lambda x: (x[0].timestamp(), x[1].timestamp(), x[2]), self.solarProduction))
-                    json.dump(saveData, file, ensure_ascii=False)
+                # Add the sample to the log for long term persistence
+                self.solarProductionLog.append([(int(self.prevSolarLifetimeProdTime.timestamp()), int(curSolarLifetimeProdTime.timestamp()), production)])
                 
         # Rotate the vars for next time
         self.prevSolarLifetimeProd     = curSolarLifetimeProd
@@ -165,43 +178,33 @@ class PowerControl(hass.Hass):
             
 
     def updateOutputs(self, kwargs):
+        self.updatePlanOutputs()
+        # The stage timings are published after the run has finished, so they cover all of it
+        if self.diagnosticsEntityName:
+            diagnostics              = self.core.stageTimer.summary()
+            diagnostics["planCache"] = self.core.planCache.summary()
+            self.set_state(self.diagnosticsEntityName, state=diagnostics.get("lastRun", {}).get("totalMs", 0), 
+                           attributes=diagnostics)
+
+
+    @timedRun(lambda self: self.core.stageTimer)
+    def updatePlanOutputs(self):
         self.log("Updating outputs")
         # Adjust for the time offset that was applied when this function was scheduled.
         now                     = datetime.now(datetime.now(timezone.utc).astimezone().tzinfo) - self.batOutputTimeOffset
         maxChargeCost           = float(self.get_state(self.prevMaxChargeCostEntity))
         self.core.maxChargeCost = maxChargeCost
-        self.core.save(now)
+        with self.core.stageTimer.stage("saveState"):
+            self.core.save(now)
         self.core.mergeAndProcessData(now)
         # The time 15 minutes in the future (ie the middle of a time slot) to find a 
         # slot that starts now. This avoids any issues with this event firing a little 
         # early / late.
         slotMidTime              = now + timedelta(minutes=15)
-        dischargeExportSolarInfo = next(filter(lambda x: x[0] < slotMidTime and slotMidTime < x[1], self.core.dischargeExportSolarPlan), None)
-        dischargeToGridInfo      = next(filter(lambda x: x[0] < slotMidTime and slotMidTime < x[1], self.core.dischargeToGridPlan),      None)
-        gridChargeInfo           = next(filter(lambda x: x[0] < slotMidTime and slotMidTime < x[1], self.core.gridChargingPlan),         None)
-        houseGridPowerdeInfo     = next(filter(lambda x: x[0] < slotMidTime and slotMidTime < x[1], self.core.houseGridPoweredPlan),     None)
-        solarChargeInfo          = next(filter(lambda x: x[0] < slotMidTime and slotMidTime < x[1], self.core.solarChargingPlan),        None)
-        standbyInfo              = next(filter(lambda x: x[0] < slotMidTime and slotMidTime < x[1], self.core.standbyPlan),              None)
-        modeInfo                 = ("Discharge"          if dischargeExportSolarInfo else
-                                    "Discharge to grid"  if dischargeToGridInfo      else
-                                    "Standby"            if standbyInfo              else 
-                                    "Grid charge"        if gridChargeInfo           else 
-                                    "House grid powered" if houseGridPowerdeInfo     else "Solar charge")        
-        eddiSolarInfo            = next(filter(lambda x: x[0] < slotMidTime and slotMidTime < x[1], self.core.eddiSolarPlan), None)
-        eddiGridInfo             = next(filter(lambda x: x[0] < slotMidTime and slotMidTime < x[1], self.core.eddiGridPlan),  None)
-        eddiInfo                 = ("boost" if eddiGridInfo  else
-                                    "on"    if eddiSolarInfo else "off")
+        (modeInfo, eddiInfo, _, chargeCost) = self.core.decisions.decisionAt(slotMidTime)
         # generate a summary string for the combined plan
-        summary                  = ( list(map(lambda x: ("D", x[0]), self.utils.mergeSeries(self.core.dischargeExportSolarPlan))) +
-                                     list(map(lambda x: ("E", x[0]), self.utils.mergeSeries(self.core.dischargeToGridPlan)))      +
-                                     list(map(lambda x: ("C", x[0]), self.utils.mergeSeries(self.core.solarChargingPlan)))        +
-                                     list(map(lambda x: ("G", x[0]), self.utils.mergeSeries(self.core.gridChargingPlan)))         +
-                                     list(map(lambda x: ("H", x[0]), self.utils.mergeSeries(self.core.houseGridPoweredPlan)))     +
-                                     list(map(lambda x: ("S", x[0]), self.utils.mergeSeries(self.core.standbyPlan)))              +
-                                     list(map(lambda x: ("B", x[0]), self.utils.mergeSeries(self.core.dischargeToHousePlan))) )
-        summary.sort(key=lambda x: x[1])
-        summary                  = list(map(lambda x: "{0}{1:%H%M}".format(*x)[:-1], summary))
-        summary                  = ",".join(summary)
+        renderedPlans            = self.core.renderedPlans
+        summary                  = self.core.decisions.summary()
 
         # Update the prev max charge cost. We do this by resetting it aronud 4:30pm (when 
         # we've got the rate data for the next day), and updating if if we're starting a 
@@ -210,45 +213,40 @@ class PowerControl(hass.Hass):
             prevMaxChargeCost = 0
         else:
             prevMaxChargeCost = maxChargeCost
-        if solarChargeInfo:
-            curRrate          = next(filter(lambda x: x[0] < slotMidTime and slotMidTime < x[1], self.core.exportRateData), 0)
-            prevMaxChargeCost = max(prevMaxChargeCost, curRrate[2] / self.core.batEfficiency)
-        elif gridChargeInfo:
-            curRrate          = next(filter(lambda x: x[0] < slotMidTime and slotMidTime < x[1], self.core.importRateData), 0)
-            prevMaxChargeCost = max(prevMaxChargeCost, curRrate[2] / self.core.batEfficiency)
-        elif houseGridPowerdeInfo:
-            curRrate          = next(filter(lambda x: x[0] < slotMidTime and slotMidTime < x[1], self.core.importRateData), 0)
-            prevMaxChargeCost = max(prevMaxChargeCost, curRrate[2])
-        self.set_state(self.prevMaxChargeCostEntity, state=prevMaxChargeCost)
-
-        self.set_state(self.batteryPlanSummaryEntityName, state=summary, attributes={"summary":                  self.core.gridSummary,
-                                                                                     "maxChargeCost":            self.core.maxChargeCost,
-                                                                                     "importProfile":            self.core.importProfileISO,
-                                                                                     "exportProfile":            self.core.exportProfileISO,
-                                                                                     "importRates":              self.core.importRateDataISO,
-                                                                                     "exportRates":              self.core.exportRateDataISO})
-        self.set_state(self.batteryModeOutputEntityName, state=modeInfo, attributes={"planUpdateTime":           self.core.planUpdateTime,
-                                                                                     "stateUpdateTime":          now,
-                                                                                     "dischargeExportSolarPlan": self.utils.seriesToString(self.core.dischargeExportSolarPlan, "<br/>", mergeable=True),
-                                                                                     "dischargeToGridPlan":      self.utils.seriesToString(self.core.dischargeToGridPlan,      "<br/>", mergeable=True),
-                                                                                     "dischargeToHousePlan":     self.utils.seriesToString(self.core.dischargeToHousePlan,     "<br/>", mergeable=True),
-                                                                                     "solarChargingPlan":        self.utils.seriesToString(self.core.solarChargingPlan,        "<br/>", mergeable=True),
-                                                                                     "gridChargingPlan":         self.utils.seriesToString(self.core.gridChargingPlan,         "<br/>", mergeable=True),
-                                                                                     "houseGridPoweredPlan":     self.utils.seriesToString(self.core.houseGridPoweredPlan,     "<br/>", mergeable=True),
-                                                                                     "standbyPlan":              self.utils.seriesToString(self.core.standbyPlan,              "<br/>", mergeable=True),
-                                                                                     "tariff":                   self.core.pwTariff,
-                                                                                     "defPrice":                 self.core.defPrice})
-        self.set_state(self.eddiOutputEntityName,        state=eddiInfo, attributes={"planUpdateTime":           self.core.planUpdateTime,
-                                                                                     "stateUpdateTime":          now,
-                                                                                     "solarPlan":                self.utils.seriesToString(self.core.eddiSolarPlan, "<br/>", mergeable=True),
-                                                                                     "gridPlan":                 self.utils.seriesToString(self.core.eddiGridPlan,  "<br/>", mergeable=True)})
+        if chargeCost is not None:
+            prevMaxChargeCost = max(prevMaxChargeCost, chargeCost)
+        with self.core.stageTimer.stage("publishOutputs"):
+            self.set_state(self.prevMaxChargeCostEntity, state=prevMaxChargeCost)
+
+            self.set_state(self.batteryPlanSummaryEntityName, state=summary, attributes={"summary":                  self.core.gridSummary,
+                                                                                         "maxChargeCost":            self.core.maxChargeCost,
+                                                                                         "importProfile":            self.core.importProfileISO,
+                                                                                         "exportProfile":            self.core.exportProfileISO,
+                                                                                         "importRates":              self.core.importRateDataISO,
+                                                                                         "exportRates":              self.core.exportRateDataISO})
+            self.set_state(self.batteryModeOutputEntityName, state=modeInfo, attributes={"planUpdateTime":           self.core.planUpdateTime,
+                                                                                         "stateUpdateTime":          now,
+                                                                                         "dischargeExportSolarPlan": renderedPlans["dischargeExportSolarPlan"].join("<br/>"),
+                                                                                         "dischargeToGridPlan":      renderedPlans["dischargeToGridPlan"].join("<br/>"),
+                                                                                         "dischargeToHousePlan":     renderedPlans["dischargeToHousePlan"].join("<br/>"),
+                                                                                         "solarChargingPlan":        renderedPlans["solarChargingPlan"].join("<br/>"),
+                                                                                         "gridChargingPlan":         renderedPlans["gridChargingPlan"].join("<br/>"),
+                                                                                         "houseGridPoweredPlan":     renderedPlans["houseGridPoweredPlan"].join("<br/>"),
+                                                                                         "standbyPlan":              renderedPlans["standbyPlan"].join("<br/>"),
+                                                                                         "tariff":                   self.core.pwTariff,
+                                                                                         "defPrice":                 self.core.defPrice})
+            self.set_state(self.eddiOutputEntityName,        state=eddiInfo, attributes={"planUpdateTime":           self.core.planUpdateTime,
+                                                                                         "stateUpdateTime":          now,
+                                                                                         "solarPlan":                renderedPlans["eddiSolarPlan"].join("<br/>"),
+                                                                                         "gridPlan":                 renderedPlans["eddiGridPlan"].join("<br/>")})
         # Update the solar actuals and tuning at the end of the day
         if now.hour == 23 and now.minute > 15 and now.minute < 45:
-            self.updateSolarActuals(now)
-            self.updateSolarTuning()
+            with self.core.stageTimer.stage("solarTuning"):
+                self.updateSolarActuals(now)
+                self.updateSolarTuning()
 
 
-    def updateSolarTuning(self):
+    def updateSolarTuning(self, plotDelay=0):
         # Convert to a series array so we can use all the normal utilitiy functions
         solarActualsSeries = list(map(lambda x: (datetime.fromtimestamp(x[0]).astimezone(timezone.utc), 
                                                  datetime.fromtimestamp(x[1][0]).astimezone(timezone.utc), 
@@ -259,35 +257,10 @@ class PowerControl(hass.Hass):
         # (and for the same times) as the actuals series. Then combine it with the estimated actuals series.
         pairedValues = self.utils.combineSeries(solarActualsSeries,
                                                 self.utils.opOnSeries(solarActualsSeries, self.solarProduction, lambda a, b: b))
-        # Combine all the samples for each timeslot
-        timeSlots = {}
-        for pair in pairedValues:
-            key = (pair[0].replace(year=2000, month=1, day=1), 
-                   pair[1].replace(year=2000, month=1, day=1))
-            if key not in timeSlots:
-                timeSlots[key] = []
-            timeSlots[key].append((pair[2], pair[3]))
-        
-        # Make sure the plot output dir exists
-        if not os.path.exists(self.solarTuningPath):
-            os.mkdir(self.solarTuningPath)
-        # Now go through each time slot and creaty a model that best fits the data
-        models = {}
-        for key, data in timeSlots.items():
-            # Filter out obviously wrong values and seperate out the data, and fit the model
-            data             = list(filter(lambda x: x[0] < 0.75 or x[1], data))            
-            estimatedActuals = list(map(lambda x: x[0], data))
-            production       = list(map(lambda x: x[1], data))
-            model            = numpy.poly1d(numpy.polyfit(estimatedActuals, production, 1))
-            # Don't publish the model to use in turing forecasts if we don't have many points
-            if len(data) >= 7:
-                models[key] = model            
-            # Now we have the model, plot and save a small graph showing the tuning profile
-            polyline = numpy.linspace(0, max(estimatedActuals), 50) 
-            plt.scatter(estimatedActuals, production)
-            plt.plot(polyline, model(polyline))
-            plt.savefig(self.solarTuningPath + "/{0:%H-%M}.png".format(key[0].astimezone()))
-            plt.close()
+        # Fit a model for each time slot, and save a small graph of each one showing the tuning profile
+        (models, fits) = self.solarTuner.fit(pairedValues)
+        if self.solarTuningPlotter:
+            self.run_in(lambda kwargs: self.solarTuningPlotter.submit(fits), plotDelay)
         
         # Update the global models
         self.solarTuningModels = models
@@ -295,21 +268,34 @@ class PowerControl(hass.Hass):
 
     def updateSolarActuals(self, now):
         # Add any current estimated actuals to the main history dict. We do most of the storage 
-        # and manipulation as a dict so its quick to insert, delete, and search for items.
+        # and manipulation as a dict so its quick to insert, delete, and search for items. Only
+        # the new or changed samples are added to the log, to preserve them accross restarts.
+        newSamples = []
         for solarSample in self.solarDataUntuned:
             if solarSample[0] < now:
                 startTime = int(solarSample[0].timestamp())
                 endTime   = int(solarSample[1].timestamp())
-                self.solarActuals[startTime] = [endTime, solarSample[2]]
-        # Filter out any really old samples
-        discardTime = (now - timedelta(days=self.solarTuningDaysHistory)).timestamp()
+                if self.solarActuals.get(startTime) != [endTime, solarSample[2]]:
+                    self.solarActuals[startTime] = [endTime, solarSample[2]]
+                    newSamples.append((startTime, endTime, solarSample[2]))
+        self.solarActualsLog.append(newSamples)
+        # Filter out any really old samples, the production samples are only used to tune the forecast 
+        # against the actuals, so they're kept for the same time
+        discardTime = int((now - timedelta(days=self.solarTuningDaysHistory)).timestamp())
         for key in list(self.solarActuals.keys()):
             if key < discardTime:
                 del self.solarActuals[key] 
-        
-        # Save the new data off to a file so we preserve it accross restarts    
-        with open(self.solarActualsFileName, 'w') as file:
-            json.dump(self.solarActuals, file, ensure_ascii=False)
+        self.solarProduction = list(filter(lambda x: x[0].timestamp() >= discardTime, self.solarProduction))
+        # This runs once a day, so its a good time to drop the old and replaced samples from the logs
+        self.solarActualsLog.compact(discardTime)
+        self.solarProductionLog.compact(discardTime)
+
+
+    def importSolarJson(self, sampleLog, fileName, toSamples):
+        # Starts off the log with the samples from the JSON file we used to save them in
+        if not sampleLog.exists() and os.path.isfile(fileName):
+            with open(fileName) as file:
+                sampleLog.append(toSamples(json.load(file)))
 
 
     def gasRateChanged(self, entity, attribute, old, new, kwargs):
@@ -413,61 +399,7 @@ class PowerControl(hass.Hass):
                                            x.get('pv_estimate90')), 
                                 flatForecast))
         powerData.sort(key=lambda x: x[0])
-        timeRangeTunedPowerData   = []
-        timeRangeUntunedPowerData = []
-        prevStartTime             = None
-        prevPower                 = None
-        prevMetaData              = None
-        prevMinEstimate           = None
-        prevMaxEstimate           = None
-        dailyTotals               = {}
-        # Reformat the data so we end up with a tuple with elements (startTime, end , power)
-        for data in powerData:
-            curStartTime = data[0]
-            if prevPower:
-                # Calculate a new set of predictions based on the tuned solar models
-                key   = (prevStartTime.astimezone(timezone.utc).replace(year=2000, month=1, day=1), 
-                         curStartTime.astimezone(timezone.utc).replace(year=2000, month=1, day=1))
-                model = self.solarTuningModels.get(key)
-                prevPowerUntuned = prevPower
-                if model:
-                    prevPower       = round(max(model(prevPower),       0), 3)
-                    prevMinEstimate = round(max(model(prevMinEstimate), 0), 3)
-                    prevMaxEstimate = round(max(model(prevMaxEstimate), 0), 3)
-                # Update the outputs
-                timeRangeUntunedPowerData.append( (prevStartTime, curStartTime, prevPowerUntuned) )
-                timeRangeTunedPowerData.append(   (prevStartTime, curStartTime, prevPower, prevMinEstimate, prevMaxEstimate, prevMetaData) )
-                prevDate = prevStartTime.date()
-                if prevDate not in dailyTotals:
-                    dailyTotals[prevDate] = [0,0,0]
-                dailyTotals[prevDate][0] = dailyTotals[prevDate][0] + prevPower
-                dailyTotals[prevDate][1] = dailyTotals[prevDate][1] + prevMinEstimate
-                dailyTotals[prevDate][2] = dailyTotals[prevDate][2] + prevMaxEstimate
-                
-            prevStartTime = curStartTime
-            # Process the estimates
-            percentile10 = data[2]
-            percentile50 = data[1]
-            percentile90 = data[3]
-            if percentile10:
-                percentile10 = round(percentile10, 3)
-            if percentile90:
-                percentile90 = round(percentile90, 3)
-            if percentile10 and percentile90:
-                # Extrapolate a polynomial from the percentiles and the fact that we should get 0 power at the 
-                # 0th percentile. Then use the polynomial to generate the percentiles we need.
-                forecastPercentiles = [0, 10, 50, 90]
-                forecastValues      = [0, percentile10, percentile50, percentile90]
-                polyLine            = numpy.poly1d(numpy.polyfit(forecastPercentiles, forecastValues, 3))
-                prevMinEstimate     = polyLine(self.solarForecastLowPercentile)
-                prevMaxEstimate     = polyLine(self.solarForecastHighPercentile)
-            else:
-                prevMinEstimate = percentile50 * self.solarForecastMargin
-                prevMaxEstimate = percentile50
-            prevMinEstimate = round(prevMinEstimate, 3)
-            prevMaxEstimate = round(prevMaxEstimate, 3)
-            prevPower       = round(percentile50, 3)
-            prevMetaData    = (percentile10, prevPower, percentile90)
+        (timeRangeUntunedPowerData, timeRangeTunedPowerData, dailyTotals) = self.solarForecastBuilder.build(powerData, self.solarTuningModels)
         self.utils.printSeries(timeRangeTunedPowerData, "Solar forecast")
         for totals in dailyTotals:
             vals = dailyTotals[totals]
@@ -503,17 +435,42 @@ class PowerControl(hass.Hass):
         self.usageStartTime     = startTime
         # Now request the history data. Note: we subtract a further 2 hours from the start time so 
         # we're guaranteed to get data from before the start time we requested
-        self.usageFetchFromTime = startTime - timedelta(hours=2)
-        self.get_history(entity_id  = self.houseLoadEntityName,
-                         start_time = self.usageFetchFromTime,
-                         callback   = self.usageHistoryCallback)
-        
-        
-    def usageHistoryCallback(self, kwargs):
-        self.usagePowerData = kwargs
-        self.get_history(entity_id  = self.eddiSolarPowerUsedTodayEntityName,
-                         start_time = self.usageFetchFromTime,
-                         callback   = self.usageEddiHistoryCallBack1)
+        self.usageFetchFromTime = (startTime - timedelta(hours=2)).astimezone()
+        # We keep an extra day of history in the store, so it still covers the fetch time if the store isn't
+        # pruned again until the next day
+        self.historyStore.prune(self.usageFetchFromTime - timedelta(days=1))
+        self.fetchHistories([self.houseLoadEntityName, self.eddiSolarPowerUsedTodayEntityName, self.eddiGridPowerUsedTodayEntityName],
+                            self.usageHistoryFetched)
+
+
+    def fetchHistories(self, entityNames, callback):
+        # Requests the history for all the entities at once, then calls the callback with a dict of the
+        # samples for each entity once they've all arrived (or the timeout's expired). Any entity that we
+        # don't get new history for uses the last samples we've got in the history store. Only the history
+        # since the last sample in the history store is fetched. Results that arrive after the timeout are
+        # still stored, and the callback is run again with them.
+        join = HistoryJoin(entityNames, lambda results: self.historiesReceived(entityNames, results, callback),
+                                        lambda entityName, result: self.historiesReceived(entityNames, {entityName: result}, callback))
+        for entityName in entityNames:
+            self.get_history(entity_id  = entityName,
+                             start_time = self.historyStore.fetchFromTime(entityName, self.usageFetchFromTime),
+                             callback   = join.resultCallback(entityName))
+        self.run_in(join.timeoutCallback, self.historyFetchTimeout)
+
+
+    def historiesReceived(self, entityNames, results, callback):
+        # Adds the newly fetched samples to the history store, and calls the callback with all the samples
+        # we've got from the usage fetch time for each entity. If there's no samples at all for an entity
+        # (EG on the first start, when the fetch is slow) the callback isn't called, so we don't replace the
+        # data we've got with nothing. It's called when the late results arrive instead.
+        for (entityName, rawHistory) in results.items():
+            self.historyStore.append(entityName, self.processUsageDataToTimeRange(rawHistory))
+        histories = dict(map(lambda x: (x, self.historyStore.load(x, self.usageFetchFromTime)), entityNames))
+        missing   = list(filter(lambda x: not histories[x], entityNames))
+        if missing:
+            self.log("No history yet for " + ", ".join(missing) + ", waiting for it to arrive")
+            return
+        callback(histories)
 
 
     def processUsageDataToTimeRange(self, rawUsageData):
@@ -550,63 +507,24 @@ class PowerControl(hass.Hass):
         return timeRangeUsageData
 
 
-    def processEddiData(self):
+    def processEddiData(self, histories):
         self.log("Eddi data updated")
-        timeRangeEddiGridUsageData  = self.processUsageDataToTimeRange(self.eddiGridData)
-        timeRangeEddiSolarUsageData = self.processUsageDataToTimeRange(self.eddiSolarData)
-        self.core.eddiData          = self.utils.opOnSeries(timeRangeEddiGridUsageData, timeRangeEddiSolarUsageData, lambda a, b: a+b)
+        self.core.eddiData = self.utils.opOnSeries(histories[self.eddiGridPowerUsedTodayEntityName],
+                                                   histories[self.eddiSolarPowerUsedTodayEntityName], lambda a, b: a+b)
 
 
-    def fastEddiHistoryCallBack1(self, kwargs):
-        self.eddiSolarData = kwargs
-        self.get_history(entity_id  = self.eddiGridPowerUsedTodayEntityName,
-                         start_time = self.usageFetchFromTime,
-                         callback   = self.fastEddiHistoryCallBack2)
-
-
-    def fastEddiHistoryCallBack2(self, kwargs):
-        self.eddiGridData = kwargs
-        self.processEddiData()
+    def updateEddiHistory(self, kwargs):
+        self.fetchHistories([self.eddiSolarPowerUsedTodayEntityName, self.eddiGridPowerUsedTodayEntityName], self.processEddiData)
         
 
-    def usageEddiHistoryCallBack1(self, kwargs):
-        self.eddiSolarData = kwargs
-        self.get_history(entity_id  = self.eddiGridPowerUsedTodayEntityName,
-                         start_time = self.usageFetchFromTime,
-                         callback   = self.usageEddiHistoryCallBack2)
-
-
-    def usageEddiHistoryCallBack2(self, kwargs):
-        self.eddiGridData = kwargs
-        self.processEddiData()
-        timeRangeUsageData = self.processUsageDataToTimeRange(self.usagePowerData)
-
-        # Now go through the data creating an average usage for each time period based on the last x days history
-        forecastUsage          = []
-        now                    = datetime.now(datetime.now(timezone.utc).astimezone().tzinfo)
-        forecastUsageStartTime = now.replace(hour=0, minute=0, second=0, microsecond=0)
-        for _ in range(0,24*2):
-            # calculate the start / end time of the timeslot
-            forecastUsageEndTime = forecastUsageStartTime + timedelta(minutes=30)
-            # go back over the last few days for this time period and get the usage
-            avgUsage = 0.0
-            for days in range(1, self.usageDaysHistory+1):
-                daysDelta      = timedelta(days=days)
-                # For each half hour period we subtract the eddi usage from the total usage. We don't
-                # want the eddi distorting the usage totals as we explicitly plan the eddi usage seperately.
-                usageForPeriod = self.utils.powerForPeriod(timeRangeUsageData, 
-                                                           forecastUsageStartTime - daysDelta, 
-                                                           forecastUsageEndTime   - daysDelta)
-                eddiForPeriod  = self.utils.powerForPeriod(self.core.eddiData, 
-                                                           forecastUsageStartTime - daysDelta, 
-                                                           forecastUsageEndTime   - daysDelta)
-                avgUsage       = avgUsage + (usageForPeriod - eddiForPeriod)
-            avgUsage = (avgUsage / self.usageDaysHistory) * self.usageMargin
-            # finally add the data to the usage array
-            forecastUsage.append((forecastUsageStartTime, forecastUsageEndTime, avgUsage)) 
-            forecastUsageStartTime = forecastUsageEndTime
-        # Extend the usage forcast into the future by the number of house in the planning window
-        forecastUsage = self.core.extendSeries(forecastUsage, timedelta(hours=24))        
+    def usageHistoryFetched(self, histories):
+        self.processEddiData(histories)
+        timeRangeUsageData = histories[self.houseLoadEntityName]
+
+        # Now create an average usage for each time period based on the last x days history, for today and tomorrow
+        now           = datetime.now(datetime.now(timezone.utc).astimezone().tzinfo)
+        forecastUsage = self.usageForecaster.forecast(timeRangeUsageData, self.core.eddiData,
+                                                      now.replace(hour=0, minute=0, second=0, microsecond=0))
         self.utils.printSeries(forecastUsage, "Usage forecast")
         self.core.usageData = forecastUsage
         # If there's not been an output update so far, force it now
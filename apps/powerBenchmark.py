@@ -0,0 +1,188 @@
+from core.powerCore import PowerControlCore
+from powerReplay import findStates
+from powerReplay import splitStateName
+import argparse
+import json
+import math
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+import yaml
+
+
+
+class CallProfiler():
+    # Wraps methods on an object so we record how many times they're called, and the total time spent
+    # in them. The times are inclusive, so the time for a stage includes any other stages it calls.
+    def __init__(self):
+        self.times = {}
+        self.calls = {}
+
+
+    def wrap(self, obj, methodName, statName=None):
+        method = getattr(obj, methodName)
+        name   = statName if statName else methodName
+        def wrapper(*args, **kwargs):
+            startTime = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.times[name] = self.times.get(name, 0.0) + time.perf_counter() - startTime
+                self.calls[name] = self.calls.get(name, 0) + 1
+        setattr(obj, methodName, wrapper)
+
+
+
+def discardLog(*args, **kwargs):
+    pass
+
+
+def argOverride(setting):
+    # Splits a NAME=VALUE override, parsing the value the same way as apps.yaml so EG "false" is a bool
+    # and "4" is an int, rather than a (truthy) string
+    (name, value) = setting.split("=", 1)
+    return (name, yaml.safe_load(value))
+
+
+def loadState(stateName, argOverrides={}, prevCore=None):
+    # We load a fresh copy of the state for every run, so each run starts from exactly the same inputs. 
+    # The discharge trial pool is kept from the previous run, as it would be in the running app.
+    (fileName, index) = splitStateName(stateName)
+    core      = PowerControlCore.load(fileName, discardLog, index)
+    core.args = dict(core.args, **argOverrides)
+    if prevCore is not None:
+        core.trialPool = prevCore.trialPool
+    return core
+
+
+def profiledRun(stateName, argOverrides={}, prevCore=None):
+    core     = loadState(stateName, argOverrides, prevCore)
+    profiler = CallProfiler()
+    for stage in ["calculateChargePlan", "allocateChangingSlots", "addDischargeSlots", "calculateEddiPlan", "genBatLevelForecast"]:
+        profiler.wrap(core, stage)
+    profiler.wrap(core.utils, "powerForPeriod")
+    profiler.wrap(core.utils, "printSeries")
+    startTime = time.perf_counter()
+    core.mergeAndProcessData(core.planUpdateTime)
+    return (time.perf_counter() - startTime, profiler, core)
+
+
+def peakMemory(stateName, argOverrides={}):
+    core = loadState(stateName, argOverrides)
+    tracemalloc.start()
+    try:
+        core.mergeAndProcessData(core.planUpdateTime)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+        core.closeDischargeTrialPool()
+
+
+def summarise(samples):
+    samples = sorted(samples)
+    p95     = statistics.quantiles(samples, n=20, method='inclusive')[18] if len(samples) > 1 else samples[0]
+    return { "median": statistics.median(samples),
+             "p95":    p95,
+             "min":    samples[0],
+             "max":    samples[-1] }
+
+
+def benchmarkState(stateName, repeat, argOverrides={}):
+    totals = []
+    stages = {}
+    calls  = {}
+    # An untimed first run, so starting the discharge trial pool (if it's enabled) isn't timed
+    (_, _, core) = profiledRun(stateName, argOverrides)
+    for _ in range(repeat):
+        (total, profiler, core) = profiledRun(stateName, argOverrides, core)
+        totals.append(total)
+        for (name, stageTime) in profiler.times.items():
+            stages.setdefault(name, []).append(stageTime)
+        # The planner is deterministic, so the call counts are the same for every run
+        calls = profiler.calls
+    core.closeDischargeTrialPool()
+    return { "total":           summarise(totals),
+             "stages":          dict(map(lambda x: (x[0], summarise(x[1])), sorted(stages.items()))),
+             "calls":           dict(sorted(calls.items())),
+             "peakMemoryBytes": peakMemory(stateName, argOverrides) }
+
+
+# The modules power.py imports (other than hassapi, which needs AppDaemon), and the code that times
+# their import and a first plan from a saved state in a fresh interpreter
+startupModules = ["core.powerCore", "core.powerUsage", "core.powerHistory", "core.powerSolar"]
+startupScript  = """
+import json, sys, time
+startTime = time.perf_counter()
+for module in {0!r}:
+    __import__(module)
+importTime = time.perf_counter() - startTime
+planTime   = None
+if {1!r}:
+    from core.powerCore import PowerControlCore
+    startTime = time.perf_counter()
+    core      = PowerControlCore.load({1!r}, lambda *args, **kwargs: None, {2!r})
+    core.mergeAndProcessData(core.planUpdateTime)
+    planTime  = time.perf_counter() - startTime
+print(json.dumps({{"import": importTime, "firstPlan": planTime, "modules": sorted(sys.modules)}}))
+"""
+
+
+def startupRun(stateName):
+    # Each run is in a new interpreter, so nothing's already imported
+    (fileName, index) = splitStateName(stateName) if stateName else (None, -1)
+    script = startupScript.format(startupModules, fileName, index)
+    output = subprocess.run([sys.executable, "-c", script], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def benchmarkStartup(stateName, repeat):
+    runs    = list(map(lambda x: startupRun(stateName), range(repeat)))
+    results = { "import":  summarise(list(map(lambda x: x["import"], runs))),
+                "heavyModulesImported": sorted(filter(lambda x: x.split(".")[0] in ["matplotlib", "multiprocessing", "statistics"],
+                                                      runs[0]["modules"])) }
+    if stateName:
+        results["firstPlan"] = summarise(list(map(lambda x: x["firstPlan"], runs)))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Times the power planner over a directory of saved states")
+    parser.add_argument("stateDir",                          help="Directory of .pickle state saves and .snapshots files")
+    parser.add_argument("--repeat", type=int, default=5,     help="Number of timed runs per state")
+    parser.add_argument("--output",                          help="Write the results as JSON to this file")
+    parser.add_argument("--label",  default="",              help="Label stored with the results, EG a git revision")
+    parser.add_argument("--startup", action="store_true",    help="Also time the imports and first plan in a fresh interpreter")
+    parser.add_argument("--set",    action="append", default=[], metavar="NAME=VALUE",
+                        help="Override an app arg for the runs, EG --set dischargeTrialWorkers=4")
+    args = parser.parse_args()
+
+    argOverrides = dict(map(argOverride, args.set))
+    results      = { "label":   args.label,
+                     "python":  platform.python_version(),
+                     "repeat":  args.repeat,
+                     "args":    argOverrides,
+                     "states":  {} }
+    states       = findStates(args.stateDir)
+    for stateName in states:
+        # Each snapshot in a snapshot file is a state of its own, named by the file and the snapshot index
+        (fileName, index)            = splitStateName(stateName)
+        shortName                    = os.path.splitext(os.path.basename(fileName))[0] + ("#{0}".format(index) if index >= 0 else "")
+        stateResults                 = benchmarkState(stateName, args.repeat, argOverrides)
+        results["states"][shortName] = stateResults
+        print("{0:24} median {1:8.3f}s  p95 {2:8.3f}s  peak {3:8.1f} MB  genBatLevelForecast {4:6}  powerForPeriod {5:6}".format(
+              shortName, stateResults["total"]["median"], stateResults["total"]["p95"],
+              stateResults["peakMemoryBytes"] / (1024 * 1024),
+              stateResults["calls"].get("genBatLevelForecast", 0), stateResults["calls"].get("powerForPeriod", 0)))
+    if args.startup:
+        results["startup"] = benchmarkStartup(os.path.abspath(states[0]) if states else None, args.repeat)
+        print("{0:24} import median {1:8.3f}s  first plan median {2:8.3f}s  heavy modules {3}".format(
+              "startup", results["startup"]["import"]["median"], results["startup"].get("firstPlan", {}).get("median", math.nan),
+              ", ".join(results["startup"]["heavyModulesImported"]) or "none"))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,153 @@
+from core.powerCore import PowerControlCore
+from core.powerSnapshots import countSnapshots
+import argparse
+import concurrent.futures
+import datetime
+import glob
+import json
+import math
+import os
+import sys
+import time
+
+
+
+planNames = ["solarChargingPlan",        "gridChargingPlan",    "houseGridPoweredPlan", "standbyPlan",
+             "dischargeExportSolarPlan", "dischargeToGridPlan", "dischargeToHousePlan", "eddiSolarPlan",
+             "eddiGridPlan"]
+
+
+def discardLog(*args, **kwargs):
+    pass
+
+
+def findStates(stateDir):
+    # Returns the names of all the states in the directory. Each snapshot in a snapshot file is a state of
+    # its own, named by the file name and the index of the snapshot in the file.
+    states = []
+    for fileName in sorted(glob.glob(os.path.join(stateDir, "*.pickle")) + glob.glob(os.path.join(stateDir, "*.snapshots"))):
+        if fileName.endswith(".snapshots"):
+            numSnapshots = countSnapshots(fileName)
+            states.extend(map(lambda x: "{0}#{1}".format(fileName, x), range(numSnapshots)))
+        else:
+            states.append(fileName)
+    return states
+
+
+def splitStateName(stateName):
+    # Returns the file name and snapshot index of a state from findStates (-1 for a pickled state)
+    (fileName, _, index) = stateName.partition("#")
+    return (fileName, int(index) if index else -1)
+
+
+def toPlain(value):
+    # Converts the planner outputs into something that can be saved as JSON, and compared after loading
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, dict):
+        return dict(map(lambda x: (str(x[0]), toPlain(x[1])), value.items()))
+    if isinstance(value, (list, tuple)):
+        return list(map(toPlain, value))
+    if hasattr(value, "item"):
+        return value.item()
+    return value
+
+
+def replayState(stateName):
+    # Runs in a worker process. Loads the state, re-plans it, and returns the plans and how long it took.
+    (fileName, index) = splitStateName(stateName)
+    core      = PowerControlCore.load(fileName, discardLog, index)
+    startTime = time.perf_counter()
+    core.mergeAndProcessData(core.planUpdateTime)
+    runTime   = time.perf_counter() - startTime
+    result    = dict(map(lambda x: (x, toPlain(list(getattr(core, x)))), planNames))
+    result["gridSummary"]   = toPlain(core.gridSummary)
+    result["maxChargeCost"] = toPlain(core.maxChargeCost)
+    return {"result": result,
+            "time":   runTime}
+
+
+def diffValues(baseline, current, tolerance, path=""):
+    # Returns a list of the differences between the two values, numbers only have to match to within the
+    # tolerance
+    if isinstance(baseline, dict) and isinstance(current, dict):
+        diffs = []
+        for key in sorted(set(baseline) | set(current)):
+            if key not in baseline or key not in current:
+                diffs.append("{0}/{1}: only in {2}".format(path, key, "baseline" if key in baseline else "current"))
+            else:
+                diffs.extend(diffValues(baseline[key], current[key], tolerance, path + "/" + key))
+        return diffs
+    if isinstance(baseline, list) and isinstance(current, list):
+        if len(baseline) != len(current):
+            return ["{0}: length {1} -> {2}".format(path, len(baseline), len(current))]
+        return [diff for idx in range(len(baseline)) for diff in diffValues(baseline[idx], current[idx], tolerance, "{0}[{1}]".format(path, idx))]
+    isNumber = lambda x: isinstance(x, (int, float)) and not isinstance(x, bool)
+    if isNumber(baseline) and isNumber(current):
+        if math.isclose(baseline, current, rel_tol=tolerance, abs_tol=tolerance) or (math.isnan(baseline) and math.isnan(current)):
+            return []
+    elif baseline == current:
+        return []
+    return ["{0}: {1} -> {2}".format(path, baseline, current)]
+
+
+def compare(baseline, current, tolerance, slowdown, minSlowdownTime):
+    # Returns the behaviour differences and the speed regressions for each state, and the states that are
+    # only in one of the two sets of results
+    stateDiffs = {}
+    slowStates = {}
+    for stateName in sorted(set(baseline) & set(current)):
+        diffs = diffValues(baseline[stateName]["result"], current[stateName]["result"], tolerance)
+        if diffs:
+            stateDiffs[stateName] = diffs
+        (baseTime, curTime) = (baseline[stateName]["time"], current[stateName]["time"])
+        if curTime > baseTime * slowdown and curTime - baseTime > minSlowdownTime:
+            slowStates[stateName] = (baseTime, curTime)
+    return {"diffs":   stateDiffs,
+            "slow":    slowStates,
+            "added":   sorted(set(current)  - set(baseline)),
+            "removed": sorted(set(baseline) - set(current))}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Re-plans a directory of saved states in parallel, and compares the plans with a baseline")
+    parser.add_argument("stateDir",                                    help="Directory of .pickle states and / or .snapshots files")
+    parser.add_argument("--baseline",                                  help="JSON file of the baseline results")
+    parser.add_argument("--update-baseline", action="store_true",      help="Save the results as the new baseline")
+    parser.add_argument("--workers",   type=int,   default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument("--tolerance", type=float, default=1e-6,       help="Allowed difference between numbers")
+    parser.add_argument("--slowdown",  type=float, default=1.5,        help="Flag states that are this many times slower than the baseline")
+    parser.add_argument("--minSlowdownTime", type=float, default=0.05, help="Ignore slow downs less than this many seconds")
+    parser.add_argument("--maxDiffs",  type=int,   default=5,          help="Number of differences to print for each state")
+    args = parser.parse_args()
+
+    states    = findStates(args.stateDir)
+    startTime = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max(args.workers, 1)) as executor:
+        # The results are named relative to the state directory, so the baseline still matches if its moved
+        current = dict(zip(map(lambda x: os.path.relpath(x, args.stateDir), states), executor.map(replayState, states)))
+    print("Replayed {0} states in {1:.1f}s".format(len(states), time.perf_counter() - startTime))
+
+    failed = False
+    if args.baseline and os.path.isfile(args.baseline) and not args.update_baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        results  = compare(baseline, current, args.tolerance, args.slowdown, args.minSlowdownTime)
+        for (stateName, diffs) in results["diffs"].items():
+            print("{0}: {1} differences".format(stateName, len(diffs)))
+            for diff in diffs[:args.maxDiffs]:
+                print("    " + diff)
+        for (stateName, (baseTime, curTime)) in results["slow"].items():
+            print("{0}: slower {1:.3f}s -> {2:.3f}s".format(stateName, baseTime, curTime))
+        for stateName in results["added"]:
+            print("{0}: not in the baseline".format(stateName))
+        for stateName in results["removed"]:
+            print("{0}: in the baseline, but not replayed".format(stateName))
+        print("{0} states differ, {1} are slower, {2} added, {3} removed".format(len(results["diffs"]), len(results["slow"]),
+                                                                                 len(results["added"]), len(results["removed"])))
+        failed = bool(results["diffs"] or results["slow"])
+    if args.baseline and (args.update_baseline or not os.path.isfile(args.baseline)):
+        with open(args.baseline, 'w') as file:
+            json.dump(current, file, indent=1)
+        print("Saved the baseline to " + args.baseline)
+    sys.exit(1 if failed else 0)
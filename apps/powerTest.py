@@ -6,5 +6,7 @@ if __name__ == "__main__":
     def log(prtStr, level=None):
         print(prtStr)
 
-    obj = PowerControlCore.load(sys.argv[1:][0], log)
+    # The state is either a pickled state or a snapshot file, for a snapshot file an index can be given
+    # to pick the snapshot to replay (by default the last one)
+    obj = PowerControlCore.load(sys.argv[1], log, int(sys.argv[2]) if len(sys.argv) > 2 else -1)
     obj.mergeAndProcessData(obj.planUpdateTime)